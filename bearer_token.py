@@ -2,3 +2,9 @@
 # e.g. token = "AAAAAAAAAAAAAAAAAAAAAMLheAAAAAAA0%2BuSeid%2BULvsea4JtiGRiSDSJSI%3DEUifiRBkKG5E2XzMDjRfl76ZC9Ub0wnz4XsNiRVBChTYbJcE3F"
 
 token = ""
+
+# If your study holds several approved project tokens, list them all here instead,
+# and Epicosm will spread its requests across them, e.g.
+# tokens = ["AAAA...first token...", "AAAA...second token..."]
+
+tokens = []
@@ -21,9 +21,24 @@ from alive_progress import alive_bar
 #~ Local application imports
 from modules import (
     mongo_ops,
+    mongod_lifecycle,
+    backup_ops,
     epicosm_meta,
     twitter_ops,
     follows_ops,
+    harvest_pipeline,
+    adaptive_schedule,
+    harvest_plan,
+    batch_harvest,
+    backfill,
+    job_queue,
+    user_failures,
+    page_archive,
+    archive_loader,
+    api_cassette,
+    schema_v2,
+    index_registry,
+    twitter_api,
     env_config,
     mongodb_config)
 try:
@@ -46,8 +61,64 @@ def args_setup():
       help="Harvest recent tweets from the users being followed by a user. (This process can be very slow and take up a lot of storage, especially if your users are prolific followers.)")
     parser.add_argument("--repeat", action="store", type=int,
       help="Repeat the harvest every given number of days. This process will need to be put to the background to free your terminal prompt.")
+    parser.add_argument("--adaptive", action="store_true",
+      help="Keep running, harvesting each user when they are due: prolific users often, quiet users rarely. Use with --harvest (and --worker, if enqueueing), instead of --repeat.")
+    parser.add_argument("--plan", action="store_true",
+      help="Before harvesting, count each user's new tweets (in groups, with the counts endpoint), skip those with none, and harvest the busiest first.")
+    parser.add_argument("--batch", action="store_true",
+      help="Harvest users with only a few new tweets many to a request, leaving the busier ones to be harvested one by one.")
+    parser.add_argument("--backfill_slices", action="store", type=int,
+      help="Fetch each new user's history as this many time slices, --concurrency slices at once, rather than as one long chain.")
+    parser.add_argument("--concurrency", action="store", type=int, default=1,
+      help="Harvest this many users' timelines at once (default 1, one user at a time).")
+    parser.add_argument("--writers", action="store", type=int,
+      help="Harvest with separate fetching and writing stages, using this many MongoDB writers (fetchers set by --concurrency).")
+    parser.add_argument("--queue_size", action="store", type=int, default=16,
+      help="With --writers, how many fetched pages may wait to be written before fetching pauses (default 16).")
+    parser.add_argument("--enqueue", action="store_true",
+      help="Rather than harvesting here, queue a harvest job per user (for --harvest and/or --get_follows) in MongoDB, for --worker processes to do.")
+    parser.add_argument("--worker", action="store_true",
+      help="Work through the queued harvest jobs (of the kinds given by --harvest and/or --get_follows, or all), with --concurrency workers. Run as many as you like, here or on other machines.")
     parser.add_argument("--refresh", action="store_true",
       help="If you have a new user_list, this will tell Epicosm to switch to this list.")
+    parser.add_argument("--lookup_max_age", action="store", type=int,
+      help="When looking up user_list, check again any name that was last looked up more than this many days ago.")
+    parser.add_argument("--fields", action="store", default="standard", choices=sorted(twitter_ops.FIELD_PROFILES),
+      help="How much to harvest about each tweet: minimal (id, author, time, text), standard (adds metrics, attachments and geo; the default) or full (everything, with authors, mentioned users and media expanded into their own collections).")
+    parser.add_argument("--expansions", action="store",
+      help="Expansions to add to the field profile, comma separated, e.g. \"author_id,attachments.media_keys\". Expanded users and media are kept in the users and media collections.")
+    parser.add_argument("--schema_v2", action="store_true",
+      help="Store new tweets, follows, users and pseudofeeds with ids as 64 bit integers and times as dates, rather than as the strings the API sends.")
+    parser.add_argument("--migrate_schema", action="store_true",
+      help="Convert the tweets, follows and pseudofeed already stored to the --schema_v2 types, in batches, in the background of any harvest. If stopped, it carries on where it left off next time.")
+    parser.add_argument("--build_indexes", action="store_true",
+      help="Build any missing indexes in the background (rebuilding any whose options have changed), then check how MongoDB would run each query Epicosm makes, flagging any that would read a whole collection.")
+    parser.add_argument("--archive_pages", action="store_true",
+      help="Also write every page the API sends back to compressed files in page_archive/, before it goes into MongoDB, so nothing is lost if MongoDB is down or slow.")
+    parser.add_argument("--load_archive", action="store_true",
+      help="Load the pages in page_archive/ into MongoDB (--concurrency files at once), skipping any already loaded. Safe to repeat.")
+    parser.add_argument("--record", action="store",
+      help="Record every API request and response of this run to a cassette file, e.g. \"--record session.cassette.gz\".")
+    parser.add_argument("--replay", action="store",
+      help="Answer every API request from a recorded cassette file instead of Twitter, to profile harvests offline on the same traffic.")
+    parser.add_argument("--replay_speed", action="store", type=float, default=1.0,
+      help="With --replay, how many times faster than recorded to replay (default 1, 0 for as fast as possible).")
+    parser.add_argument("--backup", action="store", default="auto", choices=["auto", "full", "incremental", "none"],
+      help="How to back up the database after each run, in the background: full, incremental (only the documents added since the last backup), auto (incremental, with a full one weekly; the default) or none.")
+    parser.add_argument("--keep_backups", action="store", type=int, default=backup_ops.KEEP_FULL,
+      help=f"How many full backups to keep, each with the incrementals after it (1 or more, default {backup_ops.KEEP_FULL}).")
+    parser.add_argument("--mongo_uri", action="store",
+      help="The MongoDB to use, e.g. \"mongodb://db.example.org:27017\" (default mongodb://localhost:27017, or $EPICOSM_MONGO_URI).")
+    parser.add_argument("--mongo_pool_size", action="store", type=int,
+      help=f"The most MongoDB connections to keep open (default {mongodb_config.POOL_SIZE}).")
+    parser.add_argument("--write_concern", action="store", type=mongodb_config.parse_write_concern,
+      help="How many MongoDB replica set members must have each write before it counts: a number, or \"majority\" (default 1).")
+    parser.add_argument("--pool_stats", action="store_true",
+      help="At the end of each run, report how the MongoDB connection pool was used.")
+    parser.add_argument("--mongo_cache_gb", action="store", type=float,
+      help="When starting MongoDB, how much memory (in GB) it may use to cache data (default: MongoDB's own, half of the RAM less 1 GB).")
+    parser.add_argument("--mongod_options", action="store",
+      help="Other options to start MongoDB with, in quotes, e.g. \"--bind_ip_all --quiet\".")
     parser.add_argument("--start_db", action="store_true",
       help="Start the MongoDB daemon in this folder, but don't run any Epicosm processes.")
     parser.add_argument("--stop", action="store_true",
@@ -59,6 +130,14 @@ def args_setup():
 
     args = parser.parse_args()
 
+    #~ an adaptive loop that harvests nothing here would never schedule anyone, and would run every minute
+    if args.adaptive and not args.harvest:
+        parser.error("--adaptive schedules timeline harvests, so it needs --harvest.")
+    if args.adaptive and args.enqueue and not args.worker:
+        parser.error("--adaptive with --enqueue needs --worker too: users are only scheduled once their jobs are run.")
+    if args.keep_backups < 1:
+        parser.error("--keep_backups must be 1 or more: the backup just taken is always kept.")
+
     return parser, args
 
 
@@ -78,7 +157,7 @@ def main():
         subprocess.call(["pkill", "-15", "-f", "epicosm"])
 
         if args.shutdown_db:
-            mongo_ops.stop_mongo(env.db_path)
+            mongod_lifecycle.stop_mongod()
 
         sys.exit(0)
 
@@ -87,11 +166,13 @@ def main():
     (mongod_executable_path, mongoexport_executable_path,
     mongodump_executable_path) = epicosm_meta.check_env()
 
-    #~ start mongodb daemon
-    mongo_ops.start_mongo(mongod_executable_path,
-                          env.db_path,
-                          env.db_log_filename,
-                          env.epicosm_log_filename)
+    #~ start mongodb daemon, unless one is running already, and wait until it's ready
+    mongod_lifecycle.start_mongod(mongod_executable_path,
+                                  env.db_path,
+                                  env.db_log_filename,
+                                  env.epicosm_log_filename,
+                                  cache_size_gb=args.mongo_cache_gb,
+                                  options=args.mongod_options)
     if args.start_db:
         print(f"OK, MongoDB started, but without Epicosm processes.")
         sys.exit(0)
@@ -103,41 +184,153 @@ def main():
     #~ setup signal handler
     signal.signal(signal.SIGINT, epicosm_meta.signal_handler)
 
-    #~ tidy up the database for better efficiency
-    mongo_ops.index_mongo(env.run_folder)
+    #~ record this run's API traffic, or play a recorded run back (once, even if repeating)
+    if args.record and api_cassette.recorder is None:
+        api_cassette.start_recording(args.record)
+    if args.replay and api_cassette.cassette is None:
+        api_cassette.start_replay(args.replay, args.replay_speed)
+        twitter_api.token_pool = twitter_api.TokenPool(twitter_api.bearer_tokens,
+                                                       api_cassette.replay_families(args.replay_speed))
+
+    #~ build the indexes Epicosm's queries need, and check they are used
+    if args.build_indexes:
+        index_registry.wait_for_build(index_registry.start_build(replace=True))
+        index_registry.advise()
+        if not (args.harvest or args.get_follows or args.pseudofeed or args.worker
+                or args.load_archive or args.migrate_schema):
+            sys.exit(0)
+    else:
+        index_registry.start_build()
+
+    #~ store ids as numbers and times as dates
+    if args.schema_v2:
+        schema_v2.enable()
+
+    #~ convert what's already stored, on its own or alongside the rest of the run
+    migration = None
+    if args.migrate_schema:
+        if not (args.harvest or args.get_follows or args.pseudofeed or args.worker or args.load_archive):
+            schema_v2.migrate()
+            sys.exit(0)
+        migration = schema_v2.start_migration()
+
+    #~ write every page to disk before it goes into MongoDB
+    if args.archive_pages:
+        page_archive.open_archive(env.run_folder)
+
+    #~ put archived pages into MongoDB, and stop there unless there's more to do
+    if args.load_archive:
+        archive_loader.load_archive(env.run_folder, concurrency=args.concurrency)
+        if not (args.harvest or args.get_follows or args.pseudofeed or args.worker):
+            sys.exit(0)
 
     #~ get persistent user ids from screen names
     if args.refresh or not os.path.exists(env.run_folder + "/user_details.json"):
-        twitter_ops.user_lookup()
+        twitter_ops.user_lookup(max_age_days=args.lookup_max_age,
+                                concurrency=args.concurrency)
 
-    #~ get tweets for each user and archive in mongodb
+    #~ what to ask for about each tweet
+    if args.harvest or args.worker:
+        twitter_ops.set_field_profile(args.fields, args.expansions)
+
+    #~ with adaptive scheduling, only harvest the users who are due
+    harvest_ids = None
+    if args.harvest and args.adaptive:
+        harvest_ids = adaptive_schedule.due_users([user["id"] for user in twitter_ops.load_user_details()])
+        print(f"{len(harvest_ids)} users are due a harvest.")
+
+    #~ leave out accounts that keep failing (gone, suspended, protected) until they are due a re-check
     if args.harvest:
-        twitter_ops.timeline_harvest(mongodb_config.db, mongodb_config.tweets_collection)
+        if harvest_ids is None:
+            harvest_ids = [user["id"] for user in twitter_ops.load_user_details()]
+        harvest_ids = user_failures.due_users(harvest_ids)
+    scheduled_ids = harvest_ids
+
+    #~ fetch new users' histories in time slices, several at once
+    if args.harvest and args.backfill_slices and not (args.enqueue or args.worker):
+        if harvest_ids is None:
+            harvest_ids = [user["id"] for user in twitter_ops.load_user_details()]
+        harvest_ids = backfill.backfill_harvest(harvest_ids, mongodb_config.tweets_collection,
+                                                slices=args.backfill_slices,
+                                                concurrency=args.concurrency)
+
+    #~ only harvest the users with something new, the busiest first
+    new_counts = None
+    if args.harvest and args.plan:
+        if harvest_ids is None:
+            harvest_ids = [user["id"] for user in twitter_ops.load_user_details()]
+        harvest_ids, skipped_ids, new_counts = harvest_plan.plan_harvest(harvest_ids,
+                                                                         mongodb_config.tweets_collection)
+
+    #~ harvest the quiet users many to a request, leaving the rest for the harvest below
+    if args.harvest and args.batch and not (args.enqueue or args.worker):
+        if harvest_ids is None:
+            harvest_ids = [user["id"] for user in twitter_ops.load_user_details()]
+        harvest_ids = batch_harvest.batch_harvest(harvest_ids, mongodb_config.tweets_collection,
+                                                  counts=new_counts)
+
+    #~ the job queue kinds asked for, or all of them if none were
+    job_kinds = [kind for kind, wanted in (("timeline", args.harvest), ("follows", args.get_follows)) if wanted]
+    if args.worker and len(job_kinds) == 0:
+        job_kinds = list(job_queue.JOB_KINDS)
+
+    #~ hand the harvests out as jobs, or take some of them on
+    if args.enqueue:
+        all_ids = [user["id"] for user in twitter_ops.load_user_details()]
+        if args.harvest:
+            job_queue.enqueue_jobs(harvest_ids if harvest_ids is not None else all_ids,
+                                   ["timeline"], adaptive=args.adaptive)
+        if args.get_follows:
+            job_queue.enqueue_jobs(user_failures.due_users(all_ids), ["follows"])
+    if args.worker:
+        job_queue.run_workers(job_kinds, workers=args.concurrency)
+
+    #~ get tweets for each user and archive in mongodb
+    if args.enqueue or args.worker:
+        pass #~ the job queue has seen to the timelines and follows
+    elif args.harvest and args.writers:
+        harvest_pipeline.pipeline_harvest(mongodb_config.db, mongodb_config.tweets_collection,
+                                          fetchers=args.concurrency,
+                                          writers=args.writers,
+                                          queue_size=args.queue_size,
+                                          user_ids=harvest_ids)
+    elif args.harvest:
+        twitter_ops.timeline_harvest(mongodb_config.db, mongodb_config.tweets_collection,
+                                     concurrency=args.concurrency,
+                                     user_ids=harvest_ids)
+
+    #~ set when each harvested user is next due, from how much they post
+    if args.harvest and args.adaptive and not (args.enqueue or args.worker):
+        for twitter_id in scheduled_ids:
+            adaptive_schedule.schedule_user(twitter_id, mongodb_config.tweets_collection)
 
     #~ if user wants the follows list, make it
-    if args.get_follows:
+    if args.get_follows and not (args.enqueue or args.worker):
         follows_ops.follows_list_harvest(mongodb_config.db, mongodb_config.follows_collection)
 
     #~ if we want to do the recent follows stuff
     if args.pseudofeed:
         follows_ops.pseudofeed_harvest(mongodb_config.db, mongodb_config.follows_collection)
 
-    #~ backup database into BSON
-    mongo_ops.backup_db(mongodump_executable_path,
-                        env.database_dump_path,
-                        env.epicosm_log_filename,
-                        env.processtime)
-
-    #~ rotate backups - if there are more than 3, remove the oldest one
-    current_backup_count = len([name for name in os.listdir(env.database_dump_path + "/twitter_db") if os.path.isfile(os.path.join(env.database_dump_path + "/twitter_db", name))])
-    #~ each backup is one bson and one json of metadata, so 6 = 3 backups.
-    if current_backup_count > 6:
-        print("Rotating backups.")
-        bu_list = glob.glob(env.database_dump_path + "/twitter_db/tweets*")
-        bu_list.sort()
-        #~ remove the oldest two, a bson and a json
-        subprocess.call(["rm", bu_list[0]])
-        subprocess.call(["rm", bu_list[1]])
+    #~ let the schema migration finish before backing up
+    if migration is not None:
+        print("Waiting for the schema migration to finish...")
+        migration.join()
+
+    #~ back up the database (compressed, only what's new where possible) while we get on;
+    #~ an adaptive pass with nobody due has added nothing to back up
+    if args.backup != "none" and not (args.adaptive and len(scheduled_ids) == 0):
+        backup_ops.start_backup(mongodump_executable_path,
+                                env.database_dump_path,
+                                env.epicosm_log_filename,
+                                kind=args.backup,
+                                keep_full=args.keep_backups)
+
+    if args.record or args.replay:
+        api_cassette.report()
+
+    if args.pool_stats:
+        mongodb_config.report_pool()
 
     print(f"Job finished at {datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.\n")
 
@@ -146,7 +339,20 @@ if __name__ == "__main__":
 
     parser, args = args_setup()
 
-    if args.repeat:
+    #~ where MongoDB is and how to talk to it (nothing connects until it's first used)
+    mongodb_config.configure(uri=args.mongo_uri, pool_size=args.mongo_pool_size,
+                             write_concern=args.write_concern)
+
+    if args.adaptive:
+
+        while True:
+            main()
+            user_ids = [user["id"] for user in twitter_ops.load_user_details()]
+            wait = max(adaptive_schedule.seconds_until_next_due(user_ids), 60)
+            print(f"Next adaptive harvest check in {wait / 60:.0f} minutes.")
+            time.sleep(wait)
+
+    elif args.repeat:
 
         main()
         schedule.every(args.repeat).days.do(main)
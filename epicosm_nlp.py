@@ -10,6 +10,8 @@ import subprocess
 #~ Local application imports
 from modules import (
     mongo_ops,
+    mongod_lifecycle,
+    backup_ops,
     epicosm_meta,
     twitter_ops,
     nlp_ops,
@@ -47,10 +49,9 @@ def main():
     #~ Set paths as instance of EnvironmentConfig
     env = env_config.EnvironmentConfig()
 
-    try:
-        subprocess.check_output(["pgrep", "mongod"])
+    if mongod_lifecycle.ping():
         print(f"MongoDB identified as running.")
-    except subprocess.CalledProcessError:
+    else:
         print(f"MongoDB does not appear to be running here. You can start MongoDB with")
         print(f"python3 epicosm.py --start_db")
         sys.exit(1)
@@ -98,22 +99,12 @@ def main():
     if args.algo:
         nlp_ops.nlp_algo_apply(working_collection, total_records, args.algo)
 
-    #~ backup database into BSON
-    mongo_ops.backup_db(mongodump_executable_path,
-                        env.database_dump_path,
-                        env.epicosm_log_filename,
-                        env.processtime)
-
-    #~ rotate backups - if there are more than 3, remove the oldest one
-    current_backup_count = len([name for name in os.listdir(env.database_dump_path + "/twitter_db") if os.path.isfile(os.path.join(env.database_dump_path + "/twitter_db", name))])
-    #~ each backup is one bson and one json of metadata, so 6 = 3 backups.
-    if current_backup_count > 6:
-        print("Rotating backups.")
-        bu_list = glob.glob(env.database_dump_path + "/twitter_db/tweets*")
-        bu_list.sort()
-        #~ remove the oldest two, a bson and a json
-        subprocess.call(["rm", bu_list[0]])
-        subprocess.call(["rm", bu_list[1]])
+    #~ back up the database: a full backup, since the analyses changed documents already backed up
+    backup_ops.start_backup(mongodump_executable_path,
+                            env.database_dump_path,
+                            env.epicosm_log_filename,
+                            kind="full")
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,181 @@
+#~ Standard library imports
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+#~ 3rd party imports
+import pymongo
+
+#~ Local application imports
+sys.path.append(".")
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from modules import (
+    twitter_api,
+    twitter_ops,
+    follows_ops,
+    harvest_pipeline,
+    rate_limit,
+    mongodb_config)
+import mock_twitter
+
+
+#~ Measure harvest throughput against the local mock Twitter API, so
+#~ changes to the harvester can be compared without a bearer token.
+#~ Needs MongoDB running (python epicosm.py --start_db). Writes to a
+#~ separate database, epicosm_benchmark, which is emptied first.
+#~
+#~ Run from the top level Epicosm folder, eg
+#~   python harvest_benchmarker/harvest_benchmarker.py --users 200 --concurrency 8 --latency 0.2
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ args_setup
+#~ use_benchmark_db
+#~ rate_limited_seconds
+#~ run_benchmark
+
+
+BENCHMARK_DB = "epicosm_benchmark"
+
+
+def args_setup():
+
+    parser = argparse.ArgumentParser(description="Epicosm harvest benchmark, against a local mock Twitter API")
+    parser.add_argument("--users", type=int, default=100,
+      help="How many synthetic users to harvest.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.05,
+      help="Seconds the mock adds to each response.")
+    parser.add_argument("--rate_429", type=float, default=0.0,
+      help="Chance of any request getting a 429.")
+    parser.add_argument("--rate_503", type=float, default=0.0,
+      help="Chance of any request getting a 503.")
+    parser.add_argument("--window", type=int, default=60,
+      help="Rate limit window of the mock in seconds (twitter's is 900). Budgets are scaled to match.")
+    parser.add_argument("--unpaced", action="store_true",
+      help="Drop the one request per second pacing of search/all, to measure the harvester rather than the rules.")
+    parser.add_argument("--tokens", type=int, default=1,
+      help="How many bearer tokens to spread requests across (the mock gives each the same budget).")
+    parser.add_argument("--concurrency", type=int, default=1,
+      help="As epicosm.py --concurrency.")
+    parser.add_argument("--writers", type=int,
+      help="As epicosm.py --writers.")
+    parser.add_argument("--follows", action="store_true",
+      help="Benchmark follows_list_harvest too.")
+
+    return parser.parse_args()
+
+
+def use_benchmark_db():
+
+    """Point every module at an empty benchmark database."""
+
+    mongodb_config.configure(db_name=BENCHMARK_DB, server_timeout_ms=3000)
+    try:
+        mongodb_config.client.admin.command("ping")
+    except pymongo.errors.ServerSelectionTimeoutError:
+        print(f"MongoDB does not appear to be running here. You can start MongoDB with")
+        print(f"python3 epicosm.py --start_db")
+        sys.exit(1)
+
+    mongodb_config.client.drop_database(BENCHMARK_DB)
+    db = mongodb_config.db
+
+    return db
+
+
+def rate_limited_seconds():
+
+    """Seconds all requests spent waiting on the rate limit governors."""
+
+    return sum(bucket["waited_seconds"]
+               for credential in twitter_api.token_pool.state().values()
+               for bucket in credential["limits"].values())
+
+
+def run_benchmark(label, harvest, collection):
+
+    """
+    Time one harvest and report its throughput.
+
+    RETS:   dict of the results.
+    """
+
+    requests_before = twitter_api.stats()["requests"]
+    waited_before = rate_limited_seconds()
+    start = time.monotonic()
+    harvest()
+    elapsed = time.monotonic() - start
+    requests_made = twitter_api.stats()["requests"] - requests_before
+    records = collection.count_documents({})
+
+    results = {
+        "benchmark": label,
+        "seconds": round(elapsed, 2),
+        "records": records,
+        "requests": requests_made,
+        "records_per_second": round(records / elapsed, 1),
+        "requests_per_second": round(requests_made / elapsed, 2),
+        "rate_limited_seconds": round(rate_limited_seconds() - waited_before, 2),
+        "mongo_pool": mongodb_config.pool_stats()}
+    print(json.dumps(results))
+
+    return results
+
+
+if __name__ == "__main__":
+
+    args = args_setup()
+
+    #~ the mock's budgets are the real ones, squeezed into a shorter window
+    scale = args.window / 900
+    families = {family: (max(int(limit * scale), 1), args.window)
+                for family, (limit, window) in mock_twitter.DEFAULT_RATE_LIMITS.items()}
+    mock = mock_twitter.MockTwitter(users=args.users, seed=args.seed, latency=args.latency,
+                                    rate_429=args.rate_429, rate_503=args.rate_503,
+                                    rate_limits=families)
+    server, api_root = mock_twitter.start_server(mock)
+    twitter_api.API_ROOT = api_root
+
+    governor_families = {family: (limit, window, 0.0 if args.unpaced else min_interval)
+                         for family, (limit, window, min_interval) in rate_limit.ENDPOINT_FAMILIES.items()}
+    for family, (limit, window) in families.items():
+        governor_families[family] = (limit, window, governor_families[family][2])
+    twitter_api.token_pool = twitter_api.TokenPool(
+        [f"benchmark-token-{number}" for number in range(args.tokens)], governor_families)
+
+    db = use_benchmark_db()
+
+    #~ the harvesters work on user_list / user_details.json in the current folder
+    os.chdir(tempfile.mkdtemp(prefix="epicosm_benchmark_"))
+    with open("user_list", "w") as outfile:
+        outfile.write("\n".join(f"user{index}" for index in range(args.users)))
+    twitter_ops.user_lookup(concurrency=args.concurrency)
+
+    results = []
+    if args.writers:
+        results.append(run_benchmark(
+            f"pipeline_harvest fetchers={args.concurrency} writers={args.writers}",
+            lambda: harvest_pipeline.pipeline_harvest(db, db.tweets, fetchers=args.concurrency,
+                                                      writers=args.writers),
+            db.tweets))
+    else:
+        results.append(run_benchmark(
+            f"timeline_harvest concurrency={args.concurrency}",
+            lambda: twitter_ops.timeline_harvest(db, db.tweets, concurrency=args.concurrency),
+            db.tweets))
+    if args.follows:
+        results.append(run_benchmark(
+            "follows_list_harvest",
+            lambda: follows_ops.follows_list_harvest(db, db.follows),
+            db.follows))
+
+    print(f"\nMock served: {json.dumps(mock.counters)}")
+    for result in results:
+        print(f"{result['benchmark']}: {result['records_per_second']} records/s, "
+              f"{result['requests_per_second']} requests/s, "
+              f"{result['rate_limited_seconds']} s rate limited.")
+    server.shutdown()
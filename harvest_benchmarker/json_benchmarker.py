@@ -0,0 +1,117 @@
+#~ Standard library imports
+import os
+import sys
+import json
+import time
+import argparse
+
+#~ 3rd party imports
+import requests
+
+#~ Local application imports
+sys.path.append(".")
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from modules import json_ops
+import mock_twitter
+
+
+#~ Time how long it takes to decode one full page of search results
+#~ (500 tweets), the old way (requests' response.json()) and through
+#~ json_ops, with and without orjson. No MongoDB or network needed.
+#~
+#~ Run from the top level Epicosm folder, eg
+#~   python harvest_benchmarker/json_benchmarker.py --pages 200
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ args_setup
+#~ sample_page
+#~ as_response
+#~ time_decode
+
+
+def args_setup():
+
+    parser = argparse.ArgumentParser(description="Epicosm JSON decode benchmark")
+    parser.add_argument("--pages", type=int, default=200,
+      help="How many times to decode the page, for each decoder.")
+    parser.add_argument("--tweets", type=int, default=500,
+      help="Tweets per page (500 is the search/all maximum).")
+    parser.add_argument("--seed", type=int, default=1)
+
+    return parser.parse_args()
+
+
+def sample_page(tweets, seed):
+
+    """
+    Build one search/all page body the way the mock API serves it, with the
+    tweet fields Epicosm asks for.
+
+    RETS:   the page as JSON bytes.
+    """
+
+    mock = mock_twitter.MockTwitter(users=1000, seed=seed, max_tweets=tweets)
+    page = []
+    for index in range(mock.user_count):
+        page.extend(mock.timeline(mock.user(index)["id"]))
+        if len(page) >= tweets:
+            break
+    page = page[:tweets]
+    for tweet in page:
+        tweet["attachments"] = {"media_keys": []}
+        tweet["geo"] = {}
+    body = {"data": page,
+            "meta": {"result_count": len(page), "newest_id": page[0]["id"],
+                     "oldest_id": page[-1]["id"], "next_token": "b26v89c19zqg8o3fpzbkk"}}
+
+    return json.dumps(body).encode("utf-8")
+
+
+def as_response(content):
+
+    """Wrap the bytes in a requests Response, as connect_to_endpoint gets them."""
+
+    response = requests.models.Response()
+    response._content = content
+    response.status_code = 200
+    response.headers["Content-Type"] = "application/json; charset=utf-8"
+
+    return response
+
+
+def time_decode(label, decode, pages, page_bytes):
+
+    """
+    Decode the page over and over.
+
+    RETS:   milliseconds per page.
+    """
+
+    decode() #~ warm up
+    start = time.perf_counter()
+    for _ in range(pages):
+        decode()
+    per_page = (time.perf_counter() - start) / pages * 1000
+    print(f"{label:<32} {per_page:8.3f} ms per page  ({page_bytes / per_page / 1000:.0f} MB/s)")
+
+    return per_page
+
+
+if __name__ == "__main__":
+
+    args = args_setup()
+
+    content = sample_page(args.tweets, args.seed)
+    print(f"Decoding a {args.tweets} tweet page of {len(content) / 1024:.0f} KB, {args.pages} times.\n")
+
+    before = time_decode("response.json() (before)", lambda: as_response(content).json(),
+                         args.pages, len(content))
+    time_decode("json_ops.loads, standard library",
+                lambda: json.loads(content), args.pages, len(content))
+    if json_ops.orjson is None:
+        print("\norjson isn't installed (pip install orjson), so json_ops uses the standard library.")
+    else:
+        after = time_decode("json_ops.loads, orjson (after)",
+                            lambda: json_ops.loads(content), args.pages, len(content))
+        print(f"\norjson decodes each page {before / after:.1f}x faster.")
@@ -0,0 +1,484 @@
+#~ Standard library imports
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+#~ A local stand-in for the parts of the Twitter v2 API that Epicosm uses:
+#~   /2/users/by
+#~   /2/tweets/search/all
+#~   /2/tweets/search/recent
+#~   /2/tweets/counts/all
+#~   /2/users/:id/following
+#~ Users, timelines and follows are synthetic, generated from a seed so every
+#~ run serves the same data. Latency, 429s and 503s can be injected.
+#~ Searches give only the tweet.fields asked for, and the author_id and
+#~ attachments.media_keys expansions (with user.fields and media.fields).
+#~
+#~ Run it on its own with
+#~   python harvest_benchmarker/mock_twitter.py --port 8000
+#~ and point Epicosm at it with
+#~   EPICOSM_API_ROOT=http://127.0.0.1:8000/2 python epicosm.py --harvest
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ snowflake
+#~ snowflake_time
+#~ iso
+#~ parse_iso
+#~ MockTwitter
+#~ MockHandler
+#~ start_server
+
+
+TWITTER_EPOCH_MS = 1288834974657
+FIRST_USER_ID = 1000000000
+
+#~ family: (requests per window, window seconds), the real budgets unless told otherwise
+DEFAULT_RATE_LIMITS = {
+    "search/all": (300, 900),
+    "search/recent": (450, 900),
+    "counts/all": (300, 900),
+    "users/:id/following": (15, 900),
+    "users/by": (300, 900)}
+
+
+def snowflake(timestamp, sequence):
+
+    """A tweet id in the way twitter makes them: milliseconds since their epoch, shifted."""
+
+    return ((int(timestamp * 1000) - TWITTER_EPOCH_MS) << 22) | (sequence & 0x3FFFFF)
+
+
+def snowflake_time(tweet_id):
+
+    """The epoch seconds a tweet id was made at."""
+
+    return ((int(tweet_id) >> 22) + TWITTER_EPOCH_MS) / 1000
+
+
+def iso(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def parse_iso(text):
+    return datetime.datetime.strptime(text[:19], "%Y-%m-%dT%H:%M:%S").replace(
+        tzinfo=datetime.timezone.utc).timestamp()
+
+
+class MockTwitter:
+
+    """
+    The synthetic data and the behaviour of the mock API.
+
+    ARGS:   users: how many users exist (user0, user1, ...),
+            seed: for the random data,
+            latency: seconds added to each response (plus up to 50% jitter),
+            rate_429 / rate_503: chance of any request failing with these,
+            rate_limits: per endpoint family (limit, window seconds),
+            dormant: fraction of users who barely tweet.
+    """
+
+    def __init__(self, users=100, seed=1, latency=0.0, rate_429=0.0, rate_503=0.0,
+                 rate_limits=None, dormant=0.3, max_tweets=5000, max_follows=3000):
+        self.user_count = users
+        self.seed = seed
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_503 = rate_503
+        self.dormant = dormant
+        self.max_tweets = max_tweets
+        self.max_follows = max_follows
+        self.now = time.time()
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS, **(rate_limits or {}))
+        self._windows = {} #~ family: [window start, requests used]
+        self._timelines = {}
+        self._follows = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.counters = {"requests": 0, "200": 0, "429": 0, "503": 0, "tweets_served": 0}
+
+    #~ SYNTHETIC DATA ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def user(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        created = rng.uniform(parse_iso("2008-01-01T00:00:00"), self.now - 365 * 86400)
+        return {
+            "id": str(FIRST_USER_ID + index),
+            "username": f"user{index}",
+            "name": f"Synthetic User {index}",
+            "created_at": iso(created),
+            "description": "",
+            "location": "",
+            "public_metrics": {"followers_count": rng.randint(0, 5000),
+                               "following_count": rng.randint(0, 5000),
+                               "tweet_count": 0, "listed_count": 0}}
+
+    def user_index(self, twitter_id):
+        index = int(twitter_id) - FIRST_USER_ID
+        if 0 <= index < self.user_count:
+            return index
+        return None
+
+    def timeline(self, twitter_id):
+
+        """Everything a user has ever tweeted, newest first, made on first use."""
+
+        with self._lock:
+            if twitter_id in self._timelines:
+                return self._timelines[twitter_id]
+
+        index = self.user_index(twitter_id)
+        tweets = []
+        if index is not None:
+            rng = random.Random(self.seed * 7919 + index)
+            created = parse_iso(self.user(index)["created_at"])
+            if rng.random() < self.dormant:
+                count = rng.randint(0, 5)
+                latest = self.now - 365 * 86400
+            else:
+                count = min(int(rng.paretovariate(1.2) * 50), self.max_tweets)
+                latest = self.now
+            times = sorted((rng.uniform(created, latest) for _ in range(count)), reverse=True)
+            for sequence, timestamp in enumerate(times):
+                tweet_id = str(snowflake(timestamp, sequence))
+                tweets.append({
+                    "id": tweet_id,
+                    "author_id": twitter_id,
+                    "created_at": iso(timestamp),
+                    "text": f"Synthetic tweet {sequence} from user{index} " + " ".join(
+                        rng.choice(["good", "bad", "happy", "sad", "cat", "dog", "rain", "sun"])
+                        for _ in range(rng.randint(3, 30))),
+                    "public_metrics": {"retweet_count": rng.randint(0, 10), "reply_count": 0,
+                                       "like_count": rng.randint(0, 50), "quote_count": 0}})
+
+            #~ some tweets have a photo (from their own generator, so the tweets are as before)
+            media_rng = random.Random(self.seed * 6151 + index)
+            for tweet in tweets:
+                if media_rng.random() < 0.2:
+                    tweet["attachments"] = {"media_keys": [f"3_{tweet['id']}"]}
+
+        with self._lock:
+            self._timelines.setdefault(twitter_id, tweets)
+            return self._timelines[twitter_id]
+
+    def media(self, media_key):
+        rng = random.Random(media_key)
+        width, height = rng.choice([(1200, 675), (1080, 1080), (675, 1200)])
+        return {"media_key": media_key, "type": "photo",
+                "url": f"https://pbs.twimg.com/media/{media_key}.jpg",
+                "width": width, "height": height, "alt_text": ""}
+
+    def shape(self, tweets, query):
+
+        """
+        Trim tweets to the fields asked for, and gather the expanded objects.
+
+        RETS:   the tweets, and the "includes" (empty if nothing was expanded).
+        """
+
+        def wanted(name, always):
+            return set(always) | set(filter(None, query.get(name, [""])[0].split(",")))
+
+        tweet_fields = wanted("tweet.fields", ("id", "text"))
+        expansions = wanted("expansions", ())
+        data = [{field: value for field, value in tweet.items() if field in tweet_fields}
+                for tweet in tweets]
+
+        includes = {}
+        if "author_id" in expansions:
+            user_fields = wanted("user.fields", ("id", "name", "username"))
+            authors = {tweet["author_id"]: self.user(self.user_index(tweet["author_id"])) for tweet in tweets}
+            includes["users"] = [{field: value for field, value in user.items() if field in user_fields}
+                                 for user in authors.values()]
+        if "attachments.media_keys" in expansions:
+            media_fields = wanted("media.fields", ("media_key", "type"))
+            media_keys = [key for tweet in tweets for key in tweet.get("attachments", {}).get("media_keys", [])]
+            if media_keys:
+                includes["media"] = [{field: value for field, value in self.media(key).items()
+                                      if field in media_fields} for key in media_keys]
+
+        return data, includes
+
+    def following(self, twitter_id):
+
+        """Who a user follows: some of the other synthetic users, and many outsiders."""
+
+        with self._lock:
+            if twitter_id in self._follows:
+                return self._follows[twitter_id]
+
+        index = self.user_index(twitter_id)
+        follows = []
+        if index is not None:
+            rng = random.Random(self.seed * 104729 + index)
+            count = min(int(rng.paretovariate(1.1) * 30), self.max_follows)
+            for _ in range(count):
+                if rng.random() < 0.5:
+                    followed = rng.randrange(self.user_count)
+                else:
+                    followed = rng.randrange(self.user_count, self.user_count * 100)
+                follows.append({"id": str(FIRST_USER_ID + followed),
+                                "username": f"user{followed}",
+                                "name": f"Synthetic User {followed}"})
+            follows = list({follow["id"]: follow for follow in follows}.values())
+
+        with self._lock:
+            self._follows.setdefault(twitter_id, follows)
+            return self._follows[twitter_id]
+
+    #~ BEHAVIOUR ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def family(self, path):
+        if "/tweets/search/all" in path:
+            return "search/all"
+        if "/tweets/search/recent" in path:
+            return "search/recent"
+        if "/tweets/counts/all" in path:
+            return "counts/all"
+        if re.search(r"/users/[^/]+/following", path):
+            return "users/:id/following"
+        if "/users/by" in path:
+            return "users/by"
+        return "other"
+
+    def take_rate_limit(self, family):
+
+        """
+        Count a request against its family's window.
+
+        RETS:   allowed (bool), and the x-rate-limit-* headers to send.
+        """
+
+        limit, window = self.rate_limits.get(family, (300, 900))
+        with self._lock:
+            now = time.time()
+            start, used = self._windows.get(family, (now, 0))
+            if now >= start + window:
+                start, used = now, 0
+            allowed = used < limit
+            if allowed:
+                used += 1
+            self._windows[family] = (start, used)
+        headers = {"x-rate-limit-limit": str(limit),
+                   "x-rate-limit-remaining": str(limit - used),
+                   "x-rate-limit-reset": str(int(start + window) + 1)}
+        return allowed, headers
+
+    def handle(self, path, query):
+
+        """
+        Answer one request.
+
+        RETS:   status code, headers, body (as a dict).
+        """
+
+        with self._lock:
+            self.counters["requests"] += 1
+        if self.latency:
+            time.sleep(self.latency * (1 + self._random.random() * 0.5))
+
+        family = self.family(path)
+        allowed, headers = self.take_rate_limit(family)
+        if not allowed or self._random.random() < self.rate_429:
+            self.count("429")
+            return 429, headers, {"title": "Too Many Requests", "status": 429}
+        if self._random.random() < self.rate_503:
+            self.count("503")
+            return 503, headers, {"title": "Service Unavailable", "status": 503}
+
+        if family == "users/by":
+            body = self.users_by(query)
+        elif family in ("search/all", "search/recent"):
+            body = self.search(query, recent=(family == "search/recent"))
+        elif family == "counts/all":
+            body = self.counts(query)
+        elif family == "users/:id/following":
+            body = self.follows(path.rstrip("/").split("/")[-2], query)
+        else:
+            return 404, headers, {"title": "Not Found Error", "status": 404}
+
+        self.count("200")
+        return 200, headers, body
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] += amount
+
+    def users_by(self, query):
+        names = query.get("usernames", [""])[0].split(",")
+        data, errors = [], []
+        for name in names:
+            match = re.match(r"^user(\d+)$", name, re.IGNORECASE)
+            if match and int(match.group(1)) < self.user_count:
+                data.append(self.user(int(match.group(1))))
+            else:
+                errors.append({"value": name, "detail": f"Could not find user with usernames: [{name}].",
+                               "title": "Not Found Error", "resource_type": "user",
+                               "parameter": "usernames",
+                               "type": "https://api.twitter.com/2/problems/resource-not-found"})
+        body = {}
+        if data:
+            body["data"] = data
+        if errors:
+            body["errors"] = errors
+        return body
+
+    def search(self, query, recent=False):
+        authors = re.findall(r"from:(\d+)", query.get("query", [""])[0])
+        since_id = int(query.get("since_id", ["0"])[0])
+        until_id = int(query.get("until_id", [str(2 ** 63)])[0])
+        start_time = parse_iso(query["start_time"][0]) if "start_time" in query else 0
+        end_time = parse_iso(query["end_time"][0]) if "end_time" in query else self.now + 1
+        if recent:
+            start_time = max(start_time, self.now - 7 * 86400)
+        max_results = int(query.get("max_results", ["10"])[0])
+        offset = int(query.get("next_token", ["0"])[0] or 0)
+
+        matches = []
+        for author in authors:
+            for tweet in self.timeline(author):
+                tweet_id = int(tweet["id"])
+                if since_id < tweet_id < until_id and start_time <= snowflake_time(tweet_id) < end_time:
+                    matches.append(tweet)
+        matches.sort(key=lambda tweet: int(tweet["id"]), reverse=True)
+
+        page = matches[offset:offset + max_results]
+        self.count("tweets_served", len(page))
+        meta = {"result_count": len(page)}
+        if page:
+            meta["newest_id"] = page[0]["id"]
+            meta["oldest_id"] = page[-1]["id"]
+        if offset + max_results < len(matches):
+            meta["next_token"] = str(offset + max_results)
+        body = {"meta": meta}
+        if page:
+            body["data"], includes = self.shape(page, query)
+            if includes:
+                body["includes"] = includes
+        return body
+
+    def counts(self, query):
+
+        """
+        Tweet counts per minute, hour or day bucket, as counts/all gives them.
+        Like the real endpoint, it looks back 30 days unless given a start_time,
+        and each page holds up to 31 days of buckets.
+        """
+
+        authors = re.findall(r"from:(\d+)", query.get("query", [""])[0])
+        since_id = int(query.get("since_id", ["0"])[0])
+        until_id = int(query.get("until_id", [str(2 ** 63)])[0])
+        end_time = parse_iso(query["end_time"][0]) if "end_time" in query else self.now
+        start_time = parse_iso(query["start_time"][0]) if "start_time" in query else end_time - 30 * 86400
+        bucket = {"minute": 60, "hour": 3600, "day": 86400}[query.get("granularity", ["hour"])[0]]
+        page_span = 31 * 86400
+        page_start = start_time + page_span * int(query.get("next_token", ["0"])[0] or 0)
+        page_end = min(page_start + page_span, end_time)
+
+        times = []
+        for author in authors:
+            for tweet in self.timeline(author):
+                tweet_id = int(tweet["id"])
+                if since_id < tweet_id < until_id and page_start <= snowflake_time(tweet_id) < page_end:
+                    times.append(snowflake_time(tweet_id))
+
+        data = []
+        bucket_start = page_start
+        while bucket_start < page_end:
+            bucket_end = min(bucket_start + bucket, page_end)
+            data.append({"start": iso(bucket_start), "end": iso(bucket_end),
+                         "tweet_count": sum(1 for at in times if bucket_start <= at < bucket_end)})
+            bucket_start = bucket_end
+        meta = {"total_tweet_count": len(times)}
+        if page_end < end_time:
+            meta["next_token"] = str(int(query.get("next_token", ["0"])[0] or 0) + 1)
+        return {"data": data, "meta": meta}
+
+    def follows(self, twitter_id, query):
+        if self.user_index(twitter_id) is None:
+            return {"errors": [{"title": "Not Found Error", "value": twitter_id,
+                                "detail": f"Could not find user with id: [{twitter_id}]."}],
+                    "title": "Not Found Error"}
+        max_results = int(query.get("max_results", ["100"])[0])
+        offset = int(query.get("pagination_token", ["0"])[0] or 0)
+        follows = self.following(twitter_id)
+        page = follows[offset:offset + max_results]
+        meta = {"result_count": len(page)}
+        if offset + max_results < len(follows):
+            meta["next_token"] = str(offset + max_results)
+        body = {"meta": meta}
+        if page:
+            body["data"] = page
+        return body
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    """Hands each GET to the MockTwitter the server was started with."""
+
+    protocol_version = "HTTP/1.1" #~ so clients can keep connections alive
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        status, headers, body = self.server.mock.handle(url.path, parse_qs(url.query))
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass #~ quiet
+
+
+def start_server(mock, host="127.0.0.1", port=0):
+
+    """
+    Serve a MockTwitter from a background thread.
+
+    RETS:   the server, and the API root to point twitter_api at.
+    """
+
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.mock = mock
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://{host}:{server.server_address[1]}/2"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local mock of the Twitter v2 endpoints used by Epicosm")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0,
+      help="Seconds added to each response.")
+    parser.add_argument("--rate_429", type=float, default=0.0,
+      help="Chance of any request getting a 429.")
+    parser.add_argument("--rate_503", type=float, default=0.0,
+      help="Chance of any request getting a 503.")
+    args = parser.parse_args()
+
+    mock = MockTwitter(users=args.users, seed=args.seed, latency=args.latency,
+                       rate_429=args.rate_429, rate_503=args.rate_503)
+    server, api_root = start_server(mock, port=args.port)
+    print(f"Mock Twitter API serving at {api_root} (user0 ... user{args.users - 1}). ctrl-c to stop.")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
@@ -0,0 +1,177 @@
+#~ Standard library imports
+import datetime
+
+#~ Local application imports
+from modules import mongodb_config, schema_v2, user_failures
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ tweet_time
+#~ first_tweet_id
+#~ posting_rate
+#~ harvest_interval
+#~ schedule_user
+#~ due_users
+#~ seconds_until_next_due
+
+
+#~ Rather than harvesting everyone every N days, each user gets their own
+#~ next_due time in their harvest_state record, set from how much they post:
+#~ prolific users come round often, dormant ones rarely.
+
+#~ how far back we look to judge how active someone is
+RECENT_DAYS = 90
+#~ roughly how many new tweets we'd like each harvest of a user to find
+TARGET_TWEETS_PER_HARVEST = 50
+#~ bounds on how often a user is harvested
+MIN_INTERVAL_DAYS = 1
+MAX_INTERVAL_DAYS = 30
+#~ never sleep longer than this between checks for due users, so a refreshed
+#~ user_list is picked up
+CHECK_EVERY_SECONDS = 3600
+
+TWITTER_EPOCH_MS = 1288834974657
+
+
+def tweet_time(tweet_id):
+
+    """
+    When a tweet was posted, read from its id (twitter ids start with
+    the milliseconds since their epoch).
+
+    RETS:   a utc datetime.
+    """
+
+    return datetime.datetime.utcfromtimestamp(((int(tweet_id) >> 22) + TWITTER_EPOCH_MS) / 1000)
+
+
+def first_tweet_id(at):
+
+    """
+    The smallest tweet id that could have been posted at a time, for
+    turning a time into a since_id.
+
+    ARGS:   a utc datetime.
+
+    RETS:   the id, at least 1 (ids from before twitter's epoch would be negative).
+    """
+
+    epoch_ms = int((at - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+    return max((epoch_ms - TWITTER_EPOCH_MS) << 22, 1)
+
+
+def posting_rate(twitter_id, working_collection, state=None, now=None):
+
+    """
+    Estimate how many tweets a day a user posts, from the tweets we hold.
+
+    CALLS:  collection.count_documents()
+
+    ARGS:   the ID number for the user,
+            the collection of tweets,
+            their harvest state record, if already read.
+
+    RETS:   tweets per day over the last RECENT_DAYS, 0 if they have been quiet.
+    """
+
+    now = now or datetime.datetime.utcnow()
+    if state is None:
+        state = mongodb_config.harvest_state_collection.find_one({"_id": twitter_id})
+    if state is None or not state.get("newest_id"):
+        return 0.0
+
+    recent_start = now - datetime.timedelta(days=RECENT_DAYS)
+    if tweet_time(state["newest_id"]) < recent_start:
+        return 0.0 #~ nothing recent at all, no need to count
+
+    #~ created_at is an ISO string (which sorts the same as the time it holds) or, in schema 2, a date
+    recent_count = working_collection.count_documents({
+        "author_id": schema_v2.id_match(twitter_id),
+        **schema_v2.time_after("created_at", recent_start)})
+
+    return recent_count / RECENT_DAYS
+
+
+def harvest_interval(rate):
+
+    """
+    How long to leave a user before harvesting them again.
+
+    ARGS:   their tweets per day.
+
+    RETS:   a timedelta, between MIN_INTERVAL_DAYS and MAX_INTERVAL_DAYS.
+    """
+
+    if rate <= 0:
+        return datetime.timedelta(days=MAX_INTERVAL_DAYS)
+    days = TARGET_TWEETS_PER_HARVEST / rate
+
+    return datetime.timedelta(days=min(max(days, MIN_INTERVAL_DAYS), MAX_INTERVAL_DAYS))
+
+
+def schedule_user(twitter_id, working_collection, now=None):
+
+    """
+    Set when a user is next due, from their posting rate.
+
+    CALLS:  posting_rate()
+            harvest_interval()
+
+    RETS:   the next due datetime.
+    """
+
+    now = now or datetime.datetime.utcnow()
+    rate = posting_rate(twitter_id, working_collection, now=now)
+    next_due = now + harvest_interval(rate)
+    mongodb_config.harvest_state_collection.update_one(
+        {"_id": twitter_id},
+        {"$set": {"posting_rate": round(rate, 3), "next_due": next_due}},
+        upsert=True)
+
+    return next_due
+
+
+def due_users(user_ids, now=None):
+
+    """
+    Which of these users are due a harvest. Users we have never
+    scheduled are always due, unless their account keeps failing and
+    isn't due a re-check yet (see user_failures).
+
+    CALLS:  user_failures.failing_keys()
+
+    RETS:   list of due user ids, in the order given.
+    """
+
+    now = now or datetime.datetime.utcnow()
+    not_due = {state["_id"] for state in mongodb_config.harvest_state_collection.find(
+        {"_id": {"$in": list(user_ids)}, "next_due": {"$gt": now}}, {"_id": 1})}
+    not_due |= user_failures.failing_keys(user_ids, now=now)
+
+    return [twitter_id for twitter_id in user_ids if twitter_id not in not_due]
+
+
+def seconds_until_next_due(user_ids, now=None):
+
+    """
+    How long until the next of these users comes due, capped at
+    CHECK_EVERY_SECONDS. A user is due once their next_due has passed
+    and, if their account is failing, their re-check time too.
+    """
+
+    now = now or datetime.datetime.utcnow()
+    if len(due_users(user_ids, now)) > 0:
+        return 0
+    user_ids = list(user_ids)
+    due_at = {twitter_id: now for twitter_id in user_ids}
+    for state in mongodb_config.harvest_state_collection.find(
+            {"_id": {"$in": user_ids}, "next_due": {"$gt": now}}, {"next_due": 1}):
+        due_at[state["_id"]] = state["next_due"]
+    for failure in mongodb_config.user_failures_collection.find(
+            {"_id": {"$in": user_ids}, "recheck_at": {"$gt": now}}, {"recheck_at": 1}):
+        due_at[failure["_id"]] = max(due_at[failure["_id"]], failure["recheck_at"])
+    if len(due_at) == 0:
+        return CHECK_EVERY_SECONDS
+
+    return min((min(due_at.values()) - now).total_seconds(), CHECK_EVERY_SECONDS)
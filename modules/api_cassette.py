@@ -0,0 +1,310 @@
+#~ Standard library imports
+import gzip
+import time
+import atexit
+import datetime
+import threading
+import collections
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+#~ 3rd party imports
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.exceptions import RequestException
+
+#~ Local application imports
+from modules import rate_limit, json_ops
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ CassetteMiss
+#~ request_key
+#~ CassetteRecorder
+#~ RecordingAdapter
+#~ Cassette
+#~ ReplayAdapter
+#~ start_recording
+#~ start_replay
+#~ replay_families
+#~ adapter
+#~ report
+
+
+#~ Record every request to the API and what came back into a "cassette"
+#~ (--record), and serve a run back from one later with no network and no
+#~ rate limit spent (--replay), so harvests can be profiled and compared
+#~ on exactly the same traffic. A cassette is gzipped JSON lines: a header,
+#~   {"cassette": 1, "recorded": "<iso time>"}
+#~ then one line per request, in the order the responses came back:
+#~   {"t": <seconds since recording started>, "duration": <seconds the API took>,
+#~    "wall": <epoch seconds the response came back>,
+#~    "method": "GET", "key": "<path?sorted query>", "request_headers": {...},
+#~    "status": 200, "reason": "OK", "headers": {...}, "body": "<response text>"}
+#~ Bearer tokens are never written. Requests are matched on method, path
+#~ and query (so the API root doesn't matter), and a request made several
+#~ times gets its recorded responses in the order they were recorded.
+#~ Some queries carry times worked out from the clock (counts and backfill
+#~ start_time / end_time), so a request with no exact match is given the
+#~ next response recorded for the same request with those left out.
+
+CASSETTE_VERSION = 1
+#~ "as fast as possible" (speed 0) replays this many times faster than recorded
+FASTEST = 1e6
+#~ request headers not worth keeping, or not safe to
+SKIP_REQUEST_HEADERS = {"authorization", "user-agent", "accept-encoding", "connection", "accept"}
+#~ the body is stored decoded, so these no longer describe it
+SKIP_RESPONSE_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+#~ query parameters that are set from the clock, ignored when there's no exact match
+CLOCK_PARAMS = {"start_time", "end_time"}
+
+
+class CassetteMiss(RequestException):
+
+    """A replayed run made a request the cassette has no (more) responses for."""
+
+
+def request_key(method, url, ignore=()):
+
+    """
+    The key a request is recorded and matched under: the method, the path
+    after the API root, and the query with its parameters in order.
+
+    ARGS:   the method and full url,
+            optionally, query parameters to leave out.
+    """
+
+    parts = urlsplit(url)
+    path = parts.path.split("/2/", 1)[-1] if "/2/" in parts.path else parts.path.lstrip("/")
+    query = urlencode(sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                             if name not in ignore))
+
+    return f"{method} {path}?{query}" if query else f"{method} {path}"
+
+
+class CassetteRecorder:
+
+    """
+    Writes request/response pairs to a cassette. Shared by every thread's
+    session, so each pair goes in whole, one after another.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._file = gzip.open(path, "wb")
+        self.requests = 0
+        self._write({"cassette": CASSETTE_VERSION,
+                     "recorded": datetime.datetime.utcnow().isoformat(timespec="seconds")})
+
+    def _write(self, entry):
+        self._file.write(json_ops.dumps(entry) + b"\n")
+
+    def record(self, request, response, started, duration):
+        entry = {
+            "t": round(started - self._start, 4),
+            "duration": round(duration, 4),
+            "wall": round(time.time(), 3),
+            "method": request.method,
+            "key": request_key(request.method, request.url),
+            "request_headers": {name: value for name, value in request.headers.items()
+                                if name.lower() not in SKIP_REQUEST_HEADERS},
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {name: value for name, value in response.headers.items()
+                        if name.lower() not in SKIP_RESPONSE_HEADERS},
+            "body": response.content.decode("utf-8", errors="replace")}
+        with self._lock:
+            self._write(entry)
+            self._file.flush()
+            self.requests += 1
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                print(f"Recorded {self.requests} API requests to {self.path}.")
+
+
+class RecordingAdapter(HTTPAdapter):
+
+    """An ordinary keep-alive adapter that also records what it sends and gets."""
+
+    def __init__(self, recorder, **kwargs):
+        super().__init__(**kwargs)
+        self.recorder = recorder
+
+    def send(self, request, **kwargs):
+        started = time.monotonic()
+        response = super().send(request, **kwargs)
+        response.content #~ read the whole body now, so the duration includes it
+        self.recorder.record(request, response, started, time.monotonic() - started)
+        return response
+
+
+class Cassette:
+
+    """
+    The recorded responses, queued up by request key, to be handed out in
+    the order they were recorded. Shared by every thread's session.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed if speed > 0 else FASTEST
+        self._lock = threading.Lock()
+        self._responses = collections.defaultdict(collections.deque)
+        self._loose = collections.defaultdict(collections.deque) #~ the same, keyed without CLOCK_PARAMS
+        self.requests = 0
+        self.served = 0
+        self.missed = 0
+        with gzip.open(path, "rb") as infile:
+            header = json_ops.loads(infile.readline())
+            if header.get("cassette") != CASSETTE_VERSION:
+                raise ValueError(f"{path} isn't a cassette this version of Epicosm can read.")
+            self.recorded = header.get("recorded")
+            for line in infile:
+                entry = json_ops.loads(line)
+                entry["served"] = False
+                self._responses[entry["key"]].append(entry)
+                self._loose[request_key(*entry["key"].split(" ", 1), ignore=CLOCK_PARAMS)].append(entry)
+                self.requests += 1
+
+    def _take(self, entries):
+        while len(entries) > 0:
+            entry = entries.popleft()
+            if not entry["served"]:
+                entry["served"] = True
+                return entry
+        return None
+
+    def next_response(self, method, url):
+        with self._lock:
+            entry = self._take(self._responses.get(request_key(method, url), collections.deque()))
+            if entry is None:
+                entry = self._take(self._loose.get(request_key(method, url, CLOCK_PARAMS), collections.deque()))
+            if entry is None:
+                self.missed += 1
+                return None
+            self.served += 1
+            return entry
+
+
+class ReplayAdapter(BaseAdapter):
+
+    """
+    Answers requests from a cassette instead of the network, taking as long
+    as the API did (divided by the replay speed; speed 0 doesn't wait).
+    """
+
+    def __init__(self, cassette):
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        entry = self.cassette.next_response(request.method, request.url)
+        if entry is None:
+            raise CassetteMiss(f"No recorded response left for {request_key(request.method, request.url)}",
+                               request=request)
+        time.sleep(entry["duration"] / self.cassette.speed)
+
+        response = requests.models.Response()
+        response.status_code = entry["status"]
+        response.reason = entry["reason"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        #~ rate limit resets move with the replay: as far ahead of now as they were of the response
+        reset = rate_limit.parse_rate_limit_headers(response.headers)[2]
+        if reset is not None:
+            ahead = max(reset - entry["wall"], 0) / self.cassette.speed
+            response.headers["x-rate-limit-reset"] = str(int(time.time() + ahead))
+        response._content = entry["body"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(seconds=entry["duration"])
+        return response
+
+    def close(self):
+        pass
+
+
+#~ at most one of these is set for a run
+recorder = None
+cassette = None
+
+
+def start_recording(path):
+
+    """
+    Record every API request from now on into a cassette at path.
+
+    RETS:   the CassetteRecorder.
+    """
+
+    global recorder
+    recorder = CassetteRecorder(path)
+    atexit.register(recorder.close)
+    print(f"Recording API requests and responses to {path}.")
+
+    return recorder
+
+
+def start_replay(path, speed=1.0):
+
+    """
+    Answer every API request from now on from the cassette at path.
+
+    ARGS:   the cassette,
+            how much faster than recorded to replay (1 is as recorded,
+            0 is as fast as possible).
+
+    RETS:   the Cassette.
+    """
+
+    global cassette
+    cassette = Cassette(path, speed)
+    print(f"Replaying {cassette.requests} API responses recorded {cassette.recorded} from {path}, "
+          f"{'as fast as possible' if speed <= 0 else f'at {speed:g}x speed'}.")
+
+    return cassette
+
+
+def replay_families(speed):
+
+    """
+    The rate limit budgets to pace a replay with: the real ones, with their
+    windows and gaps shortened by the replay speed (or none at all, at 0).
+    """
+
+    speed = speed if speed > 0 else FASTEST
+
+    return {family: (limit, window / speed, min_interval / speed)
+            for family, (limit, window, min_interval) in rate_limit.ENDPOINT_FAMILIES.items()}
+
+
+def adapter(pool_size):
+
+    """
+    The transport adapter for a new session: recording, replaying, or
+    None to use an ordinary one.
+    """
+
+    if cassette is not None:
+        return ReplayAdapter(cassette)
+    if recorder is not None:
+        return RecordingAdapter(recorder, pool_connections=pool_size, pool_maxsize=pool_size)
+
+    return None
+
+
+def report():
+
+    """Say how the recording or replay went."""
+
+    if cassette is not None:
+        print(f"Replay: {cassette.served} responses served from the cassette, "
+              f"{cassette.missed} requests it had no response for, "
+              f"{cassette.requests - cassette.served} recorded responses unused.")
+    elif recorder is not None:
+        print(f"Recording: {recorder.requests} API requests recorded to {recorder.path} so far.")
@@ -0,0 +1,144 @@
+#~ Standard library imports
+import os
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+#~ Local application imports
+from modules import page_archive, mongo_ops, harvest_state, mongodb_config
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ write_batch
+#~ load_segment
+#~ load_archive
+
+
+#~ Put archived pages (see page_archive.py) into MongoDB. Records are
+#~ upserted on their key just as the harvest does, so loading a segment
+#~ twice, or loading pages the harvest did manage to write, changes
+#~ nothing. Segments are loaded several at once, and each one loaded is
+#~ noted in the archive_segments collection so it isn't read again:
+#~   {"_id": "<segment file name>", "loaded": <date>,
+#~    "pages": <int>, "records": <int>, "inserted": <int>}
+
+#~ how many records to put in each bulk write
+BATCH_RECORDS = 5000
+
+
+def write_batch(collection_name, key_fields, records):
+
+    """
+    Upsert a batch of archived records, and count new tweets in
+    their authors' harvest state. Authors with tweets from before harvest
+    state existed have their state built from those first, so the count
+    starts from what was already held, and since_id stays where it was.
+
+    CALLS:  harvest_state.get_state()
+            harvest_state.bootstrap_state()
+            mongo_ops.bulk_upsert()
+            harvest_state.record_loaded()
+
+    RETS:   how many records were new.
+    """
+
+    working_collection = mongodb_config.db[collection_name]
+    is_tweets = collection_name == mongodb_config.tweets_collection.name
+    if is_tweets:
+        for twitter_id in {record.get("author_id") for record in records} - {None}:
+            if harvest_state.get_state(twitter_id) is None:
+                harvest_state.bootstrap_state(twitter_id, working_collection)
+    counts = mongo_ops.bulk_upsert(records, working_collection, key_fields)
+
+    if is_tweets:
+        authors = {}
+        for position, record in enumerate(records):
+            author = authors.setdefault(record.get("author_id"), {"records": [], "inserted": 0})
+            author["records"].append(record)
+            if position in counts["upserted"]:
+                author["inserted"] += 1
+        for twitter_id, author in authors.items():
+            if twitter_id is not None:
+                harvest_state.record_loaded(twitter_id, author["records"], author["inserted"])
+
+    return counts["inserted"]
+
+
+def load_segment(path):
+
+    """
+    Load one segment, BATCH_RECORDS at a time per collection (expanded
+    users and media go to their own collections, as mongo_ops.insert_includes).
+
+    CALLS:  page_archive.read_segment()
+            write_batch()
+
+    RETS:   dict of "pages", "records" and "inserted".
+    """
+
+    totals = {"pages": 0, "records": 0, "inserted": 0}
+    batches = {}
+    for entry in page_archive.read_segment(path):
+        totals["pages"] += 1
+        #~ the page's records, and any expanded users and media that came with it
+        parts = [((entry["collection"], tuple(entry["key_fields"])), entry["page"].get("data", []))]
+        for kind, (collection_name, key_fields) in mongo_ops.INCLUDES_COLLECTIONS.items():
+            parts.append(((getattr(mongodb_config, collection_name).name, key_fields),
+                          entry["page"].get("includes", {}).get(kind, [])))
+        for key, records in parts:
+            if len(records) == 0:
+                continue
+            batch = batches.setdefault(key, [])
+            batch.extend(records)
+            if len(batch) >= BATCH_RECORDS:
+                totals["records"] += len(batch)
+                totals["inserted"] += write_batch(key[0], key[1], batch)
+                batches[key] = []
+    for (collection_name, key_fields), batch in batches.items():
+        totals["records"] += len(batch)
+        totals["inserted"] += write_batch(collection_name, key_fields, batch)
+
+    mongodb_config.archive_segments_collection.update_one(
+        {"_id": os.path.basename(path)},
+        {"$set": dict(totals, loaded=datetime.datetime.utcnow())},
+        upsert=True)
+    print(f"Loaded {os.path.basename(path)}: {totals['pages']} pages, "
+          f"{totals['inserted']} new of {totals['records']} records.")
+
+    return totals
+
+
+def load_archive(run_folder, concurrency=4, reload=False):
+
+    """
+    Load every page archive segment not already loaded into MongoDB.
+
+    CALLS:  page_archive.list_segments()
+            load_segment()
+
+    ARGS:   the run folder (segments are in page_archive/ in it),
+            how many segments to load at once,
+            whether to load segments that were loaded before, too.
+    """
+
+    folder = os.path.join(run_folder, page_archive.ARCHIVE_FOLDER)
+    segments = page_archive.list_segments(folder)
+    if not reload:
+        loaded = {segment["_id"] for segment in mongodb_config.archive_segments_collection.find(
+            {"_id": {"$in": [os.path.basename(path) for path in segments]}}, {"_id": 1})}
+        segments = [path for path in segments if os.path.basename(path) not in loaded]
+    if len(segments) == 0:
+        print(f"\nNo page archive segments to load in {folder}.")
+        return
+
+    concurrency = max(concurrency, 1)
+    print(f"\nLoading {len(segments)} page archive segments, {concurrency} at a time...")
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(load_segment, segments))
+
+    elapsed = time.monotonic() - start
+    records = sum(result["records"] for result in results)
+    print(f"Loaded {sum(result['pages'] for result in results)} pages in {elapsed:.0f} seconds: "
+          f"{sum(result['inserted'] for result in results)} new of {records} records "
+          f"({records / max(elapsed, 0.001):.0f} records a second).")
@@ -0,0 +1,222 @@
+#~ Standard library imports
+import asyncio
+import datetime
+
+#~ Local application imports
+from modules import (
+    twitter_ops,
+    mongo_ops,
+    harvest_state,
+    mongodb_config)
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ lifetime_slices
+#~ slice_endpoint
+#~ harvest_slice
+#~ async_backfill_user
+#~ backfill_user
+#~ backfill_harvest
+
+
+#~ A new user's whole history is otherwise one next_token chain, hundreds
+#~ of requests one after another for an old account. Here their lifetime
+#~ (from created_at in user_details) is cut into start_time/end_time slices,
+#~ each its own chain, and the slices are fetched at the same time, paced
+#~ by the rate limit governors like any other requests. Each slice is
+#~ checkpointed on its own, and the slices done are kept in the user's
+#~ harvest_state "backfill" record, which is only complete once every one
+#~ has finished. Until then since_id() points back at the earliest slice
+#~ still to do, so no other harvest of the user can skip over the gaps.
+
+#~ slices shorter than this aren't worth their own chain
+MIN_SLICE_DAYS = 30
+#~ the API wants end_time a little in the past
+END_TIME_MARGIN = datetime.timedelta(seconds=30)
+#~ slice checkpoints are kept under "search/all/slice/<n>:<user id>"
+SLICE_ENDPOINT = "search/all/slice"
+
+
+def lifetime_slices(created_at, slices, now=None):
+
+    """
+    Cut an account's lifetime into equal slices of time.
+
+    ARGS:   when the account was made (ISO string from user_details),
+            how many slices to aim for.
+
+    RETS:   list of {"start", "end"} utc datetimes, oldest first; fewer
+            slices than asked for if the account is young.
+    """
+
+    now = now or datetime.datetime.utcnow()
+    end = (now - END_TIME_MARGIN).replace(microsecond=0)
+    start = datetime.datetime.strptime(created_at[:19], "%Y-%m-%dT%H:%M:%S")
+    lifetime = end - start
+    slices = max(min(slices, int(lifetime.days / MIN_SLICE_DAYS)), 1)
+    step = datetime.timedelta(seconds=int(lifetime.total_seconds() / slices)) #~ whole seconds, as the API takes
+
+    return [{"start": start + step * number,
+             "end": end if number == slices - 1 else start + step * (number + 1)}
+            for number in range(slices)]
+
+
+def slice_endpoint(number):
+
+    """The endpoint name a slice's checkpoint is kept under."""
+
+    return f"{SLICE_ENDPOINT}/{number}"
+
+
+def harvest_slice(twitter_id, number, time_slice, working_collection):
+
+    """
+    Walk one slice's chain into MongoDB, carrying on from its checkpoint
+    if it was interrupted before.
+
+    CALLS:  twitter_ops.timeline_chain()
+            twitter_ops.walk_chain()
+            mongo_ops.insert_pages()
+            harvest_state.record_page()
+            harvest_state.save_cursor() / clear_cursor()
+
+    ARGS:   the ID number for the user,
+            the slice number and its {"start", "end"},
+            the collection of tweets.
+
+    RETS:   True if the slice was walked to its end.
+    """
+
+    endpoint = slice_endpoint(number)
+    params = harvest_state.load_cursor(twitter_id, endpoint)
+    resuming = params is not None
+    if not resuming:
+        params = {
+            "query": f"(from:{twitter_id})",
+            **twitter_ops.timeline_fields(),
+            "max_results": 500,
+            "start_time": time_slice["start"].strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "end_time": time_slice["end"].strftime("%Y-%m-%dT%H:%M:%SZ")}
+
+    outcome = {}
+    label = f"{twitter_id} (slice {number})"
+    for api_response, cursor in twitter_ops.walk_chain(twitter_ops.timeline_chain(twitter_id, params, label), outcome):
+        counts = mongo_ops.insert_pages([api_response], working_collection)
+        harvest_state.record_page(twitter_id, api_response["data"], counts["inserted"])
+        if cursor is None:
+            harvest_state.clear_cursor(twitter_id, endpoint)
+        else:
+            harvest_state.save_cursor(twitter_id, endpoint, cursor)
+
+    if resuming and outcome["pages"] == 0: #~ the checkpoint is no use any more
+        harvest_state.clear_cursor(twitter_id, endpoint)
+
+    return outcome["complete"]
+
+
+async def async_backfill_user(twitter_id, created_at, working_collection, slices, concurrency):
+
+    """
+    Fetch a user's unfinished slices, up to "concurrency" at once (in
+    worker threads, since requests and pymongo both block).
+
+    CALLS:  harvest_state.clear_cursors()
+            harvest_state.start_backfill()
+            harvest_slice()
+            harvest_state.finish_slice()
+
+    RETS:   True if every slice is now done.
+    """
+
+    if not harvest_state.backfill_pending(harvest_state.get_state(twitter_id)):
+        #~ a new backfill: checkpoints left by an older, replaced one are for other slices
+        harvest_state.clear_cursors(twitter_id, SLICE_ENDPOINT)
+    backfill = harvest_state.start_backfill(twitter_id, lifetime_slices(created_at, slices))
+    to_do = [number for number in range(len(backfill["slices"])) if number not in backfill["done"]]
+    print(f"Backfilling user {twitter_id}: {len(to_do)} of {len(backfill['slices'])} time slices to fetch...")
+    semaphore = asyncio.Semaphore(concurrency)
+    complete = [len(to_do) == 0] #~ all done before, but stopped before it was marked complete
+
+    async def fetch_slice(number):
+        async with semaphore:
+            try:
+                done = await asyncio.to_thread(harvest_slice, twitter_id, number,
+                                               backfill["slices"][number], working_collection)
+            except Exception as e:
+                print(f"Something went wrong on {twitter_id} slice {number}: {e}")
+                return
+            if done and harvest_state.finish_slice(twitter_id, number):
+                complete[0] = True
+
+    await asyncio.gather(*(fetch_slice(number) for number in to_do))
+
+    return complete[0]
+
+
+def backfill_user(twitter_id, created_at, working_collection, slices=8, concurrency=4):
+
+    """
+    Backfill one user's whole history in time slices.
+
+    CALLS:  async_backfill_user()
+            twitter_ops.finish_user_timeline()
+
+    RETS:   True if the backfill is complete.
+    """
+
+    complete = asyncio.run(async_backfill_user(twitter_id, created_at, working_collection,
+                                               slices, concurrency))
+    if complete:
+        print(f"Backfill of user {twitter_id} complete.")
+    else:
+        print(f"Backfill of user {twitter_id} unfinished, the rest will be fetched next time.")
+    twitter_ops.finish_user_timeline(twitter_id, complete)
+
+    return complete
+
+
+def backfill_harvest(user_ids, working_collection=None, slices=8, concurrency=4):
+
+    """
+    Backfill the new users (and any whose backfill is unfinished), and hand
+    back the rest to be harvested as usual.
+
+    A user with an interrupted serial chain from before is left to finish
+    it that way, and a user backfilled before is never backfilled again,
+    even if it found nothing (a plain harvest of them is one request).
+
+    CALLS:  twitter_ops.load_user_details()
+            backfill_user()
+
+    ARGS:   the user ids to harvest,
+            the collection of tweets,
+            how many slices to cut each lifetime into,
+            how many slices to fetch at once.
+
+    RETS:   the user ids still to harvest, in the order given.
+    """
+
+    if working_collection is None:
+        working_collection = mongodb_config.tweets_collection
+
+    to_backfill = []
+    for user in twitter_ops.load_user_details(user_ids):
+        twitter_id = user["id"]
+        if not user.get("created_at"):
+            continue
+        state = harvest_state.get_state(twitter_id)
+        if harvest_state.backfill_pending(state):
+            to_backfill.append(user)
+        elif state is not None and "backfill" in state:
+            continue #~ backfilled already, even if it found nothing
+        elif (harvest_state.since_id(twitter_id, working_collection) <= 1
+              and harvest_state.load_cursor(twitter_id, twitter_ops.TIMELINE_ENDPOINT) is None):
+            to_backfill.append(user)
+
+    print(f"\nBackfilling {len(to_backfill)} new users in up to {slices} time slices each...")
+    for user in to_backfill:
+        backfill_user(user["id"], user["created_at"], working_collection, slices, concurrency)
+
+    backfilled = {user["id"] for user in to_backfill}
+
+    return [twitter_id for twitter_id in user_ids if twitter_id not in backfilled]
@@ -0,0 +1,362 @@
+#~ Standard library imports
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+import subprocess
+
+#~ 3rd party imports
+from bson import ObjectId
+
+#~ Local application imports
+from modules import mongodb_config
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ load_manifest
+#~ save_manifest
+#~ choose_kind
+#~ newest_id
+#~ overlap_from
+#~ dump_archive
+#~ run_backup
+#~ rotate_backups
+#~ backup
+#~ start_backup
+
+
+#~ Compressed backups of every collection, taken in the background so the
+#~ harvest doesn't wait on them. Each backup is a folder in output/backups/:
+#~   <time>-full/twitter_db.archive.gz      the whole database, one gzipped archive
+#~   <time>-incremental/<collection>.archive.gz
+#~                                          only the documents added since the last backup
+#~ mongodump streams each archive, which is written to a ".partial" file
+#~ (checksummed as it goes) and renamed once it is whole. Documents added
+#~ since the last backup are found by _id: an ObjectId _id goes up as
+#~ documents are inserted, so each backup notes the highest _id it took
+#~ of each collection (its "watermark"), and the next incremental takes
+#~ those above it. An _id is made before its document is written, by
+#~ whichever worker or client made it, so a document can land after a
+#~ backup with an _id below that backup's watermark: each incremental
+#~ reaches back OVERLAP_SECONDS before the watermark to catch these, and
+#~ mongorestore skips the documents it already has (reporting them as
+#~ duplicate keys). Anything later than that by more than the overlap is
+#~ only in the next full backup. Collections with other _ids (harvest_state,
+#~ harvest_jobs...) are small, and are taken whole every time. Changes to
+#~ documents already backed up (eg NLP scores) are only in the next full
+#~ backup, which is why epicosm_nlp.py always takes one.
+#~
+#~ output/backups/manifest.json keeps track:
+#~   {"watermarks": {"<collection>": "<_id hex>", ...},
+#~    "backups": [{"name": "<folder>", "kind": "full" | "incremental",
+#~                 "started": "<iso time>", "finished": "<iso time>",
+#~                 "files": {"<archive>": {"bytes": <int>, "sha256": "<hex>"}},
+#~                 "collections": {"<collection>": {"after": "<_id hex>" or null,
+#~                                                   "upto": "<_id hex>" or null,
+#~                                                   "documents": <int>}}}, ...]}
+#~ To restore, mongorestore the newest full backup, then each incremental
+#~ after it in turn:
+#~   mongorestore --gzip --archive=<archive>
+
+BACKUP_FOLDER = "backups"
+MANIFEST = "manifest.json"
+#~ "auto" takes a full backup if the last one is older than this, or has this many incrementals after it
+FULL_EVERY_DAYS = 7
+MAX_INCREMENTALS = 20
+#~ how far before the last watermark each incremental reaches back, for documents written late
+OVERLAP_SECONDS = 10 * 60
+#~ how many full backups (each with its incrementals) to keep
+KEEP_FULL = 3
+#~ a backup folder not in the manifest after this many seconds was left by a failed backup
+ABANDONED_AFTER = 24 * 60 * 60
+#~ streaming chunk size
+CHUNK_BYTES = 1024 * 1024
+
+#~ the backup running in the background, if there is one
+_running = None
+
+
+def load_manifest(folder):
+
+    """The backup manifest in a backup folder (an empty one if there isn't one yet)."""
+
+    path = os.path.join(folder, MANIFEST)
+    if not os.path.isfile(path):
+        return {"watermarks": {}, "backups": []}
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def save_manifest(folder, manifest):
+
+    """Write the manifest, whole or not at all."""
+
+    path = os.path.join(folder, MANIFEST)
+    with open(path + ".partial", "w") as outfile:
+        json.dump(manifest, outfile, indent=1)
+    os.replace(path + ".partial", path)
+
+
+def choose_kind(manifest, now=None):
+
+    """
+    The kind of backup "auto" means now: full if there isn't a recent
+    full backup, or it already has MAX_INCREMENTALS after it; otherwise
+    incremental.
+    """
+
+    now = now or datetime.datetime.utcnow()
+    fulls = [position for position, entry in enumerate(manifest["backups"]) if entry["kind"] == "full"]
+    if len(fulls) == 0:
+        return "full"
+    last_full = manifest["backups"][fulls[-1]]
+    if now - datetime.datetime.fromisoformat(last_full["started"]) > datetime.timedelta(days=FULL_EVERY_DAYS):
+        return "full"
+    if len(manifest["backups"]) - fulls[-1] - 1 >= MAX_INCREMENTALS:
+        return "full"
+
+    return "incremental"
+
+
+def newest_id(working_collection):
+
+    """
+    The highest _id in a collection, if its _ids are ObjectIds.
+
+    RETS:   the ObjectId, None if the collection is empty, or False if
+            its _ids aren't ObjectIds (so it can't be backed up incrementally).
+    """
+
+    document = working_collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    if document is None:
+        return None
+    if not isinstance(document["_id"], ObjectId):
+        return False
+
+    return document["_id"]
+
+
+def overlap_from(watermark, overlap_seconds=OVERLAP_SECONDS):
+
+    """
+    Where an incremental backup starts: OVERLAP_SECONDS before the last
+    watermark, so documents written late with lower _ids aren't missed.
+
+    ARGS:   the last watermark, as _id hex.
+
+    RETS:   the ObjectId to take documents above.
+    """
+
+    watermark = ObjectId(watermark)
+
+    return ObjectId.from_datetime(watermark.generation_time - datetime.timedelta(seconds=overlap_seconds))
+
+
+def dump_archive(mongodump_executable_path, path, epicosm_log_filename, collection_name=None, query=None):
+
+    """
+    Stream a gzipped mongodump archive into a file, checksumming it as
+    it comes. It is written as path.partial and renamed once mongodump
+    has finished without error.
+
+    CALLS:  mongodump --archive --gzip
+
+    ARGS:   the mongodump executable,
+            the archive to write,
+            the Epicosm log file (for mongodump's messages),
+            optionally, one collection to dump, and a query to dump only
+            some of its documents (as extended JSON).
+
+    RETS:   dict of "bytes" and "sha256".
+    """
+
+    command = [mongodump_executable_path, f"--uri={mongodb_config.connection_uri()}",
+               f"--db={mongodb_config.db.name}", "--archive", "--gzip"]
+    if collection_name is not None:
+        command.append(f"--collection={collection_name}")
+    if query is not None:
+        command.append(f"--query={json.dumps(query)}")
+
+    checksum = hashlib.sha256()
+    written = 0
+    with open(epicosm_log_filename, "a+") as log, open(path + ".partial", "wb") as outfile:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=log)
+        for chunk in iter(lambda: process.stdout.read(CHUNK_BYTES), b""):
+            outfile.write(chunk)
+            checksum.update(chunk)
+            written += len(chunk)
+        process.stdout.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"mongodump exited with code {process.returncode} writing {path}; "
+                               f"see {epicosm_log_filename}")
+    os.replace(path + ".partial", path)
+
+    return {"bytes": written, "sha256": checksum.hexdigest()}
+
+
+def run_backup(mongodump_executable_path, database_dump_path, epicosm_log_filename, kind="auto"):
+
+    """
+    Take one backup of every collection, and note it in the manifest.
+
+    CALLS:  choose_kind()
+            newest_id()
+            dump_archive()
+
+    ARGS:   the mongodump executable,
+            the output folder (backups go in backups/ in it),
+            the Epicosm log file,
+            "full", "incremental" or "auto" (see choose_kind).
+
+    RETS:   the manifest entry for the backup.
+    """
+
+    folder = os.path.join(database_dump_path, BACKUP_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    manifest = load_manifest(folder)
+    if kind == "auto":
+        kind = choose_kind(manifest)
+    if kind == "incremental" and not any(entry["kind"] == "full" for entry in manifest["backups"]):
+        kind = "full" #~ nothing to add to yet
+
+    started = datetime.datetime.utcnow()
+    name = f"{started.strftime('%Y-%m-%d_%H-%M-%S')}-{kind}"
+    os.makedirs(os.path.join(folder, name), exist_ok=True)
+    db = mongodb_config.db
+    entry = {"name": name, "kind": kind, "started": started.isoformat(timespec="seconds"),
+             "files": {}, "collections": {}}
+    #~ the watermarks are taken before dumping: anything added while it runs goes in the next backup too
+    upto = {collection_name: newest_id(db[collection_name])
+            for collection_name in sorted(db.list_collection_names()) if not collection_name.startswith("system.")}
+    start = time.monotonic()
+
+    if kind == "full":
+        archive = f"{db.name}.archive.gz"
+        entry["files"][archive] = dump_archive(mongodump_executable_path, os.path.join(folder, name, archive),
+                                               epicosm_log_filename)
+        for collection_name, newest in upto.items():
+            entry["collections"][collection_name] = {
+                "after": None, "upto": str(newest) if newest else None,
+                "documents": db[collection_name].estimated_document_count()}
+    else:
+        for collection_name, newest in upto.items():
+            after = manifest["watermarks"].get(collection_name)
+            if newest is None:
+                entry["collections"][collection_name] = {"after": after, "upto": after, "documents": 0}
+                continue
+            if newest is False or after is None:
+                lower = None #~ taken whole
+                query = None
+                documents = db[collection_name].count_documents({})
+            else:
+                lower = overlap_from(after)
+                query = {"_id": {"$gt": {"$oid": str(lower)}, "$lte": {"$oid": str(newest)}}}
+                documents = db[collection_name].count_documents({"_id": {"$gt": lower, "$lte": newest}})
+                if documents == 0:
+                    entry["collections"][collection_name] = {"after": str(lower), "upto": after, "documents": 0}
+                    continue
+            archive = f"{collection_name}.archive.gz"
+            entry["files"][archive] = dump_archive(mongodump_executable_path, os.path.join(folder, name, archive),
+                                                   epicosm_log_filename, collection_name, query)
+            entry["collections"][collection_name] = {
+                "after": str(lower) if lower else None, "upto": str(newest) if newest else None,
+                "documents": documents}
+
+    entry["finished"] = datetime.datetime.utcnow().isoformat(timespec="seconds")
+    manifest = load_manifest(folder)
+    manifest["backups"].append(entry)
+    for collection_name, newest in upto.items():
+        if newest:
+            manifest["watermarks"][collection_name] = str(newest)
+    save_manifest(folder, manifest)
+
+    size = sum(archive["bytes"] for archive in entry["files"].values())
+    print(f"Backup {name} finished: {len(entry['files'])} archives, {size / 1024 ** 2:.1f} MB, "
+          f"in {time.monotonic() - start:.0f} seconds.")
+
+    return entry
+
+
+def rotate_backups(database_dump_path, keep_full=KEEP_FULL):
+
+    """
+    Remove the backups no longer needed: everything before the oldest of
+    the last keep_full full backups (its incrementals with it), and any
+    folder the manifest doesn't know about, left half written by a backup
+    that failed (once it is ABANDONED_AFTER old).
+
+    RETS:   list of the backups removed.
+    """
+
+    if keep_full < 1:
+        raise ValueError(f"At least one full backup must be kept, not {keep_full}")
+    folder = os.path.join(database_dump_path, BACKUP_FOLDER)
+    manifest = load_manifest(folder)
+    fulls = [position for position, entry in enumerate(manifest["backups"]) if entry["kind"] == "full"]
+    removed = []
+    if len(fulls) > keep_full:
+        cut = fulls[-keep_full]
+        removed = [entry["name"] for entry in manifest["backups"][:cut]]
+        manifest["backups"] = manifest["backups"][cut:]
+        save_manifest(folder, manifest)
+    known = {entry["name"] for entry in manifest["backups"]}
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if not os.path.isdir(path) or name in known:
+            continue
+        if name not in removed and time.time() - os.path.getmtime(path) < ABANDONED_AFTER:
+            continue #~ may be being written now, by this run or another
+        for file_name in os.listdir(path):
+            os.remove(os.path.join(path, file_name))
+        os.rmdir(path)
+        if name not in removed:
+            removed.append(name)
+    if len(removed) > 0:
+        print(f"Rotating backups: removed {', '.join(removed)}.")
+
+    return removed
+
+
+def backup(mongodump_executable_path, database_dump_path, epicosm_log_filename, kind="auto", keep_full=KEEP_FULL):
+
+    """
+    Take a backup and rotate the old ones. Any failure is reported rather
+    than raised, so a failed backup doesn't stop a repeating harvest.
+
+    CALLS:  run_backup()
+            rotate_backups()
+    """
+
+    try:
+        run_backup(mongodump_executable_path, database_dump_path, epicosm_log_filename, kind)
+        rotate_backups(database_dump_path, keep_full)
+    except Exception as e:
+        print(f"Backup failed: {e}")
+
+
+def start_backup(mongodump_executable_path, database_dump_path, epicosm_log_filename,
+                 kind="auto", keep_full=KEEP_FULL):
+
+    """
+    Take a backup in a background thread, so the run can get on. The
+    thread isn't a daemon: the program waits for it to finish before it
+    exits, so a backup is never left half written. If the last backup is
+    still going, no new one is started.
+
+    RETS:   the thread.
+    """
+
+    global _running
+    if _running is not None and _running.is_alive():
+        print(f"The last backup is still running, so not starting another.")
+        return _running
+
+    print(f"\nBacking up the database ({kind}) in the background...")
+    _running = threading.Thread(target=backup, name="backup", daemon=False,
+                                args=(mongodump_executable_path, database_dump_path, epicosm_log_filename),
+                                kwargs={"kind": kind, "keep_full": keep_full})
+    _running.start()
+
+    return _running
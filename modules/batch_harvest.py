@@ -0,0 +1,226 @@
+#~ Standard library imports
+import datetime
+
+#~ Local application imports
+from modules import (
+    twitter_ops,
+    mongo_ops,
+    harvest_state,
+    harvest_plan,
+    adaptive_schedule,
+    mongodb_config)
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ expected_new_tweets
+#~ low_volume_users
+#~ batch_groups
+#~ harvest_batch
+#~ batch_harvest
+
+
+#~ A quiet user costs a whole search/all request to return a handful of
+#~ tweets. Here many quiet users share one request, "(from:a OR from:b ...)",
+#~ and the tweets that come back are sorted out by author_id. The query
+#~ asks from the oldest since_id in the batch, so anything a user already
+#~ has is dropped before it is written. Each user's tweet count is added
+#~ to page by page, as the tweets go in, but their since_id only moves on
+#~ once the whole batch chain has come back, so an interrupted batch is
+#~ simply asked for again next time (and what it already wrote is skipped
+#~ as held, without being counted twice).
+
+#~ users expected to have fewer new tweets than this are batched
+LOW_VOLUME_TWEETS = 20
+#~ aim for each batch to fit on one page
+BATCH_TWEETS = 500
+
+
+def expected_new_tweets(twitter_id, working_collection, state=None, now=None):
+
+    """
+    Guess how many new tweets a user has, from their posting rate
+    and how long since they were last harvested in full.
+
+    CALLS:  adaptive_schedule.posting_rate()
+
+    RETS:   the expected number of tweets, or None if there's no telling
+            (never harvested).
+    """
+
+    now = now or datetime.datetime.utcnow()
+    if state is None:
+        state = harvest_state.get_state(twitter_id)
+    if state is None or not state.get("newest_id"):
+        return None
+    checked = state.get("checked") or state.get("last_run")
+    if checked is None:
+        return None
+    rate = state.get("posting_rate")
+    if rate is None:
+        rate = adaptive_schedule.posting_rate(twitter_id, working_collection, state, now)
+
+    return rate * (now - checked).total_seconds() / 86400
+
+
+def low_volume_users(user_ids, working_collection, counts=None):
+
+    """
+    Pick out the users worth batching: harvested before, nothing
+    half-finished, and few new tweets expected.
+
+    ARGS:   the user ids,
+            the collection of tweets,
+            optionally, each user's count of new tweets (from harvest_plan),
+            used instead of a guess where there is one.
+
+    RETS:   dict of the low volume user ids and their expected new tweets.
+    """
+
+    counts = counts or {}
+    expected = {}
+    for twitter_id in user_ids:
+        state = harvest_state.get_state(twitter_id)
+        if harvest_state.load_cursor(twitter_id, twitter_ops.TIMELINE_ENDPOINT) is not None:
+            continue #~ finish that chain on its own
+        if harvest_state.backfill_pending(state):
+            continue #~ there are gaps further back than since_id
+        if counts.get(twitter_id) is not None and state is not None and state.get("newest_id"):
+            new_tweets = counts[twitter_id]
+        else:
+            new_tweets = expected_new_tweets(twitter_id, working_collection, state)
+        if new_tweets is not None and new_tweets < LOW_VOLUME_TWEETS:
+            expected[twitter_id] = new_tweets
+
+    return expected
+
+
+def batch_groups(expected, since_ids):
+
+    """
+    Pack low volume users into batches that fit the query length limit
+    and, going by the expected tweets, one page. Users are packed in
+    since_id order, so each batch's oldest since_id isn't far off the
+    others' and little is fetched only to be dropped.
+
+    RETS:   list of lists of user ids.
+    """
+
+    groups = []
+    group = []
+    group_tweets = 0
+    for twitter_id in sorted(expected, key=lambda twitter_id: since_ids[twitter_id]):
+        too_long = len(harvest_plan.or_query(group + [twitter_id])) > harvest_plan.MAX_QUERY_LENGTH
+        too_many = group_tweets + expected[twitter_id] > BATCH_TWEETS
+        if group and (too_long or too_many):
+            groups.append(group)
+            group, group_tweets = [], 0
+        group.append(twitter_id)
+        group_tweets += expected[twitter_id]
+    if group:
+        groups.append(group)
+
+    return groups
+
+
+def harvest_batch(batch, since_ids, working_collection):
+
+    """
+    Harvest a batch of users with one OR query.
+
+    CALLS:  twitter_ops.timeline_chain()
+            twitter_ops.walk_chain()
+            mongo_ops.insert_pages()
+            harvest_state.record_loaded()
+            harvest_state.record_page()
+            harvest_state.mark_run()
+
+    ARGS:   the user ids in the batch,
+            dict of each user's since_id,
+            the collection of tweets.
+
+    RETS:   True if the whole chain came back (and state was moved on),
+            False if it stopped early.
+    """
+
+    label = f"batch of {len(batch)} users"
+    timeline_params = {
+        "query": harvest_plan.or_query(batch),
+        **twitter_ops.timeline_fields(),
+        "max_results": 500,
+        "since_id": min(since_ids[twitter_id] for twitter_id in batch)}
+
+    print(f"Requesting timelines for a {label}...")
+    authors = set(batch)
+    harvested = {twitter_id: [] for twitter_id in batch}
+    new_tweets = 0
+    outcome = {}
+    for api_response, cursor in twitter_ops.walk_chain(
+            twitter_ops.timeline_chain(None, timeline_params, label), outcome):
+        #~ keep only each author's tweets newer than their own since_id
+        wanted = [tweet for tweet in api_response["data"]
+                  if tweet.get("author_id") in authors
+                  and int(tweet["id"]) > since_ids[tweet["author_id"]]]
+        dropped = len(api_response["data"]) - len(wanted)
+        if dropped:
+            print(f"Dropped {dropped} tweets already held.")
+        if len(wanted) == 0:
+            continue
+        counts = mongo_ops.insert_pages([{"data": wanted, "includes": api_response.get("includes", {})}],
+                                        working_collection)
+        #~ count each author's new tweets now, since a retry would find them already held
+        page_authors = {}
+        for position, tweet in enumerate(wanted):
+            author = page_authors.setdefault(tweet["author_id"], {"records": [], "inserted": 0})
+            author["records"].append({"id": tweet["id"]})
+            if position in counts["upserted"]:
+                author["inserted"] += 1
+        for twitter_id, author in page_authors.items():
+            harvest_state.record_loaded(twitter_id, author["records"], author["inserted"])
+            harvested[twitter_id] += author["records"]
+            new_tweets += author["inserted"]
+
+    if not outcome["complete"]:
+        print(f"The {label} stopped part way, it will be asked for again next time.")
+        return False
+
+    for twitter_id, records in harvested.items():
+        harvest_state.record_page(twitter_id, records, 0) #~ already counted, page by page
+        harvest_state.mark_run(twitter_id)
+    print(f"{new_tweets} new tweets from {sum(1 for records in harvested.values() if records)} "
+          f"of the {label}.")
+
+    return True
+
+
+def batch_harvest(user_ids, working_collection=None, counts=None):
+
+    """
+    Harvest the quiet users in batches, and hand back the rest
+    to be harvested one by one as usual.
+
+    CALLS:  low_volume_users()
+            batch_groups()
+            harvest_batch()
+
+    ARGS:   the user ids to harvest,
+            the collection of tweets,
+            optionally, counts of new tweets from harvest_plan.
+
+    RETS:   the user ids still to harvest, in the order given.
+    """
+
+    if working_collection is None:
+        working_collection = mongodb_config.tweets_collection
+
+    expected = low_volume_users(user_ids, working_collection, counts)
+    since_ids = {twitter_id: harvest_state.since_id(twitter_id, working_collection)
+                 for twitter_id in expected}
+    groups = batch_groups(expected, since_ids)
+    print(f"\nHarvesting {len(expected)} low volume users in {len(groups)} batches...")
+
+    done = set()
+    for batch in groups:
+        if harvest_batch(batch, since_ids, working_collection):
+            done.update(batch)
+
+    return [twitter_id for twitter_id in user_ids if twitter_id not in done]
@@ -6,13 +6,10 @@ import logging
 import subprocess
 
 # local imports
-from modules import env_config, mongo_ops
+from modules import env_config, mongo_ops, mongodb_config
 
 
 env = env_config.EnvironmentConfig()
-client = pymongo.MongoClient('localhost', 27017)
-db = client.twitter_db
-collection = db.tweets
 
 
 #~ Catch ctrl-c signals (and kill -15 signals)
@@ -89,7 +86,7 @@ def status_up(status_file):
     Does a quick count of the current database,
     and rewrite the STATUS file to say that process is in progress."""
 
-    tweet_count = collection.count_documents({})
+    tweet_count = mongodb_config.tweets_collection.count_documents({})
     with open(status_file, 'w+') as status:
         status.write(f"Epicosm is currently running.\nThis process started at {datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}\n")
         if tweet_count > 0:
@@ -103,7 +100,7 @@ def status_down(status_file, run_folder):
     Does a quick count of the current database,
     and rewrite the STATUS file to say that process is in progress."""
 
-    tweet_count = collection.count_documents({})
+    tweet_count = mongodb_config.tweets_collection.count_documents({})
     with open(status_file, 'w+') as status:
         next_harvest = (datetime.datetime.now() + datetime.timedelta(hours = 72)).strftime('%Y-%m-%d_' + "06:00:00")
         status.write(f"Epicosm is currently idle.\nThe most recent harvest was at {datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}\nThe database currently contains {tweet_count} tweets.\n")
@@ -10,101 +10,67 @@ import subprocess
 
 #~ 3rd party imports
 import pymongo
-import requests
-from requests.exceptions import *
-from retry import retry
 from alive_progress import alive_bar
 
 #~ Local application imports
-try:
-    import bearer_token
-except ModuleNotFoundError as e:
-    print("Your bearer_token.py doesn't seem to be here.")
-    sys.exit(1)
-
-bearer_token = bearer_token.token
+from modules import twitter_api, mongo_ops, harvest_state, json_ops, user_failures, schema_v2
 
 
 #~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
-#~ bearer_oauth
-#~ connect_to_endpoint
 #~ request_follows_list
 #~ request_follows_recents_response
+#~ harvest_user_follows
 #~ follows_list_harvest
 #~ pseudofeed_harvest
 
-
-def bearer_oauth(r):
-
-    """
-    Set up Oauth object.
-    """
-
-    r.headers["Authorization"] = f"Bearer {bearer_token}"
-    r.headers["User-Agent"] = "v2FullArchiveSearchPython"
-
-    return r
-
-
-@retry(RequestException, delay=1, backoff=5, max_delay=900)
-def connect_to_endpoint(url, params):
-
-    """
-    Make connection to twitter endpoint
-
-    CALLS:  requests.request()
-
-    ARGS:   url: the full URL built by create_url, completed with
-            params (usually the fields you want). If you are doing
-            a user lookup, params aren't needed and can be left empty.
-
-    RETS:   response from the endpoint as json
-    """
-
-    response = requests.request("GET", url, auth=bearer_oauth, params=params)
-    if response.status_code == 429:
-        print(f"Rate limited, waiting for cooldown...")
-        raise RequestException
-    if response.status_code == 401:
-        print("Bearer token was not verified. Please check and retry.")
-        sys.exit(129)
-    if response.status_code == 503:
-        print("Twitter's servers seem unavailable, giving them a moment...")
-        raise RequestException
-    elif response.status_code != 200:
-        print("Didn't get a 200 response:", response.status_code)
-    return response.json()
+#~ the endpoint family follows checkpoints are kept under
+FOLLOWS_ENDPOINT = "users/:id/following"
+#~ failures after which a saved follows cursor is no use: the account is gone,
+#~ or the request itself (its pagination token) was refused
+CURSOR_FINAL = {"not_found", "suspended", "refused"}
 
 
-def request_follows_list(twitter_id, url, params):
+def request_follows_list(twitter_id, url, params, outcome=None):
 
     """
     This is a modification of the request_timeline_response in twitter ops.
     The params are a little different, and making a generalised version was getting messy
     and error prone.
 
-    CALLS:  connect_to_endpoint()
+    CALLS:  twitter_api.connect_to_endpoint()
+            user_failures.record_failure()
 
     ARGS:   the ID number for the user.
             the built url for API endpoint.
+            optionally, a dict to put why a 1 came back into, under
+            "stopped": "end" (nothing more to get), a user_failures
+            reason, "refused" (any other 4xx), or "error" (the servers
+            or the connection failing, which may work next time).
 
     RETS:   the follows list response as a JSON,
             OR 1 if there was an issue. Return value 1 is
             used as a trigger for the continue in the loop.
     """
 
+    if outcome is None:
+        outcome = {}
+    outcome["stopped"] = "end"
+
     try:
 
-        follows_response = connect_to_endpoint(url, params)
+        follows_response = twitter_api.connect_to_endpoint(url, params)
+
+        if "errors" in follows_response and "data" not in follows_response:
+            error = follows_response["errors"][0]
+            print(f"Problem on {twitter_id} :", error.get("detail", error.get("title")))
+            outcome["stopped"] = user_failures.classify_error(error)
+            user_failures.record_failure(twitter_id, outcome["stopped"], error.get("detail", ""))
+            return 1
 
         if follows_response["meta"]["result_count"] == 0:
             print(f"No recent tweets from follow {twitter_id}.")
             return 1 #~ all "return 1"s are triggers to continue the harvest loop
 
-        if "errors" in follows_response:
-            print(f"Problem on {twitter_id} :", follows_response["title"])
-            return 1
-
         #~ each subfield in "data" is a tweet / follow.
         if "data" not in follows_response:
             print(f"No data in response: {follows_response}")
@@ -112,12 +78,25 @@ def request_follows_list(twitter_id, url, params):
 
         return follows_response
 
-    except RequestException:
-        print(f"Rate limited even after cooldown on {twitter_id}. Moving on...")
+    except twitter_api.AuthenticationError as e:
+        print(e)
+        sys.exit(129)
+
+    except twitter_api.ClientError as e:
+        print(f"Problem on {twitter_id}: {e}. Moving on...")
+        reason, detail = user_failures.classify_exception(e)
+        outcome["stopped"] = reason if reason != "errors" else "refused"
+        user_failures.record_failure(twitter_id, reason, detail)
+        return 1
+
+    except twitter_api.TwitterAPIError as e:
+        print(f"Problem on {twitter_id}: {e}. Moving on...")
+        outcome["stopped"] = "error"
         return 1
 
     except Exception as e:
         print(f"Something went wrong on {twitter_id}: {e}")
+        outcome["stopped"] = "error"
         return 1
 
 
@@ -127,7 +106,8 @@ def request_follows_recents_response(twitter_id, params):
     This builds and sends the API request to twitter - used to for getting
     the recent tweets from those that are being followed by a user.
 
-    CALLS:  connect_to_endpoint()
+    CALLS:  twitter_api.connect_to_endpoint()
+            user_failures.record_failure()
 
     ARGS:   the ID number for the user.
             the built url for API endpoint.
@@ -137,20 +117,23 @@ def request_follows_recents_response(twitter_id, params):
             used as a trigger for the continue in the loop.
     """
 
-    url = "https://api.twitter.com/2/tweets/search/recent"
+    url = twitter_api.endpoint_url("tweets/search/recent")
 
     try:
 
-        follows_response = connect_to_endpoint(url, params)
+        follows_response = twitter_api.connect_to_endpoint(url, params)
+
+        if "errors" in follows_response and "data" not in follows_response:
+            error = follows_response["errors"][0]
+            print(f"Problem on {twitter_id} :", error.get("detail", error.get("title")))
+            user_failures.record_failure(twitter_id, user_failures.classify_error(error),
+                                         error.get("detail", ""))
+            return 1
 
         if follows_response["meta"]["result_count"] == 0:
             print(f"No recent tweets for {twitter_id}.")
             return 1 #~ all "return 1"s are triggers to continue the harvest loop
 
-        if "errors" in follows_response:
-            print(f"Problem on {twitter_id} :", follows_response["title"])
-            return 1
-
         #~ each subfield in "data" is a tweet / follow.
         if "data" not in follows_response:
             print(f"No data in response: {follows_response}")
@@ -158,8 +141,17 @@ def request_follows_recents_response(twitter_id, params):
 
         return follows_response
 
-    except RequestException:
-        print(f"Rate limited even after cooldown on {twitter_id}. Moving on...")
+    except twitter_api.AuthenticationError as e:
+        print(e)
+        sys.exit(129)
+
+    except twitter_api.ClientError as e:
+        print(f"Problem on {twitter_id}: {e}. Moving on...")
+        user_failures.record_failure(twitter_id, *user_failures.classify_exception(e))
+        return 1
+
+    except twitter_api.TwitterAPIError as e:
+        print(f"Problem on {twitter_id}: {e}. Moving on...")
         return 1
 
     except Exception as e:
@@ -167,14 +159,81 @@ def request_follows_recents_response(twitter_id, params):
         return 1
 
 
+def harvest_user_follows(twitter_id, working_collection, stop=None):
+
+    """
+    Walk one user's following list, 1000 at a time, and put it into MongoDB.
+    The pagination token is checkpointed after each page is committed, so an
+    interrupted list carries on from where it stopped on the next run. The
+    checkpoint is only cleared once the list is finished, or the account
+    or the token can't be had any more: a failing connection or a server
+    error keeps it for next time.
+
+    CALLS:  request_follows_list()
+            mongo_ops.insert_pages()
+            harvest_state.load_cursor()
+            harvest_state.save_cursor()
+            harvest_state.clear_cursor()
+            user_failures.clear_failure()
+
+    ARGS:   the ID number for the user,
+            the follows collection,
+            optionally, a threading.Event to stop at the next page
+            (the checkpoint is kept, to carry on from).
+
+    RETS:   "done" if the list was walked to its end (or the account or
+            token can't be had any more), "incomplete" if a request
+            failed part way and the checkpoint is kept, or "stopped".
+    """
+
+    url = twitter_api.endpoint_url(f"users/{twitter_id}/following")
+    params = harvest_state.load_cursor(twitter_id, FOLLOWS_ENDPOINT)
+    if params is not None:
+        print(f"Resuming interrupted follows list for {twitter_id}...")
+    else:
+        params = {"max_results": 1000}
+        print(f"Requesting {twitter_id} follows list...")
+
+    outcome = {}
+    while True:
+        api_response = request_follows_list(twitter_id, url, params, outcome)
+        if api_response == 1: #~ finished user, moving to next one
+            finished = outcome["stopped"] == "end" or outcome["stopped"] in CURSOR_FINAL
+            if finished:
+                harvest_state.clear_cursor(twitter_id, FOLLOWS_ENDPOINT) #~ the checkpoint is no use any more
+            break
+
+        #~ assign new field with who we are harvesting to each follow
+        for follow_item in api_response["data"]:
+            follow_item["follower_id"] = twitter_id
+        mongo_ops.insert_pages([api_response], working_collection, ("follower_id", "id"))
+
+        #~ we get a "next_token" if there are > 1000 follows.
+        if "next_token" not in api_response["meta"]:
+            harvest_state.clear_cursor(twitter_id, FOLLOWS_ENDPOINT)
+            user_failures.clear_failure(twitter_id)
+            finished = True
+            break
+        params = dict(params, pagination_token=api_response["meta"]["next_token"])
+        harvest_state.save_cursor(twitter_id, FOLLOWS_ENDPOINT, params)
+        if stop is not None and stop.is_set():
+            print(f"Stopping the follows harvest of {twitter_id} part way.")
+            return "stopped"
+
+    print(twitter_id, "follows count in DB:",
+          working_collection.count_documents({"follower_id": schema_v2.id_match(twitter_id)}))
+
+    return "done" if finished else "incomplete"
+
+
 def follows_list_harvest(db, working_collection):
 
     """
     Gathers the list of users being followed by each user.
     Adds these to the MongoDB collection "follows"
 
-    CALLS:  request_follows_list
-            insert_to_mongodb
+    CALLS:  user_failures.due_users()
+            harvest_user_follows
 
     ARGS:   the name of the follows collection, taken from env,
             DB name
@@ -185,59 +244,18 @@ def follows_list_harvest(db, working_collection):
             later (twitter API does not return this, only user details.)
     """
 
-    with open("user_details.json", "r") as infile:
-        #~ load in the json of users
-        user_details = json.load(infile)
-
-        total_users = (len(user_details))
-        print(f"\nHarvesting follows lists from {total_users} users...")
-
-        #~ we need a compound index here, since two people can follow the same user
-        #~ so, records where BOTH follower_id and id are the same are considered duplicates
-        working_collection.create_index([
-            ("follower_id", pymongo.ASCENDING),
-            ("id", pymongo.ASCENDING)], unique=True, dropDups=True)
-
-        #~ loop over each user ID
-        for user in user_details:
-
-            twitter_id = user["id"]
-            url = f"https://api.twitter.com/2/users/{twitter_id}/following?"
-            params = {"max_results": 1000}
-
-            print(f"Requesting {twitter_id} follows list...")
-            api_response = request_follows_list(twitter_id, url, params)
-
-            #~ request first 1000 follows
-            if api_response == 1: #~ finished user, moving to next one
-                try:
-                    print(twitter_id, "follows count in DB:", working_collection.count())
-                except Exception as e:
-                    print(f"That weird CentOS7 bug: {e}")
-                continue
-            else:
-                #~ assign new field with who we are harvesting to each follow
-                for follow_item in api_response["data"]:
-                    follow_item["follower_id"] = twitter_id
-                insert_to_mongodb(api_response, working_collection)
-
-            #~ we get a "next_token" if there are > 1000 follows.
-            try:
-                while "next_token" in api_response["meta"]:
-                    params["pagination_token"] = api_response["meta"]["next_token"]
-                    api_response = request_follows_list(twitter_id, url, params)
-                    if api_response == 1: #~ "1" means "next"
-                        continue
-                    else:
-                        #~ assign new field with who we are harvesting to each follow
-                        for follow_item in api_response["data"]:
-                            follow_item["follower_id"] = twitter_id
-                        insert_to_mongodb(api_response, working_collection)
-
-            except TypeError:
-                pass #~ api_response returned "1", so all done.
-
-            print(twitter_id, "follows count in DB:", working_collection.count_documents({"follower_id": twitter_id}))
+    #~ load in the json of users
+    user_details = json_ops.load_file("user_details.json")
+
+    total_users = (len(user_details))
+    print(f"\nHarvesting follows lists from {total_users} users...")
+
+    #~ records where BOTH follower_id and id are the same are duplicates (see index_registry)
+    mongo_ops.ensure_key_index(working_collection, ("follower_id", "id"))
+
+    #~ loop over each user ID, leaving out any that keep failing
+    for twitter_id in user_failures.due_users([user["id"] for user in user_details]):
+        harvest_user_follows(twitter_id, working_collection)
 
     users_in_collection = len(working_collection.distinct("follower_id"))
     try:
@@ -261,8 +279,8 @@ def pseudofeed_harvest(db, working_collection):
         this represents a "pseudofeed" of what they might be seeing in their true feed.
 
     CALLS:  request_timeline_response()
-            insert_to_mongodb()
-            json.load()
+            user_failures.due_keys()
+            json_ops.load_file()
             working_collection.count_documents()
             working_collection.find_one()
 
@@ -275,81 +293,64 @@ def pseudofeed_harvest(db, working_collection):
         print(f"(You will need to run the flag --get_follows before doing a follows harvest.)")
         return
 
-    with open("user_details.json", "r") as infile:
-        #~ load in the json of users
-        user_details = json.load(infile)
-
-        total_users = (len(user_details))
-        print(f"\nHarvesting follows' recents from {total_users} users...")
-
-        #~ loop over each user ID
-        for user in user_details:
-
-            pseudofeed = {}
-            pseudofeed_block = ""
-            twitter_id = user["id"]
-            pseudofeed["user"] = twitter_id
-            timestamp = datetime.now().isoformat(timespec='seconds')
-            pseudofeed["timestamp"] = timestamp
-
-            #~ check if we have this user in DB
-            if working_collection.count_documents({"follower_id": twitter_id}) == 0:
-                print(f"{twitter_id} follows are not in the database. Skipping.")
-                continue
-
-            #~ make a list of all FOLLOws from MongoDB, for this user
-            follow_ids = working_collection.find({"follower_id": twitter_id}).distinct("id")
-
-            for follow_id in follow_ids:
-
-                follow_params = {
-                    "query": f"(from:{follow_id})",
-                    "tweet.fields": "id,author_id,created_at,text",
-                    "max_results": 10} #~ the minimum!
-
-                #~ send the request for the first 500 tweets and insert to mongodb
-                print(f"Requesting recents for followed user {follow_id}...")
-                try:
-                    api_response = request_follows_recents_response(follow_id, follow_params)
-                    if api_response == 1: #~ this "1" is an end-trigger from request_timeline_response
-                        continue
-                    else: #~ extract the text field from the follow's tweets
-                        for tweet in api_response["data"]:
-                            pseudofeed_block = pseudofeed_block + tweet["text"]
-
-                except TypeError as e:
-                    print(e)
-
-            #~ make pseudofeed into a 3pair dict: id, timestamp,
-            #~ and text (big block of what follows have said in past 7 days)
-            word_count = len(pseudofeed_block.strip().split(" "))
-            print(f"Inserting pseudofeed tweet block of ~{word_count} words.")
-            pseudofeed["text"] = pseudofeed_block
+    #~ load in the json of users
+    user_details = json_ops.load_file("user_details.json")
 
-            try:
-                db.pseudofeed.insert_one(pseudofeed)
-            except Exception as e:
-                print(e)
+    total_users = (len(user_details))
+    print(f"\nHarvesting follows' recents from {total_users} users...")
 
+    #~ loop over each user ID
+    for user in user_details:
 
-def insert_to_mongodb(api_response, working_collection):
+        pseudofeed = {}
+        pseudofeed_block = ""
+        twitter_id = user["id"]
+        pseudofeed["user"] = twitter_id
+        timestamp = datetime.now().isoformat(timespec='seconds')
+        pseudofeed["timestamp"] = timestamp
 
-    """
-    Puts tweets into the MongoDB database collection. I'm not sure if I am doing
-    this right, as "insert_one" loop seems silly? But I can't get "insert many"
-    to work.
+        #~ check if we have this user in DB
+        if working_collection.count_documents({"follower_id": schema_v2.id_match(twitter_id)}) == 0:
+            print(f"{twitter_id} follows are not in the database. Skipping.")
+            continue
 
-    CALLS:  working_collection.insert_one()
+        #~ make a list of all FOLLOws from MongoDB, for this user (as strings, whichever
+        #~ schema they are stored in), leaving out the protected, suspended and gone
+        #~ until they're due a re-check
+        follow_ids = working_collection.find({"follower_id": schema_v2.id_match(twitter_id)}).distinct("id")
+        follow_ids = list(dict.fromkeys(str(follow_id) for follow_id in follow_ids))
+        follow_ids = user_failures.due_keys(follow_ids, "followed users")
+        recorded = user_failures.recorded_keys(follow_ids)
 
-    ARGS:   Stuff that the API sent back after query,
-            the name of the collection.
+        for follow_id in follow_ids:
 
-    RETS:   Nothing, puts things into DB.
-    """
+            follow_params = {
+                "query": f"(from:{follow_id})",
+                "tweet.fields": "id,author_id,created_at,text",
+                "max_results": 10} #~ the minimum!
+
+            #~ send the request for the first 500 tweets and insert to mongodb
+            print(f"Requesting recents for followed user {follow_id}...")
+            try:
+                api_response = request_follows_recents_response(follow_id, follow_params)
+                if api_response == 1: #~ this "1" is an end-trigger from request_timeline_response
+                    continue
+                else: #~ extract the text field from the follow's tweets
+                    for tweet in api_response["data"]:
+                        pseudofeed_block = pseudofeed_block + tweet["text"]
+                    if follow_id in recorded: #~ working again
+                        user_failures.clear_failure(follow_id)
+
+            except TypeError as e:
+                print(e)
 
-    for record in api_response["data"]:
+        #~ make pseudofeed into a 3pair dict: id, timestamp,
+        #~ and text (big block of what follows have said in past 7 days)
+        word_count = len(pseudofeed_block.strip().split(" "))
+        print(f"Inserting pseudofeed tweet block of ~{word_count} words.")
+        pseudofeed["text"] = pseudofeed_block
 
         try:
-            working_collection.insert_one(record)
-        except pymongo.errors.DuplicateKeyError:
-            pass #~ denies duplicates being added
\ No newline at end of file
+            db.pseudofeed.insert_one(schema_v2.convert_records([pseudofeed], "pseudofeed")[0])
+        except Exception as e:
+            print(e)
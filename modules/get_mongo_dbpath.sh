@@ -1 +0,0 @@
-mongo --eval 'db.adminCommand("getCmdLineOpts").parsed.storage.dbPath' | tail -1 ;
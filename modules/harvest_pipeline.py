@@ -0,0 +1,268 @@
+#~ Standard library imports
+import json
+import time
+import queue
+import threading
+import zlib
+
+#~ Local application imports
+from modules import twitter_ops, mongo_ops
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ MeteredQueue
+#~ HarvestPipeline
+#~ pipeline_harvest
+
+
+class MeteredQueue:
+
+    """
+    A bounded queue that keeps count of how it is being used.
+
+    put() blocks when the queue is full, which is the backpressure: fetchers
+    can't race ahead of the writers by more than maxsize pages. The time
+    spent blocked on each side tells us which side is the bottleneck.
+    """
+
+    def __init__(self, maxsize):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.put_blocked = 0.0 #~ seconds producers waited for room
+        self.get_idle = 0.0    #~ seconds consumers waited for work
+        self.max_depth = 0
+        self._depth_total = 0
+        self._depth_samples = 0
+
+    def put(self, item):
+        start = time.monotonic()
+        self._queue.put(item)
+        waited = time.monotonic() - start
+        with self._lock:
+            self.put_blocked += waited
+            self._sample()
+
+    def get(self, timeout=None):
+        start = time.monotonic()
+        item = self._queue.get(timeout=timeout)
+        waited = time.monotonic() - start
+        with self._lock:
+            self.get_idle += waited
+            self._sample()
+        return item
+
+    def get_nowait(self):
+        item = self._queue.get_nowait()
+        with self._lock:
+            self._sample()
+        return item
+
+    def _sample(self):
+        depth = self._queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self._depth_total += depth
+        self._depth_samples += 1
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def mean_depth(self):
+        with self._lock:
+            return self._depth_total / self._depth_samples if self._depth_samples else 0.0
+
+
+class HarvestPipeline:
+
+    """
+    Timeline harvest split into two stages joined by bounded queues.
+
+    Fetch workers each take a user, walk their pagination chain, and put
+    every decoded page onto a queue. Writer workers drain the queues, and
+    write whatever pages are waiting (up to batch_pages) in one bulk write,
+    then move each user's harvest state and checkpoint on.
+
+    Each writer has its own queue, and a user's pages always go to the same
+    one, so a user's pages are committed (and checkpointed) in order.
+    """
+
+    def __init__(self, working_collection, fetchers=4, writers=1, queue_size=16, batch_pages=8,
+                 report_every=30):
+        self.working_collection = working_collection
+        self.fetchers = max(fetchers, 1)
+        self.writers = max(writers, 1)
+        self.batch_pages = max(batch_pages, 1)
+        self.report_every = report_every
+        shard_size = max(queue_size // self.writers, 1)
+        self.queues = [MeteredQueue(shard_size) for _ in range(self.writers)]
+        self._users = queue.Queue()
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._failed_users = set()
+        self.pages_fetched = 0
+        self.pages_written = 0
+        self.tweets_written = 0
+        self.started = None
+
+    def queue_for(self, twitter_id):
+        #~ crc32 rather than hash(), so the same user lands on the same writer every run
+        return self.queues[zlib.crc32(str(twitter_id).encode()) % self.writers]
+
+    def fetch_worker(self):
+        while True:
+            twitter_id = self._users.get()
+            if twitter_id is None:
+                return
+            page_queue = self.queue_for(twitter_id)
+            outcome = {"complete": False}
+            try:
+                for api_response, cursor in twitter_ops.walk_chain(
+                        twitter_ops.timeline_pages(twitter_id, self.working_collection), outcome):
+                    page_queue.put(("page", twitter_id, api_response, cursor))
+                    with self._lock:
+                        self.pages_fetched += 1
+            except Exception as e:
+                print(f"Something went wrong on {twitter_id}: {e}")
+                outcome["complete"] = False
+            #~ a "done" item carries whether the user's harvest got to the end
+            page_queue.put(("done", twitter_id, outcome["complete"], None))
+
+    def write_worker(self, page_queue):
+        while True:
+            items = [page_queue.get()]
+            #~ take whatever else is already waiting, to write it all at once
+            while len(items) < self.batch_pages:
+                try:
+                    items.append(page_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(items)
+            except Exception as e:
+                #~ nothing was checkpointed for these pages, so the next run fetches them again.
+                #~ Later pages of the same users mustn't be checkpointed past them either.
+                print(f"Couldn't write {len(items)} queued pages: {e}")
+                with self._lock:
+                    self._failed_users.update(twitter_id for _, twitter_id, _, _ in items if twitter_id)
+            if any(kind == "stop" for kind, *_ in items):
+                return
+
+    def write_batch(self, items):
+
+        """
+        Write a batch of queued pages in one bulk write, then commit
+        each page's state and checkpoint in the order they were fetched.
+        """
+
+        with self._lock:
+            items = [item for item in items if item[1] not in self._failed_users]
+        pages = [item for item in items if item[0] == "page"]
+        counts = mongo_ops.insert_pages([api_response for _, _, api_response, _ in pages],
+                                        self.working_collection)
+
+        position = 0
+        for kind, twitter_id, api_response, cursor in items:
+            if kind == "page":
+                page_size = len(api_response["data"])
+                inserted = len([index for index in counts["upserted"]
+                                if position <= index < position + page_size])
+                position += page_size
+                twitter_ops.commit_timeline_page(twitter_id, api_response, cursor, inserted)
+            elif kind == "done":
+                twitter_ops.finish_user_timeline(twitter_id, complete=api_response)
+
+        with self._lock:
+            self.pages_written += len(pages)
+            self.tweets_written += position
+
+    def metrics(self):
+
+        """How the pipeline is doing, as a dict."""
+
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        with self._lock:
+            return {
+                "elapsed_seconds": round(elapsed, 1),
+                "pages_fetched": self.pages_fetched,
+                "pages_written": self.pages_written,
+                "tweets_written": self.tweets_written,
+                "queue_depth": sum(page_queue.depth() for page_queue in self.queues),
+                "queue_capacity": sum(page_queue.maxsize for page_queue in self.queues),
+                "max_queue_depth": max(page_queue.max_depth for page_queue in self.queues),
+                "mean_queue_depth": round(sum(page_queue.mean_depth() for page_queue in self.queues), 2),
+                "fetch_blocked_seconds": round(sum(page_queue.put_blocked for page_queue in self.queues), 1),
+                "write_idle_seconds": round(sum(page_queue.get_idle for page_queue in self.queues), 1)}
+
+    def bottleneck(self):
+
+        """Which side is holding the other up, going by time spent waiting."""
+
+        metrics = self.metrics()
+        if metrics["fetch_blocked_seconds"] > metrics["write_idle_seconds"]:
+            return "writing to MongoDB"
+        return "fetching from the API"
+
+    def report(self):
+        while not self._done.wait(self.report_every):
+            print(f"Pipeline: {json.dumps(self.metrics())}")
+
+    def run(self, user_ids):
+
+        """
+        Harvest these users, and wait until everything is written.
+
+        RETS:   the final metrics.
+        """
+
+        self.started = time.monotonic()
+        for twitter_id in user_ids:
+            self._users.put(twitter_id)
+        for _ in range(self.fetchers):
+            self._users.put(None)
+
+        fetch_threads = [threading.Thread(target=self.fetch_worker, daemon=True)
+                         for _ in range(self.fetchers)]
+        write_threads = [threading.Thread(target=self.write_worker, args=(page_queue,), daemon=True)
+                         for page_queue in self.queues]
+        reporter = threading.Thread(target=self.report, daemon=True)
+        for thread in fetch_threads + write_threads + [reporter]:
+            thread.start()
+
+        for thread in fetch_threads:
+            thread.join()
+        for page_queue in self.queues:
+            page_queue.put(("stop", None, None, None))
+        for thread in write_threads:
+            thread.join()
+        self._done.set()
+
+        return self.metrics()
+
+
+def pipeline_harvest(db, working_collection, fetchers=4, writers=1, queue_size=16, user_ids=None):
+
+    """
+    Harvest timelines with the fetch and write stages decoupled
+    (see HarvestPipeline). Stores the same documents as timeline_harvest.
+
+    CALLS:  HarvestPipeline.run()
+
+    ARGS:   db name (set in epicosm.py, just as local defaults)
+            collection name (set in epicosm.py)
+            how many fetch workers, how many writer workers,
+            and how many pages may wait between them,
+            optionally, which user ids to harvest (default: everyone).
+    """
+
+    user_details = twitter_ops.load_user_details(user_ids)
+
+    print(f"\nHarvesting timelines from {len(user_details)} users, "
+          f"{fetchers} fetching and {writers} writing...")
+
+    pipeline = HarvestPipeline(working_collection, fetchers, writers, queue_size)
+    metrics = pipeline.run([user["id"] for user in user_details])
+    print(f"Pipeline finished: {json.dumps(metrics)}")
+    print(f"Most time was spent waiting on {pipeline.bottleneck()}.")
+
+    users_in_collection = len(working_collection.distinct("author_id"))
+    print(f"\nThe DB contains a total of {working_collection.count()} tweets from {users_in_collection} users.")
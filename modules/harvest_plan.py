@@ -0,0 +1,232 @@
+#~ Standard library imports
+import sys
+import math
+import datetime
+
+#~ Local application imports
+from modules import (
+    twitter_api,
+    twitter_ops,
+    harvest_state,
+    adaptive_schedule,
+    mongodb_config)
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ or_query
+#~ or_query_groups
+#~ request_counts
+#~ count_group
+#~ plan_harvest
+
+
+#~ Before a harvest, ask the counts endpoint how many new tweets each user
+#~ has, rather than spending a search/all request on each to find out.
+#~ Users are asked about in groups, "(from:a OR from:b ...)" since the oldest
+#~ since_id among them: a group with nothing new is done in one request,
+#~ and a group with something is split in half until the users with new
+#~ tweets are found. Users with nothing new are skipped, and the rest are
+#~ harvested heaviest first, so the long timelines aren't left to the end.
+
+COUNTS_ENDPOINT = "tweets/counts/all"
+#~ the longest query search/all and counts/all will take (academic access)
+MAX_QUERY_LENGTH = 1024
+#~ most users in one counts group; more than this and bisecting costs more than it saves
+MAX_GROUP_SIZE = 32
+#~ tweets on a full search/all page
+PAGE_SIZE = 500
+#~ counts start this long before a user's last complete harvest, to allow
+#~ for tweets that took a while to show up in search
+CHECKED_MARGIN = datetime.timedelta(days=1)
+
+
+def or_query(twitter_ids):
+
+    """The search query for tweets from any of these users."""
+
+    return "(" + " OR ".join(f"from:{twitter_id}" for twitter_id in twitter_ids) + ")"
+
+
+def or_query_groups(twitter_ids, max_length=MAX_QUERY_LENGTH, max_size=None):
+
+    """
+    Pack users into groups whose OR query fits within the length limit.
+
+    ARGS:   the user ids, in the order to pack them,
+            the longest query allowed,
+            optionally, the most users in a group.
+
+    RETS:   list of lists of user ids.
+    """
+
+    groups = []
+    group = []
+    for twitter_id in twitter_ids:
+        too_long = len(or_query(group + [twitter_id])) > max_length
+        too_many = max_size is not None and len(group) >= max_size
+        if group and (too_long or too_many):
+            groups.append(group)
+            group = []
+        group.append(twitter_id)
+    if group:
+        groups.append(group)
+
+    return groups
+
+
+def request_counts(twitter_ids, since_id, start_time):
+
+    """
+    Ask counts/all how many tweets these users have posted since since_id,
+    following its pages (each covers up to 31 days) to the end.
+
+    CALLS:  twitter_api.connect_to_endpoint()
+
+    ARGS:   the user ids,
+            the tweet id to count from,
+            the time to count from (counts/all only looks back 30 days
+            unless told otherwise, and each 31 days costs a request).
+
+    RETS:   the number of tweets, or None if the count couldn't be had.
+    """
+
+    url = twitter_api.endpoint_url(COUNTS_ENDPOINT)
+    params = {
+        "query": or_query(twitter_ids),
+        "granularity": "day",
+        "start_time": start_time.strftime("%Y-%m-%dT%H:%M:%SZ")}
+    if since_id > 1:
+        params["since_id"] = since_id #~ users with no tweets yet are counted from start_time alone
+
+    total = 0
+    try:
+        while True:
+            counts_response = twitter_api.connect_to_endpoint(url, params)
+            total += counts_response.get("meta", {}).get("total_tweet_count", 0)
+            if "next_token" not in counts_response.get("meta", {}):
+                return total
+            params = dict(params, next_token=counts_response["meta"]["next_token"])
+
+    except twitter_api.AuthenticationError as e:
+        print(e)
+        sys.exit(129)
+
+    except twitter_api.TwitterAPIError as e:
+        print(f"Couldn't count tweets for {len(twitter_ids)} users: {e}. They will be harvested anyway.")
+        return None
+
+
+def count_group(group, since_ids, start_times, counts):
+
+    """
+    Count new tweets for a group of users, splitting it in half
+    whenever it has any, until each user's count is known.
+
+    CALLS:  request_counts()
+
+    ARGS:   the user ids,
+            dicts of each user's since_id and time to count from,
+            dict to put each user's count into (None if unknown).
+    """
+
+    total = request_counts(group,
+                           min(since_ids[twitter_id] for twitter_id in group),
+                           min(start_times[twitter_id] for twitter_id in group))
+    if total is None or (total > 0 and len(group) == 1):
+        for twitter_id in group:
+            counts[twitter_id] = total
+    elif total == 0:
+        for twitter_id in group:
+            counts[twitter_id] = 0
+    else:
+        #~ the group count is from the oldest since_id, so it can overstate
+        #~ the others; their own counts come out as the group is split
+        half = len(group) // 2
+        count_group(group[:half], since_ids, start_times, counts)
+        count_group(group[half:], since_ids, start_times, counts)
+
+
+def plan_harvest(user_ids, working_collection=None):
+
+    """
+    Work out who has anything new, and in what order to harvest them.
+
+    New users (never harvested nor backfilled) aren't counted, their whole
+    archive is wanted anyway; they go first, along with any whose last
+    harvest was interrupted. Then the rest, most new tweets first. Users
+    harvested before who had no tweets then are counted from their last run.
+    Users with nothing new are marked as run and left out.
+
+    CALLS:  harvest_state.since_id()
+            harvest_state.get_state()
+            or_query_groups()
+            count_group()
+            harvest_state.mark_run()
+
+    ARGS:   the user ids to plan for,
+            the collection of tweets.
+
+    RETS:   the user ids to harvest, in order,
+            the user ids skipped as having nothing new,
+            and dict of the new tweets counted for each known user
+            (None where the count failed).
+    """
+
+    if working_collection is None:
+        working_collection = mongodb_config.tweets_collection
+    print(f"\nPlanning harvest: counting new tweets for {len(user_ids)} users...")
+
+    since_ids = {twitter_id: harvest_state.since_id(twitter_id, working_collection)
+                 for twitter_id in user_ids}
+    #~ an interrupted chain or backfill is older than since_id, so counting wouldn't see it
+    unfinished = {twitter_id for twitter_id in user_ids
+                  if harvest_state.load_cursor(twitter_id, twitter_ops.TIMELINE_ENDPOINT) is not None
+                  or harvest_state.backfill_pending(harvest_state.get_state(twitter_id))}
+    states = {twitter_id: harvest_state.get_state(twitter_id) or {} for twitter_id in user_ids}
+    #~ a user with no tweets is only new if we've never looked: once run or backfilled, they're counted
+    new_users = [twitter_id for twitter_id in user_ids
+                 if twitter_id in unfinished or (since_ids[twitter_id] <= 1 and "last_run" not in states[twitter_id]
+                                                 and "backfill" not in states[twitter_id])]
+    new_set = set(new_users)
+    known_users = [twitter_id for twitter_id in user_ids if twitter_id not in new_set]
+
+    #~ anything older than a user's last complete harvest we would already have,
+    #~ so count from then (or from their newest tweet, if that's later)
+    start_times = {}
+    for twitter_id in known_users:
+        state = states[twitter_id]
+        checked = state.get("checked") or state.get("last_run") or state.get("backfill", {}).get("started")
+        if since_ids[twitter_id] > 1:
+            start_time = adaptive_schedule.tweet_time(since_ids[twitter_id])
+            if checked is not None:
+                start_time = max(start_time, checked - CHECKED_MARGIN)
+        else:
+            start_time = checked - CHECKED_MARGIN
+        start_times[twitter_id] = start_time
+
+    #~ users harvested around the same time share a group, so its oldest start isn't far off theirs
+    known_users.sort(key=lambda twitter_id: start_times[twitter_id])
+    counts = {}
+    requests_before = twitter_api.stats()["requests"]
+    for group in or_query_groups(known_users, max_size=MAX_GROUP_SIZE):
+        count_group(group, since_ids, start_times, counts)
+    count_requests = twitter_api.stats()["requests"] - requests_before
+
+    skipped = [twitter_id for twitter_id in known_users if counts.get(twitter_id) == 0]
+    for twitter_id in skipped:
+        harvest_state.mark_run(twitter_id)
+
+    #~ unknown counts (the request failed) are treated as heavy, to be safe
+    to_harvest = [twitter_id for twitter_id in known_users if counts.get(twitter_id) != 0]
+    to_harvest.sort(key=lambda twitter_id: -math.inf if counts.get(twitter_id) is None
+                    else -counts[twitter_id])
+    to_harvest = new_users + to_harvest
+
+    expected_tweets = sum(counts.get(twitter_id) or 0 for twitter_id in to_harvest)
+    expected_pages = len(new_users) + sum(max(math.ceil((counts.get(twitter_id) or 0) / PAGE_SIZE), 1)
+                                          for twitter_id in to_harvest if twitter_id not in new_set)
+    print(f"Plan: {count_requests} count requests. {len(skipped)} users have nothing new and are skipped. "
+          f"{len(to_harvest)} to harvest ({len(new_users)} new or unfinished), "
+          f"~{expected_tweets} new tweets from known users, at least {expected_pages} search requests.")
+
+    return to_harvest, skipped, counts
@@ -0,0 +1,337 @@
+#~ Standard library imports
+import re
+import datetime
+
+#~ 3rd party imports
+from pymongo import ReturnDocument
+
+#~ Local application imports
+from modules import mongodb_config, adaptive_schedule, schema_v2
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ get_state
+#~ bootstrap_state
+#~ since_id
+#~ record_page
+#~ record_loaded
+#~ mark_run
+#~ backfill_pending
+#~ start_backfill
+#~ finish_slice
+#~ cursor_key
+#~ load_cursor
+#~ save_cursor
+#~ clear_cursor
+#~ clear_cursors
+
+
+#~ One document per harvested user, keyed by their twitter id:
+#~   {"_id": "<author_id>",
+#~    "newest_id": <int>,   newest tweet id we hold (the next since_id)
+#~    "oldest_id": <int>,   oldest tweet id we hold
+#~    "count": <int>,       how many of their tweets we hold
+#~    "last_run": <date>,   when we last harvested them
+#~    "checked": <date>,    when a harvest of them last got everything new
+#~    "backfill": {...}}    for users backfilled in time slices (see backfill.py):
+#~                          "slices": [{"start", "end"}], "done": [slice numbers],
+#~                          "complete": <bool>
+#~ Tweet ids are stored as numbers here (they are strings in the tweets
+#~ themselves), so $max/$min compare them properly.
+#~
+#~ Pagination cursors live in their own collection, one document per
+#~ user and endpoint, holding the request parameters to carry on with
+#~ after the last page that was committed to the DB:
+#~   {"_id": "search/all:<author_id>",
+#~    "user": "<author_id>", "endpoint": "search/all",
+#~    "params": {... "next_token": "..."},
+#~    "pages": <int>, "updated": <date>}
+
+
+def get_state(twitter_id, state_collection=None):
+
+    """
+    Read one user's harvest state, an indexed lookup on _id.
+
+    RETS:   the state document, or None if we have never harvested them.
+    """
+
+    if state_collection is None:
+        state_collection = mongodb_config.harvest_state_collection
+
+    return state_collection.find_one({"_id": twitter_id})
+
+
+def bootstrap_state(twitter_id, working_collection, state_collection=None):
+
+    """
+    Build the state record for a user from the tweets we already hold.
+    Only needed once per user, for databases harvested before harvest
+    state existed. The ids are converted and compared inside MongoDB,
+    rather than pulled into python.
+
+    ARGS:   the ID number for the user,
+            the collection of tweets.
+
+    RETS:   the new state document, or None if we hold nothing for them.
+    """
+
+    if state_collection is None:
+        state_collection = mongodb_config.harvest_state_collection
+
+    summary = list(working_collection.aggregate([
+        {"$match": {"author_id": schema_v2.id_match(twitter_id)}},
+        {"$group": {
+            "_id": None,
+            "newest_id": {"$max": {"$toLong": "$id"}},
+            "oldest_id": {"$min": {"$toLong": "$id"}},
+            "count": {"$sum": 1}}}]))
+    if len(summary) == 0:
+        return None
+
+    state = {
+        "newest_id": summary[0]["newest_id"],
+        "oldest_id": summary[0]["oldest_id"],
+        "count": summary[0]["count"]}
+    state_collection.update_one({"_id": twitter_id}, {"$set": state}, upsert=True)
+    state["_id"] = twitter_id
+
+    return state
+
+
+def since_id(twitter_id, working_collection, state_collection=None):
+
+    """
+    Find where the next harvest of a user should start from.
+
+    CALLS:  get_state()
+            bootstrap_state()
+
+    ARGS:   the ID number for the user,
+            the collection of tweets.
+
+    RETS:   the newest tweet id we hold as an int, or 1 if we have nothing
+            for this user (go as far back in time as possible). If a time
+            sliced backfill of the user is unfinished, from the start of
+            the earliest slice still to do.
+    """
+
+    state = get_state(twitter_id, state_collection)
+    if state is None:
+        state = bootstrap_state(twitter_id, working_collection, state_collection)
+    if state is None or not state.get("newest_id"):
+        return 1 #~ go as far back in time as possible.
+    if backfill_pending(state):
+        #~ newest_id came from a finished slice, there are gaps before it
+        unfinished = [time_slice["start"] for number, time_slice in enumerate(state["backfill"]["slices"])
+                      if number not in state["backfill"]["done"]]
+        return adaptive_schedule.first_tweet_id(min(unfinished))
+
+    return state["newest_id"]
+
+
+def record_page(twitter_id, records, inserted, state_collection=None):
+
+    """
+    Move a user's state on after a page of their tweets has been ingested.
+    This is a single update, so it is atomic even with several harvesters.
+
+    ARGS:   the ID number for the user,
+            the tweets on the page (as returned by the API),
+            how many of them were new to the DB.
+    """
+
+    if len(records) == 0:
+        return
+
+    if state_collection is None:
+        state_collection = mongodb_config.harvest_state_collection
+    tweet_ids = [int(record["id"]) for record in records]
+    state_collection.update_one(
+        {"_id": twitter_id},
+        {"$max": {"newest_id": max(tweet_ids)},
+         "$min": {"oldest_id": min(tweet_ids)},
+         "$inc": {"count": inserted},
+         "$set": {"last_run": datetime.datetime.utcnow()}},
+        upsert=True)
+
+
+def record_loaded(twitter_id, records, inserted, state_collection=None):
+
+    """
+    Count in a user's tweets loaded from the page archive (see archive_loader.py),
+    or written by a batch harvest still under way (see batch_harvest.py).
+    Unlike record_page, newest_id is left alone: the archive may hold the
+    first pages of a chain whose cursor was never saved, and moving since_id
+    past them would leave a gap. The next harvest asks again from its own
+    since_id, and anything already loaded is skipped as a duplicate.
+    A user with tweets from before harvest state existed must have had
+    bootstrap_state first (archive_loader.write_batch sees to it), or the
+    record made here would stop since_id from ever building theirs.
+
+    ARGS:   the ID number for the user,
+            the tweets loaded,
+            how many of them were new to the DB.
+    """
+
+    if len(records) == 0:
+        return
+
+    if state_collection is None:
+        state_collection = mongodb_config.harvest_state_collection
+    state_collection.update_one(
+        {"_id": twitter_id},
+        {"$min": {"oldest_id": min(int(record["id"]) for record in records)},
+         "$inc": {"count": inserted}},
+        upsert=True)
+
+
+def mark_run(twitter_id, complete=True, state_collection=None):
+
+    """
+    Note that a user has been harvested, even if they had nothing new.
+    If everything new was got (the chain was walked to its end), "checked"
+    is set too: we hold everything they posted up to then.
+    """
+
+    if state_collection is None:
+        state_collection = mongodb_config.harvest_state_collection
+    now = datetime.datetime.utcnow()
+    update = {"last_run": now}
+    if complete:
+        update["checked"] = now
+    state_collection.update_one(
+        {"_id": twitter_id},
+        {"$set": update,
+         "$setOnInsert": {"count": 0}},
+        upsert=True)
+    if complete:
+        #~ a complete harvest from since_id covers any unfinished backfill slices too
+        state_collection.update_one(
+            {"_id": twitter_id, "backfill.complete": False},
+            {"$set": {"backfill.complete": True}})
+
+
+def backfill_pending(state):
+
+    """Whether a state record has a time sliced backfill still unfinished."""
+
+    return state is not None and "backfill" in state and not state["backfill"].get("complete")
+
+
+def start_backfill(twitter_id, slices, state_collection=None):
+
+    """
+    Record the time slices a user's backfill is split into, unless
+    an unfinished backfill is already under way.
+
+    ARGS:   the ID number for the user,
+            list of {"start", "end"} utc datetimes.
+
+    RETS:   the backfill record in force.
+    """
+
+    if state_collection is None:
+        state_collection = mongodb_config.harvest_state_collection
+    state = get_state(twitter_id, state_collection)
+    if backfill_pending(state):
+        return state["backfill"]
+    backfill = {"slices": slices, "done": [], "complete": False,
+                "started": datetime.datetime.utcnow()}
+    state_collection.update_one(
+        {"_id": twitter_id},
+        {"$set": {"backfill": backfill},
+         "$setOnInsert": {"count": 0}},
+        upsert=True)
+
+    return backfill
+
+
+def finish_slice(twitter_id, number, state_collection=None):
+
+    """
+    Note a backfill slice as done. This is one atomic update, so slices
+    finishing at the same time can't lose each other.
+
+    RETS:   True if that was the last slice, and the backfill is complete.
+    """
+
+    if state_collection is None:
+        state_collection = mongodb_config.harvest_state_collection
+    state = state_collection.find_one_and_update(
+        {"_id": twitter_id},
+        {"$addToSet": {"backfill.done": number}},
+        return_document=ReturnDocument.AFTER)
+    backfill = state["backfill"]
+
+    return len(set(backfill["done"])) >= len(backfill["slices"])
+
+
+def cursor_key(twitter_id, endpoint):
+
+    """The _id of a user's cursor for an endpoint."""
+
+    return f"{endpoint}:{twitter_id}"
+
+
+def load_cursor(twitter_id, endpoint, cursor_collection=None):
+
+    """
+    Find an unfinished pagination chain for this user and endpoint.
+
+    RETS:   the request params to resume with, or None if there isn't one.
+    """
+
+    if cursor_collection is None:
+        cursor_collection = mongodb_config.harvest_cursors_collection
+    cursor = cursor_collection.find_one({"_id": cursor_key(twitter_id, endpoint)})
+    if cursor is None:
+        return None
+
+    return cursor["params"]
+
+
+def save_cursor(twitter_id, endpoint, params, cursor_collection=None):
+
+    """
+    Checkpoint a pagination chain. Call this only once the page before
+    has been committed to the DB, so a restart never skips a page.
+
+    ARGS:   the ID number for the user,
+            the endpoint family, eg "search/all",
+            the request params for the next page (including its token).
+    """
+
+    if cursor_collection is None:
+        cursor_collection = mongodb_config.harvest_cursors_collection
+    cursor_collection.update_one(
+        {"_id": cursor_key(twitter_id, endpoint)},
+        {"$set": {
+            "user": twitter_id,
+            "endpoint": endpoint,
+            "params": params,
+            "updated": datetime.datetime.utcnow()},
+         "$inc": {"pages": 1}},
+        upsert=True)
+
+
+def clear_cursor(twitter_id, endpoint, cursor_collection=None):
+
+    """The chain has been walked to the end, so forget its cursor."""
+
+    if cursor_collection is None:
+        cursor_collection = mongodb_config.harvest_cursors_collection
+    cursor_collection.delete_one({"_id": cursor_key(twitter_id, endpoint)})
+
+
+def clear_cursors(twitter_id, endpoint_prefix, cursor_collection=None):
+
+    """
+    Forget all of a user's cursors for endpoints starting with a prefix,
+    eg every slice of an old backfill ("search/all/slice").
+    """
+
+    if cursor_collection is None:
+        cursor_collection = mongodb_config.harvest_cursors_collection
+    cursor_collection.delete_many({"user": twitter_id,
+                                   "endpoint": {"$regex": "^" + re.escape(endpoint_prefix)}})
@@ -0,0 +1,477 @@
+#~ Standard library imports
+import datetime
+import threading
+
+#~ 3rd party imports
+import pymongo
+
+#~ Local application imports
+from modules import mongodb_config, schema_v2
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ registered_indexes
+#~ same_keys
+#~ remove_duplicates
+#~ create_registered
+#~ ensure_indexes
+#~ build_indexes
+#~ start_build
+#~ build_progress
+#~ wait_for_build
+#~ sample_value
+#~ epicosm_queries
+#~ plan_stages
+#~ winning_plans
+#~ explain_query
+#~ advise
+
+
+#~ Every index Epicosm relies on, in one place. Each collection (named as
+#~ its attribute in mongodb_config) has a list of
+#~   (index name, keys, options)
+#~ which ensure_indexes() builds if missing. --build_indexes builds them all
+#~ in the background, replaces any older index on the same keys whose
+#~ options have changed (eg a plain tweet id index now to be unique), drops
+#~ the ones listed in SUPERSEDED, then runs explain() on the queries Epicosm
+#~ makes and flags any that would scan a whole collection. A database
+#~ harvested before the unique indexes existed can hold duplicates (eg the
+#~ same tweet twice), which a unique index can't be built over: that is
+#~ reported, and --build_indexes removes the extra copies first.
+
+#~ only analysed tweets have these, so their indexes hold nothing for the rest
+ANALYSER_FIELDS = ("epicosm.vader.compound", "epicosm.labMT.emotion_valence",
+                   "epicosm.textblob", "epicosm.trivial_nlp.e_ratio")
+
+INDEXES = {
+    "tweets_collection": [
+        ("tweet_id_unique", [("id", pymongo.ASCENDING)], {"unique": True}),
+        ("author_newest", [("author_id", pymongo.ASCENDING), ("id", pymongo.DESCENDING)], {})] + [
+        (field.replace("epicosm.", "analysed_").replace(".", "_"), [(field, pymongo.ASCENDING)],
+         {"partialFilterExpression": {field: {"$exists": True}}})
+        for field in ANALYSER_FIELDS],
+    #~ two people can follow the same account, so an edge is follower and followed together
+    "follows_collection": [
+        ("follow_edge_unique", [("follower_id", pymongo.ASCENDING), ("id", pymongo.ASCENDING)], {"unique": True})],
+    "pseudofeed_collection": [
+        ("user_timestamp", [("user", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)], {})],
+    "users_collection": [
+        ("user_id_unique", [("id", pymongo.ASCENDING)], {"unique": True})],
+    "media_collection": [
+        ("media_key_unique", [("media_key", pymongo.ASCENDING)], {"unique": True})],
+    "harvest_state_collection": [
+        ("next_due", [("next_due", pymongo.ASCENDING)], {})],
+    "harvest_jobs_collection": [
+        ("job_claim", [("status", pymongo.ASCENDING), ("enqueued", pymongo.ASCENDING),
+                       ("position", pymongo.ASCENDING)], {})],
+    "user_failures_collection": [
+        ("recheck_at", [("recheck_at", pymongo.ASCENDING)], {})]}
+
+#~ older indexes a registered one does the job of, dropped once it is built
+SUPERSEDED = {
+    "tweets_collection": [[("author_id", pymongo.ASCENDING)]]}
+
+#~ how often to report on index builds running in the background
+PROGRESS_EVERY = 10
+#~ how many duplicates to delete at a time
+DELETE_BATCH = 1000
+
+#~ (collection, index name) of unique indexes found this run to be blocked by duplicates,
+#~ so they aren't tried (a whole collection scan) again until --build_indexes
+_duplicates = set()
+
+
+def registered_indexes(working_collection):
+
+    """
+    The registered indexes for a collection, found by its name, so it
+    works for collections got at by name too (eg db["tweets"]).
+
+    RETS:   the mongodb_config attribute name, and its list of indexes
+            (None and [] if nothing is registered for it).
+    """
+
+    for attribute, indexes in INDEXES.items():
+        if getattr(mongodb_config, attribute).name == working_collection.name:
+            return attribute, indexes
+
+    return None, []
+
+
+def same_keys(first, second):
+
+    """Whether two index key lists are the same fields in the same directions."""
+
+    return [(field, int(direction)) for field, direction in first] == \
+           [(field, int(direction)) for field, direction in second]
+
+
+def remove_duplicates(working_collection, keys):
+
+    """
+    Delete all but the first stored (lowest _id) of the documents that
+    share the same values of these fields, so a unique index can be built.
+
+    CALLS:  collection.aggregate()
+            collection.delete_many()
+
+    ARGS:   the collection,
+            the index keys.
+
+    RETS:   how many documents were deleted.
+    """
+
+    group_key = {f"key_{number}": f"${field}" for number, (field, direction) in enumerate(keys)}
+    groups = working_collection.aggregate([
+        {"$sort": {"_id": pymongo.ASCENDING}},
+        {"$group": {"_id": group_key, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}],
+        allowDiskUse=True)
+
+    removed = 0
+    extra_ids = []
+    for group in groups:
+        extra_ids += group["ids"][1:]
+        if len(extra_ids) >= DELETE_BATCH:
+            removed += working_collection.delete_many({"_id": {"$in": extra_ids}}).deleted_count
+            extra_ids = []
+    if len(extra_ids) > 0:
+        removed += working_collection.delete_many({"_id": {"$in": extra_ids}}).deleted_count
+
+    return removed
+
+
+def create_registered(working_collection, name, keys, options, dedupe=False):
+
+    """
+    Build one registered index. If it is unique and duplicates are in
+    the way (MongoDB error 11000), and dedupe is set, they are removed
+    and the build tried again; otherwise the error is raised.
+    """
+
+    try:
+        working_collection.create_index(keys, name=name, background=True, **options)
+    except pymongo.errors.OperationFailure as e:
+        if e.code != 11000 or not dedupe:
+            raise
+        print(f"Removing duplicate {', '.join(field for field, direction in keys)} values "
+              f"from {working_collection.name}, keeping the first stored of each...")
+        removed = remove_duplicates(working_collection, keys)
+        print(f"Removed {removed} duplicates from {working_collection.name}.")
+        working_collection.create_index(keys, name=name, background=True, **options)
+
+
+def ensure_indexes(working_collection, replace=False):
+
+    """
+    Build whichever of a collection's registered indexes it doesn't have.
+    An index already there on the same keys is taken to be the one wanted,
+    whatever its name, unless replace is set and its options differ: then
+    it is dropped and built again as registered (if that fails, the old
+    one is put back). With replace, duplicates blocking a unique index
+    are removed; without, the index is reported as blocked by them, and
+    not tried again this run.
+
+    CALLS:  collection.index_information()
+            create_registered()
+
+    ARGS:   the collection,
+            whether to replace indexes whose options have changed, and
+            drop superseded ones (slow on a big collection, so only for
+            --build_indexes).
+
+    RETS:   dict of index name: "present", "built", "replaced", "differs"
+            (options changed, not replaced), "duplicates" (unique, but the
+            collection has duplicates) or "failed: <why>".
+    """
+
+    attribute, indexes = registered_indexes(working_collection)
+    existing = working_collection.index_information()
+    results = {}
+
+    for name, keys, options in indexes:
+        if (working_collection.full_name, name) in _duplicates and not replace:
+            results[name] = "duplicates"
+            continue
+        match = next((existing_name for existing_name, info in existing.items()
+                      if same_keys(info["key"], keys)), None)
+        if match is not None:
+            info = existing[match]
+            differs = any(info.get(option) != value for option, value in options.items())
+            if not differs:
+                results[name] = "present"
+                continue
+            if not replace:
+                results[name] = "differs"
+                continue
+            print(f"Rebuilding index {match} on {working_collection.name} as {name}...")
+            working_collection.drop_index(match)
+            try:
+                create_registered(working_collection, name, keys, options, dedupe=True)
+                results[name] = "replaced"
+            except pymongo.errors.OperationFailure as e:
+                working_collection.create_index(
+                    keys, name=match, background=True,
+                    **{option: value for option, value in info.items() if option in ("unique", "partialFilterExpression")})
+                results[name] = f"failed: {e}"
+            continue
+        print(f"Building index {name} on {working_collection.name}...")
+        try:
+            create_registered(working_collection, name, keys, options, dedupe=replace)
+            results[name] = "built"
+        except pymongo.errors.OperationFailure as e:
+            if e.code == 11000 and not replace:
+                _duplicates.add((working_collection.full_name, name))
+                results[name] = "duplicates"
+            else:
+                results[name] = f"failed: {e}"
+
+    #~ only once everything registered is in place, so nothing is left unindexed
+    complete = all(status in ("present", "built", "replaced") for status in results.values())
+    if replace and complete:
+        for keys in SUPERSEDED.get(attribute, []):
+            for existing_name, info in existing.items():
+                if same_keys(info["key"], keys):
+                    print(f"Dropping index {existing_name} on {working_collection.name}, no longer needed.")
+                    working_collection.drop_index(existing_name)
+
+    for name, status in results.items():
+        if status.startswith("failed"):
+            print(f"Index {name} on {working_collection.name}: {status}.")
+        elif status == "differs":
+            print(f"Index {name} on {working_collection.name} is there with other options "
+                  f"(run with --build_indexes to rebuild it).")
+        elif status == "duplicates":
+            print(f"Index {name} on {working_collection.name} can't be built: the collection holds duplicate "
+                  f"values of its fields (stored before it was unique), and every write to it is slow without it. "
+                  f"Run with --build_indexes to remove the duplicates and build it.")
+
+    return results
+
+
+def build_indexes(replace=False):
+
+    """
+    Build the registered indexes on every collection.
+
+    CALLS:  ensure_indexes()
+
+    RETS:   dict of collection name: ensure_indexes() results.
+    """
+
+    results = {}
+    for attribute in INDEXES:
+        working_collection = getattr(mongodb_config, attribute)
+        results[working_collection.name] = ensure_indexes(working_collection, replace)
+
+    return results
+
+
+def start_build(replace=False):
+
+    """
+    Build the registered indexes in a background thread, so a harvest
+    can start straight away. MongoDB carries on with a build the thread
+    started even if Epicosm stops, so the thread doesn't hold up exiting.
+
+    RETS:   the thread.
+    """
+
+    thread = threading.Thread(target=build_indexes, name="index-build", daemon=True,
+                              kwargs={"replace": replace})
+    thread.start()
+
+    return thread
+
+
+def build_progress():
+
+    """
+    What MongoDB says about the index builds running on the database.
+
+    RETS:   list of strings, eg "tweets: Index Build: scanning collection 120000/450000 26%".
+    """
+
+    try:
+        operations = mongodb_config.client.admin.command(
+            {"currentOp": 1, "command.createIndexes": {"$exists": True}})
+    except pymongo.errors.PyMongoError:
+        return []
+
+    progress = []
+    for operation in operations.get("inprog", []):
+        if operation.get("ns", "").split(".", 1)[0] != mongodb_config.db.name:
+            continue
+        progress.append(f"{operation['command']['createIndexes']}: {operation.get('msg', 'building')}")
+
+    return progress
+
+
+def wait_for_build(thread, every=PROGRESS_EVERY):
+
+    """Wait for a start_build() thread to finish, saying how the builds are going."""
+
+    while thread.is_alive():
+        thread.join(every)
+        if thread.is_alive():
+            for line in build_progress():
+                print(f"  {line}")
+
+
+def sample_value(working_collection, field, default="0"):
+
+    """One value of a field from a collection, so explained queries look like real ones."""
+
+    document = working_collection.find_one({field: {"$exists": True}}, {field: 1})
+
+    return document[field] if document is not None else default
+
+
+def epicosm_queries():
+
+    """
+    The queries Epicosm makes, filled in with values from the database.
+
+    RETS:   list of (what the query is for, the collection, the command
+            to explain, as sent to MongoDB without the collection name).
+    """
+
+    config = mongodb_config
+    author = sample_value(config.tweets_collection, "author_id")
+    tweet = sample_value(config.tweets_collection, "id")
+    follower = sample_value(config.follows_collection, "follower_id")
+    followed = sample_value(config.follows_collection, "id")
+    user = sample_value(config.pseudofeed_collection, "user")
+    now = datetime.datetime.utcnow()
+    user_ids = [str(author), str(follower)]
+
+    return [
+        ("tweet upsert, by id (mongo_ops.bulk_upsert)", config.tweets_collection,
+         {"find": {"filter": {"id": schema_v2.id_match(tweet)}}}),
+        ("a user's recent tweets (adaptive_schedule.posting_rate)", config.tweets_collection,
+         {"count": {"query": {"author_id": schema_v2.id_match(author),
+                              **schema_v2.time_after("created_at", now - datetime.timedelta(days=30))}}}),
+        ("a user's newest and oldest tweets (harvest_state.bootstrap_state)", config.tweets_collection,
+         {"aggregate": {"pipeline": [{"$match": {"author_id": schema_v2.id_match(author)}},
+                                     {"$group": {"_id": None, "newest_id": {"$max": "$id"}}}],
+                        "cursor": {}}}),
+        ("users in the tweets collection (end of harvest)", config.tweets_collection,
+         {"distinct": {"key": "author_id", "query": {}}}),
+        ("tweets by sentiment (analysis)", config.tweets_collection,
+         {"find": {"filter": {"epicosm.vader.compound": {"$gte": 0.5}}}}),
+        ("follow upsert, by edge (mongo_ops.bulk_upsert)", config.follows_collection,
+         {"find": {"filter": {"follower_id": schema_v2.id_match(follower), "id": schema_v2.id_match(followed)}}}),
+        ("a user's follows (follows_ops.pseudofeed_harvest)", config.follows_collection,
+         {"distinct": {"key": "id", "query": {"follower_id": schema_v2.id_match(follower)}}}),
+        ("a user's pseudofeeds", config.pseudofeed_collection,
+         {"find": {"filter": {"user": user}, "sort": {"timestamp": -1}}}),
+        ("users not yet due (adaptive_schedule.due_users)", config.harvest_state_collection,
+         {"find": {"filter": {"_id": {"$in": user_ids}, "next_due": {"$gt": now}}}}),
+        ("the next user due (adaptive_schedule.seconds_until_next_due)", config.harvest_state_collection,
+         {"find": {"filter": {"_id": {"$in": user_ids}, "next_due": {"$gt": now}},
+                   "sort": {"next_due": 1}, "limit": 1}}),
+        ("claiming a job (job_queue.claim_job)", config.harvest_jobs_collection,
+         {"find": {"filter": {"status": "queued", "kind": {"$in": ["timeline", "follows"]}},
+                   "sort": {"enqueued": 1, "position": 1}, "limit": 1}}),
+        ("accounts left alone (user_failures.failing_keys)", config.user_failures_collection,
+         {"find": {"filter": {"_id": {"$in": user_ids}, "recheck_at": {"$gt": now}}}}),
+        ("expanded user upsert, by id (mongo_ops.insert_includes)", config.users_collection,
+         {"find": {"filter": {"id": schema_v2.id_match(author)}}}),
+        ("media upsert, by key (mongo_ops.insert_includes)", config.media_collection,
+         {"find": {"filter": {"media_key": "3_0"}}})]
+
+
+def plan_stages(plan):
+
+    """
+    Every stage of a query plan, however deeply nested.
+
+    RETS:   list of (stage name, index name or None).
+    """
+
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append((plan["stage"], plan.get("indexName")))
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+
+    return stages
+
+
+def winning_plans(explained):
+
+    """Every winningPlan in an explain() result (aggregations and shards have several)."""
+
+    plans = []
+    if isinstance(explained, dict):
+        for key, value in explained.items():
+            if key == "winningPlan":
+                plans.append(value)
+            else:
+                plans.extend(winning_plans(value))
+    elif isinstance(explained, list):
+        for value in explained:
+            plans.extend(winning_plans(value))
+
+    return plans
+
+
+def explain_query(working_collection, command):
+
+    """
+    Ask MongoDB how it would run a query, without running it.
+
+    ARGS:   the collection,
+            {"find" | "count" | "distinct" | "aggregate": {the rest of the command}}.
+
+    RETS:   list of (stage name, index name or None) in the winning plan.
+    """
+
+    (verb, body), = command.items()
+    explained = working_collection.database.command(
+        {"explain": {verb: working_collection.name, **body}, "verbosity": "queryPlanner"})
+
+    return [stage for plan in winning_plans(explained) for stage in plan_stages(plan)]
+
+
+def advise():
+
+    """
+    Run explain() on each query Epicosm makes and say how MongoDB would
+    run it, flagging any that would scan a whole collection.
+
+    CALLS:  epicosm_queries()
+            explain_query()
+
+    RETS:   list of the queries that would scan a collection.
+    """
+
+    print(f"\nHow MongoDB would run Epicosm's queries:")
+    scans = []
+    for purpose, working_collection, command in epicosm_queries():
+        try:
+            stages = explain_query(working_collection, command)
+        except pymongo.errors.OperationFailure as e:
+            print(f"  ??    {purpose}: couldn't explain it ({e}).")
+            continue
+        names = [stage for stage, index in stages]
+        indexes = sorted({index for stage, index in stages if index})
+        if "COLLSCAN" in names:
+            scans.append(purpose)
+            print(f"  SCAN  {purpose}: reads the whole {working_collection.name} collection!")
+        elif "EOF" in names and len(indexes) == 0:
+            print(f"  --    {purpose}: {working_collection.name} is empty.")
+        else:
+            print(f"  ok    {purpose}: {', '.join(indexes) or ' > '.join(names)}.")
+
+    if len(scans) > 0:
+        print(f"{len(scans)} queries would scan a whole collection: run with --build_indexes "
+              f"to build any missing indexes, and see above for any that failed.")
+    else:
+        print(f"Every query is served by an index.")
+
+    return scans
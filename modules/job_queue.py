@@ -0,0 +1,365 @@
+#~ Standard library imports
+import os
+import time
+import socket
+import datetime
+import threading
+
+#~ 3rd party imports
+import pymongo
+from pymongo import UpdateOne, ReturnDocument
+
+#~ Local application imports
+from modules import (
+    twitter_ops,
+    follows_ops,
+    mongo_ops,
+    adaptive_schedule,
+    index_registry,
+    mongodb_config)
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ job_key
+#~ worker_name
+#~ enqueue_jobs
+#~ requeue_expired
+#~ claim_job
+#~ renew_lease
+#~ complete_job
+#~ fail_job
+#~ queue_counts
+#~ run_job
+#~ worker_loop
+#~ run_workers
+
+
+#~ Instead of one process looping over user_details.json, each user's
+#~ harvest is a job in MongoDB, and any number of worker processes (on
+#~ this machine or others sharing the DB) take jobs one at a time:
+#~   {"_id": "timeline:<user id>",
+#~    "kind": "timeline" | "follows",
+#~    "user": "<user id>",
+#~    "status": "queued" | "leased" | "done" | "failed",
+#~    "owner": "<host>:<pid>:<thread>",   the worker holding the lease
+#~    "lease_expires": <date>,
+#~    "attempts": <int>, "error": "...",
+#~    "enqueued": <date>, "position": <int>,  jobs are taken in this order
+#~    "updated": <date>}
+#~ A worker holds a lease on its job and renews it while it works. If the
+#~ worker dies the lease runs out and the job is queued again, and since
+#~ harvests resume from harvest_state and their checkpoints, whoever picks
+#~ it up carries on rather than fetching it all again.
+
+#~ the kinds of job: a user's timeline into tweets, their follows list into follows
+JOB_KINDS = ("timeline", "follows")
+
+#~ how long a lease lasts without being renewed, and how often it's renewed
+LEASE_SECONDS = 300
+HEARTBEAT_SECONDS = 60
+#~ a job that fails this many times is set aside as "failed"
+MAX_ATTEMPTS = 3
+#~ how long an idle worker waits before looking for work again
+POLL_SECONDS = 10
+
+
+def job_key(kind, twitter_id):
+
+    """The _id of a user's job of this kind."""
+
+    return f"{kind}:{twitter_id}"
+
+
+def worker_name():
+
+    """
+    Name this worker uniquely across machines, processes and threads.
+    """
+
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def enqueue_jobs(user_ids, kinds, adaptive=False, job_collection=None):
+
+    """
+    Queue a job of each kind for each user. Jobs already waiting or being
+    worked on are left as they are; finished or failed ones are queued again.
+
+    CALLS:  index_registry.ensure_indexes()
+            collection.bulk_write()
+
+    ARGS:   the user ids,
+            the kinds of job, from JOB_KINDS,
+            whether finished timeline jobs should reschedule their user
+            (see adaptive_schedule).
+
+    RETS:   how many jobs are now queued for these users.
+    """
+
+    if job_collection is None:
+        job_collection = mongodb_config.harvest_jobs_collection
+    index_registry.ensure_indexes(job_collection)
+    now = datetime.datetime.utcnow()
+
+    job_ids = [job_key(kind, twitter_id) for kind in kinds for twitter_id in user_ids]
+    if len(job_ids) == 0:
+        return 0
+    #~ position keeps the order the users were given in (e.g. a harvest plan's)
+    requests = []
+    for kind in kinds:
+        for position, twitter_id in enumerate(user_ids):
+            requests.append(UpdateOne(
+                {"_id": job_key(kind, twitter_id)},
+                {"$setOnInsert": {"kind": kind, "user": twitter_id, "status": "queued",
+                                  "attempts": 0, "enqueued": now, "position": position,
+                                  "updated": now}},
+                upsert=True))
+            requests.append(UpdateOne(
+                {"_id": job_key(kind, twitter_id), "status": {"$in": ["done", "failed"]}},
+                {"$set": {"status": "queued", "attempts": 0, "enqueued": now,
+                          "position": position, "updated": now},
+                 "$unset": {"owner": "", "lease_expires": "", "error": ""}}))
+    job_collection.bulk_write(requests, ordered=True)
+    job_collection.update_many(
+        {"_id": {"$in": job_ids}, "kind": "timeline"},
+        {"$set": {"adaptive": adaptive}})
+
+    queued = job_collection.count_documents({"_id": {"$in": job_ids}, "status": "queued"})
+    print(f"{queued} harvest jobs queued, of {len(job_ids)} for {len(user_ids)} users.")
+
+    return queued
+
+
+def requeue_expired(job_collection=None):
+
+    """
+    Put back any job whose worker has stopped renewing its lease.
+
+    RETS:   how many jobs were queued again.
+    """
+
+    if job_collection is None:
+        job_collection = mongodb_config.harvest_jobs_collection
+    now = datetime.datetime.utcnow()
+    requeued = job_collection.update_many(
+        {"status": "leased", "lease_expires": {"$lt": now}},
+        {"$set": {"status": "queued", "updated": now},
+         "$unset": {"owner": "", "lease_expires": ""}})
+    if requeued.modified_count:
+        print(f"{requeued.modified_count} harvest jobs had expired leases, queued again.")
+
+    return requeued.modified_count
+
+
+def claim_job(worker, kinds, lease_seconds=LEASE_SECONDS, job_collection=None):
+
+    """
+    Take the oldest queued job of these kinds. This is a single
+    find_one_and_update, so two workers can never claim the same job.
+
+    RETS:   the job document, or None if there is nothing queued.
+    """
+
+    if job_collection is None:
+        job_collection = mongodb_config.harvest_jobs_collection
+    now = datetime.datetime.utcnow()
+
+    return job_collection.find_one_and_update(
+        {"status": "queued", "kind": {"$in": list(kinds)}},
+        {"$set": {"status": "leased", "owner": worker, "updated": now,
+                  "lease_expires": now + datetime.timedelta(seconds=lease_seconds)},
+         "$inc": {"attempts": 1}},
+        sort=[("enqueued", pymongo.ASCENDING), ("position", pymongo.ASCENDING)],
+        return_document=ReturnDocument.AFTER)
+
+
+def renew_lease(job, worker, lease_seconds=LEASE_SECONDS, job_collection=None):
+
+    """
+    Extend the lease on a job we are working on.
+
+    RETS:   True if we still hold it, False if it has been given to someone else.
+    """
+
+    if job_collection is None:
+        job_collection = mongodb_config.harvest_jobs_collection
+    now = datetime.datetime.utcnow()
+    renewed = job_collection.update_one(
+        {"_id": job["_id"], "status": "leased", "owner": worker},
+        {"$set": {"lease_expires": now + datetime.timedelta(seconds=lease_seconds),
+                  "updated": now}})
+
+    return renewed.matched_count == 1
+
+
+def complete_job(job, worker, job_collection=None):
+
+    """Mark a job done, if we still hold its lease."""
+
+    if job_collection is None:
+        job_collection = mongodb_config.harvest_jobs_collection
+    job_collection.update_one(
+        {"_id": job["_id"], "owner": worker},
+        {"$set": {"status": "done", "updated": datetime.datetime.utcnow()},
+         "$unset": {"owner": "", "lease_expires": "", "error": ""}})
+
+
+def fail_job(job, worker, error, job_collection=None):
+
+    """
+    Give a job back after it went wrong: queued again to be retried,
+    or set aside as failed once it has had MAX_ATTEMPTS.
+    """
+
+    if job_collection is None:
+        job_collection = mongodb_config.harvest_jobs_collection
+    status = "failed" if job.get("attempts", 0) >= MAX_ATTEMPTS else "queued"
+    job_collection.update_one(
+        {"_id": job["_id"], "owner": worker},
+        {"$set": {"status": status, "error": str(error), "updated": datetime.datetime.utcnow()},
+         "$unset": {"owner": "", "lease_expires": ""}})
+    print(f"Job {job['_id']} went wrong ({error}), {status}.")
+
+
+def queue_counts(kinds=JOB_KINDS, job_collection=None):
+
+    """How many jobs of these kinds are in each status, as a dict."""
+
+    if job_collection is None:
+        job_collection = mongodb_config.harvest_jobs_collection
+    counts = job_collection.aggregate([
+        {"$match": {"kind": {"$in": list(kinds)}}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}])
+
+    return {count["_id"]: count["count"] for count in counts}
+
+
+def run_job(job, stop=None):
+
+    """
+    Do the harvest a job stands for.
+
+    CALLS:  twitter_ops.harvest_user_timeline()
+            follows_ops.harvest_user_follows()
+            adaptive_schedule.schedule_user()
+
+    ARGS:   the job,
+            optionally, a threading.Event to stop at the next page.
+
+    RETS:   True if it ran to the end, False if it was stopped. Raises
+            RuntimeError if a request failed before the end, so the job
+            is retried (see fail_job).
+    """
+
+    if job["kind"] == "timeline":
+        result = twitter_ops.harvest_user_timeline(job["user"], mongodb_config.tweets_collection, stop)
+        if result == "done" and job.get("adaptive"):
+            adaptive_schedule.schedule_user(job["user"], mongodb_config.tweets_collection)
+    elif job["kind"] == "follows":
+        mongo_ops.ensure_key_index(mongodb_config.follows_collection, ("follower_id", "id"))
+        result = follows_ops.harvest_user_follows(job["user"], mongodb_config.follows_collection, stop)
+    else:
+        raise ValueError(f"Unknown kind of job: {job['kind']}")
+
+    if result == "incomplete":
+        raise RuntimeError(f"the {job['kind']} harvest of {job['user']} stopped before its end")
+
+    return result == "done"
+
+
+def worker_loop(kinds, lease_seconds=LEASE_SECONDS, wait=False):
+
+    """
+    Claim and run jobs until there are none left. While a job runs,
+    a heartbeat thread keeps its lease renewed. If the lease is lost (we
+    were too slow to renew it, and the job went to another worker), the
+    job is told to stop at its next page, and is neither completed nor
+    failed: it is the other worker's now.
+
+    CALLS:  requeue_expired()
+            claim_job()
+            run_job()
+            renew_lease()
+            complete_job() / fail_job()
+
+    ARGS:   the kinds of job to take,
+            the lease length in seconds,
+            whether to keep waiting for new jobs once the queue is empty.
+
+    RETS:   how many jobs this worker completed.
+    """
+
+    worker = worker_name()
+    completed = 0
+
+    while True:
+        requeue_expired()
+        job = claim_job(worker, kinds, lease_seconds)
+
+        if job is None:
+            counts = queue_counts(kinds)
+            if not wait and counts.get("leased", 0) == 0:
+                break #~ nothing queued, and nobody's lease can run out to give us more
+            time.sleep(POLL_SECONDS)
+            continue
+
+        finished = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            while not finished.wait(min(HEARTBEAT_SECONDS, lease_seconds / 3)):
+                if not renew_lease(job, worker, lease_seconds):
+                    print(f"Lost the lease on {job['_id']}, another worker has it now.")
+                    lost.set()
+                    return
+
+        renewer = threading.Thread(target=heartbeat, daemon=True)
+        renewer.start()
+        try:
+            ran = run_job(job, lost)
+        except Exception as e:
+            if lost.is_set():
+                print(f"Job {job['_id']} went wrong ({e}) after its lease was lost, leaving it be.")
+            else:
+                fail_job(job, worker, e)
+        else:
+            if not ran or lost.is_set():
+                print(f"Left job {job['_id']} to the worker that has it now.")
+            else:
+                complete_job(job, worker)
+                completed += 1
+        finally:
+            finished.set()
+            renewer.join()
+
+    return completed
+
+
+def run_workers(kinds, workers=1, lease_seconds=LEASE_SECONDS, wait=False):
+
+    """
+    Work through the job queue with several workers in this process.
+    Run this in as many processes, on as many machines, as you like.
+
+    CALLS:  worker_loop()
+
+    ARGS:   the kinds of job to take,
+            how many workers (threads) to run here,
+            the lease length in seconds,
+            whether to keep waiting for new jobs once the queue is empty.
+    """
+
+    print(f"\nWorking through the harvest job queue ({', '.join(kinds)}) with {workers} workers...")
+    print(f"Jobs waiting: {queue_counts(kinds)}")
+
+    if workers > 1:
+        threads = [threading.Thread(target=worker_loop, args=(kinds, lease_seconds, wait))
+                   for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        worker_loop(kinds, lease_seconds, wait)
+
+    print(f"\nHarvest job queue now: {queue_counts(kinds)}")
@@ -0,0 +1,72 @@
+#~ Standard library imports
+import json
+
+#~ 3rd party imports, optional: orjson decodes API pages several times
+#~ faster than the standard library, but everything works without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ loads
+#~ dumps
+#~ load_file
+#~ dump_file
+
+
+def loads(data):
+
+    """
+    Decode JSON, with orjson if it is installed.
+
+    ARGS:   JSON as bytes or str (e.g. response.content).
+
+    RETS:   the decoded object.
+    """
+
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
+def dumps(obj, pretty=False):
+
+    """
+    Encode as JSON, with orjson if it is installed.
+    Keys are sorted either way, so the output is the same whichever is used.
+
+    ARGS:   the object,
+            whether to indent it for people to read (default compact).
+
+    RETS:   the JSON as bytes.
+    """
+
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+
+    if pretty:
+        return json.dumps(obj, indent=2, sort_keys=True).encode("utf-8")
+
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+
+def load_file(path):
+
+    """Read a JSON file, e.g. user_details.json."""
+
+    with open(path, "rb") as infile:
+        return loads(infile.read())
+
+
+def dump_file(obj, path, pretty=False):
+
+    """Write a JSON file, compact unless asked otherwise."""
+
+    with open(path, "wb") as outfile:
+        outfile.write(dumps(obj, pretty))
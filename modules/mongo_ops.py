@@ -6,9 +6,13 @@ import chardet
 import psutil
 import pymongo
 
-client = pymongo.MongoClient("localhost", 27017)
-db = client.twitter_db
-collection = db.tweets
+from modules import page_archive, mongodb_config, schema_v2, index_registry
+
+#~ expanded objects that come back under a page's "includes": which collection
+#~ (in mongodb_config) each kind is kept in, and the field that identifies them
+INCLUDES_COLLECTIONS = {
+    "users": ("users_collection", ("id",)),
+    "media": ("media_collection", ("media_key",))}
 
 
 def mongo_checks():
@@ -40,68 +44,148 @@ def mongo_checks():
     return mongod_executable_path, mongoexport_executable_path, mongodump_executable_path, mongoimport_executable_path
 
 
-def start_mongo(mongod_executable_path, db_path, db_log_filename, epicosm_log_filename):
+#~ (collection, key fields) pairs we have already made sure are indexed this run
+_key_indexes = set()
+
+
+def ensure_key_index(working_collection, key_fields):
 
     """
-    Spin up a MongoDB daemon (mongod) from the shell.
+    Upserts look records up by their key, so without an index on it
+    every upsert would scan the whole collection. Make sure there is one,
+    once per collection per run: the collection's registered indexes (see
+    index_registry.py) are built if missing, and if the registry has none
+    for these fields and none of its indexes starts with them, a plain one
+    is made. A registered index that can't be built (eg unique, over
+    duplicates) is left for --build_indexes, not stood in for.
+
+    CALLS:  index_registry.ensure_indexes()
+            index_registry.registered_indexes()
+    """
+
+    index_key = (working_collection.full_name, tuple(key_fields))
+    if index_key in _key_indexes:
+        return
+    index_registry.ensure_indexes(working_collection)
+    key_fields = list(key_fields)
+
+    def leads_with(keys):
+        return [field for field, direction in list(keys)[:len(key_fields)]] == key_fields
+
+    registered = any(leads_with(keys) for name, keys, options in index_registry.registered_indexes(working_collection)[1])
+    covered = any(leads_with(info["key"]) for info in working_collection.index_information().values())
+    if not covered and not registered:
+        try:
+            working_collection.create_index([(field, pymongo.ASCENDING) for field in key_fields])
+        except pymongo.errors.OperationFailure:
+            pass #~ an index on these fields exists already, with other options
+    _key_indexes.add(index_key)
+
+
+def bulk_upsert(records, working_collection, key_fields=("id",)):
 
-    The db path is set as suitable to the environment (locally in the
-    folder it is run in, but docker in the volumes folder).
-    pgrep will look for running mongod processes and inform of conflicts,
-    but this might throw an error if it comes across a zombie, in which case
-    it ignores it and carries on with starting the daemon.
     """
+    Write a batch of records in one unordered bulk_write, upserting on their key
+    (the tweet id, or follower_id + id for follows), so records we already have
+    are left alone rather than duplicated. A duplicate key error (two writers
+    racing on the same record) doesn't stop the rest of the batch.
+    Records are stored in schema 2 if this run writes it (see schema_v2),
+    and matched on their key in either schema.
+
+    CALLS:  ensure_key_index()
+            collection.bulk_write()
+
+    ARGS:   a list of records (dicts),
+            the collection to write to,
+            the fields which identify a record.
+
+    RETS:   dict of counts: "inserted" new records, and "duplicates" we already had,
+            plus "upserted", the positions in records of the new ones.
+    """
+
+    if len(records) == 0:
+        return {"inserted": 0, "duplicates": 0, "upserted": set()}
+
+    ensure_key_index(working_collection, key_fields)
+    operations = [
+        pymongo.UpdateOne({field: schema_v2.id_match(record[field]) for field in key_fields},
+                          {"$setOnInsert": record},
+                          upsert=True)
+        for record in schema_v2.convert_records(records, working_collection.name)]
 
-    print(f"\nStarting the MongoDB daemon...")
     try:
-        subprocess.Popen([mongod_executable_path, "--dbpath",
-                          db_path, "--logpath", db_log_filename],
-                          stdout = open(epicosm_log_filename, "a+"))
-        time.sleep(1)
-    except subprocess.CalledProcessError as e:
-        print(f"Problem starting MongoDB:", e.output)
-        sys.exit(1)
+        result = working_collection.bulk_write(operations, ordered=False)
+        upserted = set(result.upserted_ids)
+    except pymongo.errors.BulkWriteError as e:
+        #~ 11000 is a duplicate key, anything else is a real problem
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+        upserted = {upsert["index"] for upsert in e.details["upserted"]}
 
-    true_db_path = subprocess.check_output([
-        "sh",
-        "./modules/get_mongo_dbpath.sh"])
-    print(f"MongoDB running, DB path: {true_db_path.decode('utf-8')}")
+    return {"inserted": len(upserted), "duplicates": len(records) - len(upserted), "upserted": upserted}
 
 
-def stop_mongo(dbpath):
+def insert_pages(api_responses, working_collection, key_fields=("id",)):
 
-    """ Gracefully close the MongoDB daemon.
+    """
+    Puts the records from one or more API response pages into a MongoDB
+    collection in a single bulk write, and reports how that went.
+    With --archive_pages, the pages are archived first (see page_archive);
+    if MongoDB then can't take them, the run still stops, but it says
+    the pages are safe in the archive for --load_archive.
 
-    pkill -15 is a standard way of ending mongod, which will close connections
-    cleanly. """
+    CALLS:  page_archive.archive_pages()
+            bulk_upsert()
 
-    print(f"Asking MongoDB to close...")
-    client.close()
-    subprocess.call(["pkill", "-15", "mongod"])
+    ARGS:   a list of the responses that the API sent back,
+            the collection to write to,
+            the fields which identify a record.
 
-    timeout = 60
-    while timeout > 0: #~ wait one minute for mongod to close
-        try:
-            subprocess.check_output(["pgrep", "mongod"])
-        except subprocess.CalledProcessError:
-            print(f"OK, MongoDB daemon closed.")
-            break
-        time.sleep(1)
-        timeout -= 1
-    if timeout == 0: #~ wait 1 minutes, then let it go...
-        print(f"MongoDB didn't respond to requests to close... be aware that MongoDB is still running.")
-    return
+    RETS:   dict of counts: "inserted" and "duplicates", and the
+            positions of the new records ("upserted").
+    """
 
+    page_archive.archive_pages(api_responses, working_collection.name, key_fields)
+    records = [record for api_response in api_responses for record in api_response["data"]]
+    try:
+        counts = bulk_upsert(records, working_collection, key_fields)
+    except pymongo.errors.ConnectionFailure:
+        if page_archive.archive is not None:
+            print(f"MongoDB can't be reached: the run stops here, but the last {len(api_responses)} "
+                  f"page(s) are safe in {page_archive.archive.folder}; load them with --load_archive.")
+        raise
+    print(f"Inserted {counts['inserted']} new records, {counts['duplicates']} already held.")
+    insert_includes(api_responses)
 
-def index_mongo(run_folder):
+    return counts
 
-    """Tidy up the database so that upsert operations are faster."""
 
-    if not os.path.isfile(run_folder + "/db/WiredTiger"):
-        return
-    print(f"\nIndexing MongoDB...")
-    db.tweets.create_index([("author_id", pymongo.ASCENDING)],
-                           unique=False, dropDups=False)
+def insert_includes(api_responses):
+
+    """
+    Upsert the expanded users and media that came with some pages into
+    their own collections, one document each however many tweets refer
+    to them. Anything else under "includes" is left.
+
+    CALLS:  bulk_upsert()
+
+    ARGS:   a list of the responses that the API sent back.
+
+    RETS:   dict of how many new records went into each collection.
+    """
+
+    inserted = {}
+    for kind, (collection_name, key_fields) in INCLUDES_COLLECTIONS.items():
+        records = [record for api_response in api_responses
+                   for record in api_response.get("includes", {}).get(kind, [])]
+        if len(records) == 0:
+            continue
+        counts = bulk_upsert(records, getattr(mongodb_config, collection_name), key_fields)
+        inserted[kind] = counts["inserted"]
+    if len(inserted) > 0:
+        print("Included: " + ", ".join(f"{count} new {kind}" for kind, count in inserted.items()) + ".")
+
+    return inserted
 
 
 def export_csv_tweets(mongoexport_executable_path,
@@ -140,22 +224,6 @@ def export_csv_friends(mongoexport_executable_path,
                      stderr = open(epicosm_log_filename, "a+"))
 
 
-def backup_db(mongodump_executable_path, database_dump_path, epicosm_log_filename, processtime):
-
-    """ Do a full backup of the database into BSON format """
-
-    print(f"\nBacking up the database...")
-    subprocess.call([mongodump_executable_path, "-o",
-                     database_dump_path, "--host=127.0.0.1"],
-                     stdout = open(epicosm_log_filename, "a+"),
-                     stderr = open(epicosm_log_filename, "a+"))
-    #~ mongodb doesn't give a naming option(?), so rename with the timestamp
-    subprocess.call(["mv", database_dump_path + "/twitter_db/tweets.bson",
-                     database_dump_path + "/twitter_db/tweets" + processtime + ".bson"])
-    subprocess.call(["mv", database_dump_path + "/twitter_db/tweets.metadata.json",
-                     database_dump_path + "/twitter_db/tweets" + processtime + ".metadata.json"])
-
-
 def export_latest_tweet(mongoexport_executable_path, epicosm_log_filename):
 
     """Export most recent tweet as csv"""
@@ -0,0 +1,284 @@
+#~ Standard library imports
+import os
+import sys
+import time
+import shlex
+import subprocess
+
+#~ 3rd party imports
+import pymongo
+from pymongo import uri_parser
+
+#~ Local application imports
+from modules import mongodb_config
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ probe
+#~ ping
+#~ ready
+#~ is_local
+#~ db_path_of_running
+#~ wait_until
+#~ wait_until_ready
+#~ mongod_command
+#~ start_mongod
+#~ stop_mongod
+
+
+#~ Start, find and stop the MongoDB daemon. A mongod is taken to be
+#~ running if it answers a ping at the configured uri (see
+#~ mongodb_config.configure), rather than if a process of that name
+#~ exists, so it works the same for a mongod started by hand, by another
+#~ run, or on another machine. One started here is waited on until it
+#~ says it can take writes, checking often at first and less often as
+#~ time goes on, and is stopped with the shutdown admin command.
+
+#~ how long a single ping waits for an answer
+PING_TIMEOUT_MS = 1000
+#~ readiness checks: the first wait, the longest wait, and when to give up
+FIRST_WAIT = 0.05
+LONGEST_WAIT = 2.0
+READY_TIMEOUT = 120
+STOP_TIMEOUT = 60
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+def probe(timeout_ms=PING_TIMEOUT_MS):
+
+    """
+    A short lived client for checking on the server, which gives up
+    quickly rather than waiting as long as the shared client would.
+    """
+
+    return pymongo.MongoClient(mongodb_config.connection_uri(), serverSelectionTimeoutMS=timeout_ms,
+                               connectTimeoutMS=timeout_ms)
+
+
+def ping(timeout_ms=PING_TIMEOUT_MS):
+
+    """Whether a MongoDB answers at the configured uri at all."""
+
+    client = probe(timeout_ms)
+    try:
+        client.admin.command("ping")
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+def ready(timeout_ms=PING_TIMEOUT_MS):
+
+    """
+    Whether MongoDB is ready for a harvest: it answers, and can take
+    writes (a mongod still recovering, or a replica set still electing,
+    answers but can't).
+    """
+
+    client = probe(timeout_ms)
+    try:
+        try:
+            hello = client.admin.command("hello")
+        except pymongo.errors.OperationFailure:
+            #~ servers before 4.4.2 (4.2.10, 4.0.21) don't know "hello", only its old name
+            hello = client.admin.command("isMaster")
+        return bool(hello.get("isWritablePrimary", hello.get("ismaster")))
+    except pymongo.errors.PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+def is_local():
+
+    """Whether the configured uri is a single server on this machine, which we can start."""
+
+    try:
+        nodes = uri_parser.parse_uri(mongodb_config.connection_uri())["nodelist"]
+    except (pymongo.errors.InvalidURI, pymongo.errors.ConfigurationError, ValueError):
+        return False
+
+    return len(nodes) == 1 and nodes[0][0] in LOCAL_HOSTS
+
+
+def db_path_of_running():
+
+    """The data folder of the running mongod, as it reports it (None if it won't say)."""
+
+    client = probe()
+    try:
+        options = client.admin.command("getCmdLineOpts")
+        return options.get("parsed", {}).get("storage", {}).get("dbPath")
+    except pymongo.errors.PyMongoError:
+        return None
+    finally:
+        client.close()
+
+
+def wait_until(check, timeout, first_wait=FIRST_WAIT, longest_wait=LONGEST_WAIT, give_up=None):
+
+    """
+    Check something until it is true, waiting twice as long after each
+    try (up to longest_wait), for up to timeout seconds.
+
+    ARGS:   a function returning True when done,
+            how long to keep trying, in seconds,
+            optionally, a function returning True if there's no point going on.
+
+    RETS:   True if it came true, False if not.
+    """
+
+    deadline = time.monotonic() + timeout
+    wait = first_wait
+    while True:
+        if check():
+            return True
+        if give_up is not None and give_up():
+            return False
+        if time.monotonic() + wait > deadline:
+            return False
+        time.sleep(wait)
+        wait = min(wait * 2, longest_wait)
+
+
+def wait_until_ready(process=None, timeout=READY_TIMEOUT):
+
+    """
+    Wait for MongoDB to answer and take writes, giving up early if the
+    mongod we started has exited.
+
+    ARGS:   the mongod subprocess.Popen, if we started it,
+            how long to wait, in seconds.
+
+    RETS:   True if it is ready.
+    """
+
+    start = time.monotonic()
+    exited = (lambda: process.poll() is not None) if process is not None else None
+    is_ready = wait_until(ready, timeout, give_up=exited)
+    if is_ready:
+        print(f"MongoDB ready after {time.monotonic() - start:.2f} seconds.")
+
+    return is_ready
+
+
+def mongod_command(mongod_executable_path, db_path, db_log_filename, cache_size_gb=None, options=None):
+
+    """
+    The command line to start mongod with.
+
+    ARGS:   the mongod executable,
+            the data folder, and the log file,
+            the WiredTiger cache size in GB (None for MongoDB's default,
+            half of (RAM - 1 GB)),
+            any other mongod options, as one string, eg "--bind_ip_all --quiet".
+
+    RETS:   list of arguments.
+    """
+
+    port = uri_parser.parse_uri(mongodb_config.connection_uri())["nodelist"][0][1]
+    command = [mongod_executable_path, "--dbpath", db_path, "--logpath", db_log_filename,
+               "--logappend", "--port", str(port)]
+    if cache_size_gb is not None:
+        command += ["--wiredTigerCacheSizeGB", f"{cache_size_gb:g}"]
+    if options:
+        command += shlex.split(options)
+
+    return command
+
+
+def start_mongod(mongod_executable_path, db_path, db_log_filename, epicosm_log_filename,
+                 cache_size_gb=None, options=None, timeout=READY_TIMEOUT):
+
+    """
+    Make sure MongoDB is running: if one already answers at the configured
+    uri it is used as it is, otherwise (on this machine) a mongod is started
+    and waited on until it is ready. Exits if neither works out.
+
+    CALLS:  ping()
+            mongod_command()
+            wait_until_ready()
+
+    ARGS:   the mongod executable,
+            the data folder, the mongod log file, and the Epicosm log
+            file (mongod's own output goes there),
+            the WiredTiger cache size in GB, and any other mongod options,
+            how long to wait for it to be ready, in seconds.
+
+    RETS:   the subprocess.Popen of the mongod started, or None if one was running.
+    """
+
+    if ping():
+        db_path_running = db_path_of_running()
+        print(f"\nMongoDB already running, DB path: {db_path_running or 'not given'}")
+        if db_path_running and os.path.realpath(db_path_running) != os.path.realpath(db_path):
+            print(f"(That isn't this folder's {db_path}: Epicosm will use the one running.)")
+        if not ready() and not wait_until_ready(timeout=timeout):
+            print(f"MongoDB is running but not taking writes. Stopping.")
+            sys.exit(1)
+        return None
+
+    if not is_local():
+        print(f"MongoDB at {mongodb_config.pool_stats()['uri']} isn't answering, "
+              f"and isn't on this machine to start. Stopping.")
+        sys.exit(1)
+
+    command = mongod_command(mongod_executable_path, db_path, db_log_filename, cache_size_gb, options)
+    print(f"\nStarting the MongoDB daemon...")
+    os.makedirs(os.path.dirname(db_log_filename), exist_ok=True)
+    #~ its own session, so a ctrl-c meant for Epicosm doesn't stop the database too
+    process = subprocess.Popen(command, stdout=open(epicosm_log_filename, "a+"),
+                               stderr=subprocess.STDOUT, start_new_session=True)
+
+    if not wait_until_ready(process, timeout):
+        if process.poll() is not None:
+            print(f"mongod stopped as it started (exit code {process.returncode}); "
+                  f"see {db_log_filename}. Stopping.")
+        else:
+            print(f"MongoDB didn't get ready within {timeout} seconds; see {db_log_filename}. Stopping.")
+        sys.exit(1)
+    print(f"MongoDB running, DB path: {db_path}")
+
+    return process
+
+
+def stop_mongod(timeout=STOP_TIMEOUT):
+
+    """
+    Ask MongoDB to shut down cleanly with the shutdown admin command, and
+    wait until it stops answering. If it won't shut down while replicas
+    catch up, it is asked again with force.
+
+    CALLS:  ping()
+            wait_until()
+
+    RETS:   True if it is down.
+    """
+
+    mongodb_config.close()
+    if not ping():
+        print(f"MongoDB isn't running.")
+        return True
+
+    print(f"Asking MongoDB to close...")
+    for command in ({"shutdown": 1}, {"shutdown": 1, "force": True}):
+        client = probe()
+        try:
+            client.admin.command(command)
+        except pymongo.errors.AutoReconnect:
+            pass #~ the server closes the connection as it goes down: what we want
+        except pymongo.errors.OperationFailure as e:
+            print(f"MongoDB wouldn't shut down: {e}")
+            continue
+        finally:
+            client.close()
+        break
+
+    if wait_until(lambda: not ping(), timeout):
+        print(f"OK, MongoDB daemon closed.")
+        return True
+    print(f"MongoDB didn't close within {timeout} seconds... be aware that MongoDB is still running.")
+
+    return False
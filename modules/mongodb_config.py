@@ -1,7 +1,279 @@
+#~ Standard library imports
+import os
+import time
+import threading
+
+#~ 3rd party imports
 import pymongo
+from pymongo import monitoring
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ PoolMonitor
+#~ parse_write_concern
+#~ configure
+#~ connection_uri
+#~ get_client
+#~ get_db
+#~ close
+#~ pool_stats
+#~ report_pool
+#~ __getattr__
+
+
+#~ The one MongoDB connection every module shares. Nothing connects at
+#~ import: the client is made the first time something asks for it, eg
+#~ mongodb_config.tweets_collection, so a run that never touches the DB
+#~ (--stop, --help) never opens a pool. Settings can be changed with
+#~ configure() (--mongo_uri, --mongo_pool_size, --write_concern) before then.
+
+#~ default connection settings; EPICOSM_MONGO_URI overrides the uri
+MONGO_URI = os.environ.get("EPICOSM_MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = "twitter_db"
+POOL_SIZE = 100
+SERVER_TIMEOUT_MS = 30000
+
+#~ the handles this module offers: attribute name: collection name
+COLLECTIONS = {
+    "tweets_collection": "tweets",
+    "follows_collection": "follows",
+    "pseudofeed_collection": "pseudofeed",
+    "harvest_state_collection": "harvest_state",
+    "harvest_cursors_collection": "harvest_cursors",
+    "harvest_jobs_collection": "harvest_jobs",
+    "user_failures_collection": "user_failures",
+    "archive_segments_collection": "archive_segments",
+    "users_collection": "users",
+    "media_collection": "media",
+    "schema_migrations_collection": "schema_migrations",
+    #~ the tweets, under the name the NLP code knows them by
+    "collection": "tweets"}
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+
+    """
+    Keeps count of what the client's connection pools do: connections
+    opened and closed, how many are checked out now and at most, and
+    how long threads waited to check one out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.created = 0
+            self.closed = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.in_use = 0
+            self.peak_in_use = 0
+            self.wait_seconds = 0.0
+            self.longest_wait = 0.0
+            self.cleared = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        self._waiting.started = time.monotonic()
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        waited = time.monotonic() - getattr(self._waiting, "started", time.monotonic())
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_seconds += waited
+            self.longest_wait = max(self.longest_wait, waited)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "connections_open": self.created - self.closed,
+                "connections_created": self.created,
+                "connections_closed": self.closed,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "checkout_wait_seconds": round(self.wait_seconds, 3),
+                "longest_checkout_wait": round(self.longest_wait, 3),
+                "pool_clears": self.cleared}
+
+
+#~ the client and its handles, made on first use
+_settings = {"uri": MONGO_URI, "db_name": DB_NAME, "pool_size": POOL_SIZE,
+             "write_concern": None, "server_timeout_ms": SERVER_TIMEOUT_MS}
+_client = None
+_handles = {}
+_lock = threading.Lock()
+pool_monitor = PoolMonitor()
+
+
+def parse_write_concern(value):
+
+    """
+    A write concern from the command line: "majority", or how many members
+    must have a write (at least 1: upserts need to hear what they did).
+
+    RETS:   the w value, as MongoDB wants it.
+    """
+
+    if value == "majority":
+        return value
+    if not value.isdigit() or int(value) < 1:
+        raise ValueError(f"A write concern is \"majority\" or a number of members, 1 or more, not {value}")
+
+    return int(value)
+
+
+def configure(uri=None, db_name=None, pool_size=None, write_concern=None, server_timeout_ms=None):
+
+    """
+    Change the connection settings. If the client has been made already,
+    it is closed, and made again with the new settings when next used.
+
+    ARGS:   the MongoDB uri, eg "mongodb://db.example.org:27017",
+            the database name,
+            the most connections to keep open,
+            the write concern w, "majority" or a number,
+            how long to look for a server before giving up, in ms.
+            (anything left as None is unchanged)
+    """
+
+    changes = {"uri": uri, "db_name": db_name, "pool_size": pool_size,
+               "write_concern": write_concern, "server_timeout_ms": server_timeout_ms}
+    _settings.update({setting: value for setting, value in changes.items() if value is not None})
+    close()
+
+
+def connection_uri():
+
+    """The uri the shared client connects to (see configure)."""
+
+    return _settings["uri"]
+
+
+def get_client():
+
+    """
+    The shared MongoClient, made the first time it is asked for.
+
+    RETS:   the pymongo.MongoClient.
+    """
+
+    global _client
+    with _lock:
+        if _client is None:
+            options = {"maxPoolSize": _settings["pool_size"],
+                       "serverSelectionTimeoutMS": _settings["server_timeout_ms"],
+                       "event_listeners": [pool_monitor]}
+            if _settings["write_concern"] is not None:
+                options["w"] = _settings["write_concern"]
+            _client = pymongo.MongoClient(_settings["uri"], **options)
+
+    return _client
+
+
+def get_db():
+
+    """The Epicosm database, on the shared client."""
+
+    return get_client()[_settings["db_name"]]
+
+
+def close():
+
+    """Close the shared client, if it was made. It is made again if used again."""
+
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _handles.clear()
+
+
+def pool_stats():
+
+    """
+    The connection settings and what the pools have done, for diagnostics.
+
+    RETS:   dict of the settings (no password) and the PoolMonitor's counts.
+    """
+
+    uri = _settings["uri"]
+    if "@" in uri:
+        uri = uri.split("://", 1)[0] + "://...@" + uri.rsplit("@", 1)[1]
+
+    return dict(pool_monitor.stats(), uri=uri, db_name=_settings["db_name"],
+                max_pool_size=_settings["pool_size"], write_concern=_settings["write_concern"] or 1,
+                connected=_client is not None)
+
+
+def report_pool():
+
+    """Print how the connection pools have done this run."""
+
+    stats = pool_stats()
+    if not stats["connected"]:
+        print(f"MongoDB connection pool: not used this run.")
+        return
+    print(f"MongoDB connection pool ({stats['uri']}, up to {stats['max_pool_size']} connections): "
+          f"{stats['connections_open']} open, {stats['connections_created']} made in all, "
+          f"at most {stats['peak_in_use']} in use at once; {stats['checkouts']} checkouts "
+          f"waited {stats['checkout_wait_seconds']} seconds in all (longest {stats['longest_checkout_wait']}), "
+          f"{stats['checkout_failures']} failed, {stats['pool_clears']} pool clears.")
+
+
+def __getattr__(name):
+
+    """
+    client, db and the collections in COLLECTIONS, made when first asked for.
+    """
+
+    if name == "client":
+        return get_client()
+    if name == "db":
+        return get_db()
+    if name in COLLECTIONS:
+        handle = _handles.get(name)
+        if handle is None:
+            handle = get_db()[COLLECTIONS[name]]
+            _handles[name] = handle
+        return handle
 
-client = pymongo.MongoClient("localhost", 27017)
-db = client.twitter_db
-tweets_collection = db.tweets
-follows_collection = db.follows
-pseudofeed_collection = db.pseudofeed
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
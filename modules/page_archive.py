@@ -0,0 +1,214 @@
+#~ Standard library imports
+import os
+import gzip
+import re
+import glob
+import atexit
+import socket
+import datetime
+import threading
+import zlib
+
+#~ Local application imports
+from modules import json_ops
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ PageArchive
+#~ open_archive
+#~ archive_pages
+#~ close_archive
+#~ writer_alive
+#~ list_segments
+#~ read_segment
+
+
+#~ With --archive_pages, every page the API sends back is appended to a
+#~ gzipped JSON lines segment file before it goes anywhere near MongoDB,
+#~ so a page that can't be written (mongod down, or stopped part way) is
+#~ never lost: archive_loader.py can put the segments into the DB later.
+#~ The archive only writes ahead: the harvest still needs MongoDB for
+#~ its state (since_ids, cursors), so a run stops when MongoDB goes down,
+#~ but every page it got before then is in the archive.
+#~ Each line is one page:
+#~   {"collection": "tweets", "key_fields": ["id"],
+#~    "archived": "<iso time>", "page": {... "data": [...] ...}}
+#~ A segment being written is named "<name>.jsonl.gz.open", and loses the
+#~ ".open" when it is full (SEGMENT_BYTES of pages) or the run ends. Each
+#~ page is flushed as it is written, so a segment left open by a crash can
+#~ still be read up to its last page.
+
+ARCHIVE_FOLDER = "page_archive"
+#~ start a new segment after this much (uncompressed) JSON
+SEGMENT_BYTES = 64 * 1024 * 1024
+OPEN_SUFFIX = ".open"
+
+
+class PageArchive:
+
+    """
+    Appends pages to rotating gzip segments. Safe to share between threads:
+    each page goes in whole, one after another.
+    """
+
+    def __init__(self, folder, segment_bytes=SEGMENT_BYTES):
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._file = None
+        self._path = None
+        self._written = 0
+        self.pages = 0
+        self.segments = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _start_segment(self):
+        stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        self._sequence += 1
+        name = f"pages-{stamp}-{self.host}-{self.pid}-{self._sequence:04d}.jsonl.gz"
+        self._path = os.path.join(self.folder, name + OPEN_SUFFIX)
+        self._file = gzip.open(self._path, "wb", compresslevel=6)
+        self._written = 0
+        self.segments += 1
+
+    def _seal_segment(self):
+        if self._file is None:
+            return
+        self._file.close()
+        os.rename(self._path, self._path[:-len(OPEN_SUFFIX)])
+        self._file = None
+        self._path = None
+
+    def append(self, collection_name, key_fields, pages):
+        archived = datetime.datetime.utcnow().isoformat(timespec="seconds")
+        lines = b"".join(json_ops.dumps({"collection": collection_name,
+                                         "key_fields": list(key_fields),
+                                         "archived": archived,
+                                         "page": page}) + b"\n"
+                         for page in pages)
+        with self._lock:
+            if self._file is None:
+                self._start_segment()
+            self._file.write(lines)
+            self._file.flush() #~ out to the OS, readable even if we crash
+            self._written += len(lines)
+            self.pages += len(pages)
+            if self._written >= self.segment_bytes:
+                self._seal_segment()
+
+    def close(self):
+        with self._lock:
+            self._seal_segment()
+
+
+#~ the archive pages are written to this run, if there is one
+archive = None
+
+
+def open_archive(run_folder, segment_bytes=SEGMENT_BYTES):
+
+    """
+    Start archiving every page inserted this run (see mongo_ops.insert_pages).
+    The open segment is sealed when the program exits.
+
+    ARGS:   the run folder (segments go in page_archive/ in it),
+            how much JSON to put in each segment.
+
+    RETS:   the PageArchive.
+    """
+
+    global archive
+    if archive is None:
+        archive = PageArchive(os.path.join(run_folder, ARCHIVE_FOLDER), segment_bytes)
+        atexit.register(close_archive)
+        print(f"Archiving every page to {archive.folder} before it is written to MongoDB.")
+
+    return archive
+
+
+def archive_pages(api_responses, collection_name, key_fields):
+
+    """
+    Append pages to the archive, if this run has one.
+
+    ARGS:   the pages, as they are about to be written,
+            the collection they are going into,
+            the fields which identify a record there.
+    """
+
+    if archive is not None:
+        archive.append(collection_name, key_fields, api_responses)
+
+
+def close_archive():
+
+    """Seal the open segment, so it is ready to be loaded."""
+
+    if archive is not None:
+        archive.close()
+
+
+def writer_alive(path):
+
+    """
+    Whether the process writing an open segment is still running. Only
+    processes on this machine can be checked; others are taken to be alive.
+    """
+
+    match = re.match(r"pages-\d{8}T\d{6}-(.+)-(\d+)-\d+\.jsonl\.gz", os.path.basename(path))
+    if match is None:
+        return False
+    host, pid = match.group(1), int(match.group(2))
+    if host != socket.gethostname():
+        return True
+    if pid == os.getpid():
+        return archive is not None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def list_segments(folder):
+
+    """
+    Find the segments ready to be loaded, oldest first. Segments left open
+    by a run that has since died are sealed and included; those still
+    being written are left.
+
+    RETS:   list of segment paths.
+    """
+
+    for path in glob.glob(os.path.join(folder, "*.jsonl.gz" + OPEN_SUFFIX)):
+        if not writer_alive(path):
+            print(f"Sealing {os.path.basename(path)}, left open by a run that stopped.")
+            os.rename(path, path[:-len(OPEN_SUFFIX)])
+
+    return sorted(glob.glob(os.path.join(folder, "*.jsonl.gz")))
+
+
+def read_segment(path):
+
+    """
+    Read a segment's pages. A segment cut short (its writer crashed) is
+    read up to the last whole page.
+
+    RETS:   yields each {"collection", "key_fields", "archived", "page"}.
+    """
+
+    with gzip.open(path, "rb") as infile:
+        try:
+            for line in infile:
+                try:
+                    yield json_ops.loads(line)
+                except ValueError:
+                    print(f"Skipping a broken page at the end of {os.path.basename(path)}.")
+        except (EOFError, OSError, zlib.error):
+            pass #~ the end of a segment that was never sealed
@@ -0,0 +1,264 @@
+#~ Standard library imports
+import re
+import time
+import threading
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ endpoint_family
+#~ TokenBucket
+#~ RateLimitGovernor
+
+
+#~ Twitter v2 app-auth budgets per 15 minute window, used until the API
+#~ tells us otherwise through its x-rate-limit-* headers.
+#~ family: (requests per window, window in seconds, minimum gap between requests)
+ENDPOINT_FAMILIES = {
+    "search/all": (300, 900, 1.0), #~ full archive search also allows only 1 request/second
+    "search/recent": (450, 900, 0.0),
+    "counts/all": (300, 900, 1.0), #~ paced like search/all
+    "users/:id/following": (15, 900, 0.0),
+    "users/by": (300, 900, 0.0),
+    "other": (300, 900, 0.0)}
+
+#~ how url paths map onto the families above
+ENDPOINT_PATTERNS = [
+    ("search/all", re.compile(r"/tweets/search/all")),
+    ("search/recent", re.compile(r"/tweets/search/recent")),
+    ("counts/all", re.compile(r"/tweets/counts/all")),
+    ("users/:id/following", re.compile(r"/users/[^/]+/following")),
+    ("users/by", re.compile(r"/users/by"))]
+
+#~ a little slack on top of x-rate-limit-reset, as our clock and twitter's differ a bit
+RESET_MARGIN = 0.5
+
+
+def endpoint_family(url):
+
+    """
+    Work out which rate limit family a request url belongs to.
+
+    ARGS:   the full url of the request.
+
+    RETS:   the family name, a key of ENDPOINT_FAMILIES.
+    """
+
+    for family, pattern in ENDPOINT_PATTERNS:
+        if pattern.search(url):
+            return family
+
+    return "other"
+
+
+class TokenBucket:
+
+    """
+    Token bucket for one endpoint family.
+
+    Tokens refill at limit / window per second, up to the limit.
+    Each request takes a token, and if there isn't one the caller
+    sleeps until there is. When the API says the budget is spent
+    (x-rate-limit-remaining: 0, or a 429) the bucket is blocked until
+    x-rate-limit-reset, and then refilled.
+    """
+
+    def __init__(self, family, limit, window, min_interval=0.0):
+        self.family = family
+        self.limit = limit
+        self.window = window
+        self.min_interval = min_interval
+        self._tokens = float(limit)
+        self._last_refill = time.time()
+        self._last_request = 0.0
+        self._blocked_until = 0.0
+        self._remaining = None #~ as last advertised by the API
+        self._reset = None
+        self._requests = 0
+        self._rate_limited = 0
+        self._waited = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def refill_rate(self):
+        return self.limit / self.window
+
+    def _refill(self, at):
+        if at > self._last_refill:
+            self._tokens = min(self.limit, self._tokens + (at - self._last_refill) * self.refill_rate)
+            self._last_refill = at
+
+    def acquire(self):
+
+        """
+        Take a token, sleeping until one is available.
+        The token is reserved under the lock and the sleep happens
+        outside it, so concurrent callers queue up one behind another.
+
+        RETS:   seconds slept.
+        """
+
+        with self._lock:
+            now = time.time()
+            start = max(now, self._last_request + self.min_interval)
+            if self._blocked_until > start:
+                start = self._blocked_until
+            if self._blocked_until and start >= self._blocked_until:
+                #~ the window has reset, so the whole budget is back
+                self._tokens = float(self.limit)
+                self._last_refill = max(self._last_refill, self._blocked_until)
+                self._blocked_until = 0.0
+                self._remaining = None
+            self._refill(start)
+            if self._tokens < 1:
+                start += (1 - self._tokens) / self.refill_rate
+                self._refill(start)
+            self._tokens -= 1
+            self._last_request = start
+            self._requests += 1
+            wait = start - now
+            if wait > 0:
+                self._waited += wait
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return max(wait, 0.0)
+
+    def available_in(self):
+
+        """How many seconds until a request would go out without waiting."""
+
+        with self._lock:
+            now = time.time()
+            start = max(now, self._last_request + self.min_interval, self._blocked_until)
+            if self._blocked_until and start >= self._blocked_until:
+                return start - now
+            tokens = min(self.limit, self._tokens + max(start - self._last_refill, 0) * self.refill_rate)
+            if tokens < 1:
+                start += (1 - tokens) / self.refill_rate
+            return start - now
+
+    def update(self, headers):
+
+        """
+        Bring the bucket into line with the x-rate-limit-* headers
+        of a response.
+
+        ARGS:   the response headers.
+        """
+
+        limit, remaining, reset = parse_rate_limit_headers(headers)
+        with self._lock:
+            if limit:
+                self.limit = limit
+            if remaining is not None:
+                self._remaining = remaining
+                self._tokens = min(self._tokens, remaining)
+            if reset is not None:
+                self._reset = reset
+                if remaining == 0:
+                    self._blocked_until = max(self._blocked_until, reset + RESET_MARGIN)
+
+    def rate_limited(self, headers):
+
+        """
+        The API has said 429: block the bucket until the reset time
+        it gave, or for a whole window if it didn't give one.
+
+        ARGS:   the response headers.
+
+        RETS:   seconds until the bucket reopens.
+        """
+
+        limit, remaining, reset = parse_rate_limit_headers(headers)
+        with self._lock:
+            now = time.time()
+            if reset is None:
+                reset = now + self.window
+            self._rate_limited += 1
+            self._remaining = 0
+            self._reset = reset
+            self._tokens = 0.0
+            self._blocked_until = max(self._blocked_until, reset + RESET_MARGIN)
+            return self._blocked_until - now
+
+    def state(self):
+
+        """A snapshot of this bucket, for logging and planning."""
+
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            return {
+                "limit": self.limit,
+                "window": self.window,
+                "tokens": round(max(self._tokens, 0.0), 2),
+                "remaining": self._remaining,
+                "reset": self._reset,
+                "seconds_until_reset": max(self._reset - now, 0.0) if self._reset else None,
+                "blocked_for": max(self._blocked_until - now, 0.0),
+                "requests": self._requests,
+                "rate_limited": self._rate_limited,
+                "waited_seconds": round(self._waited, 2)}
+
+
+def parse_rate_limit_headers(headers):
+
+    """
+    Pull the rate limit numbers out of a set of response headers.
+
+    RETS:   limit, remaining, reset (epoch seconds) - each None if absent.
+    """
+
+    def header_number(name):
+        try:
+            return int(headers.get(name))
+        except (TypeError, ValueError):
+            return None
+
+    return (header_number("x-rate-limit-limit"),
+            header_number("x-rate-limit-remaining"),
+            header_number("x-rate-limit-reset"))
+
+
+class RateLimitGovernor:
+
+    """
+    One token bucket per endpoint family, so that search/all, search/recent,
+    counts/all, users/:id/following and users/by are each paced to their own budget.
+    Each bearer token has its own governor (see twitter_api.TokenPool).
+
+    Usage around a request:
+        governor.acquire(url)
+        response = ...
+        governor.update(url, response.headers)
+        if response.status_code == 429:
+            governor.rate_limited(url, response.headers)
+    """
+
+    def __init__(self, families=None):
+        families = families or ENDPOINT_FAMILIES
+        self.buckets = {family: TokenBucket(family, *budget) for family, budget in families.items()}
+
+    def bucket(self, url):
+        family = endpoint_family(url)
+        return self.buckets.get(family, self.buckets["other"])
+
+    def acquire(self, url):
+        return self.bucket(url).acquire()
+
+    def available_in(self, url):
+        return self.bucket(url).available_in()
+
+    def update(self, url, headers):
+        self.bucket(url).update(headers)
+
+    def rate_limited(self, url, headers):
+        return self.bucket(url).rate_limited(headers)
+
+    def state(self):
+
+        """The current state of every endpoint family, as a dict."""
+
+        return {family: bucket.state() for family, bucket in self.buckets.items()}
+
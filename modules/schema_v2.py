@@ -0,0 +1,258 @@
+#~ Standard library imports
+import time
+import datetime
+import threading
+
+#~ 3rd party imports
+import pymongo
+from bson.int64 import Int64
+
+#~ Local application imports
+from modules import mongodb_config
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ enable
+#~ to_int64
+#~ to_date
+#~ to_v2
+#~ convert_records
+#~ id_match
+#~ time_after
+#~ migrate_collection
+#~ migrate
+#~ start_migration
+
+
+#~ Schema 1 is what the API sends: ids as strings ("1234..."), times as ISO
+#~ strings ("2021-03-04T05:06:07.000Z"). Schema 2 (--schema_v2) stores ids
+#~ as 64 bit integers and times as BSON dates, so indexes on them are
+#~ smaller and max/min/range queries run inside MongoDB on real numbers and
+#~ dates. Documents in schema 2 carry "schema": 2. Anything not listed
+#~ below (text, metrics, nested objects) is stored as the API sent it.
+#~
+#~ The two can sit side by side in a collection while an old one is being
+#~ migrated (--migrate_schema), so queries on ids and times go through
+#~ id_match() and time_after(), which match either.
+
+SCHEMA_VERSION = 2
+#~ collection name: (id fields, time fields)
+SCHEMA_FIELDS = {
+    "tweets": (("id", "author_id", "conversation_id", "in_reply_to_user_id"), ("created_at",)),
+    "follows": (("id", "follower_id", "pinned_tweet_id"), ("created_at",)),
+    "users": (("id", "pinned_tweet_id"), ("created_at",)),
+    "pseudofeed": (("user",), ("timestamp",))}
+#~ documents migrated per bulk write, and the pause between batches so a
+#~ harvest running alongside isn't starved
+MIGRATION_BATCH = 1000
+MIGRATION_PAUSE = 0.05
+
+#~ whether this run writes schema 2 (set by --schema_v2)
+enabled = False
+
+
+def enable():
+
+    """Write every new tweet, follow, user and pseudofeed in schema 2 from now on."""
+
+    global enabled
+    enabled = True
+    print(f"Storing new records in schema {SCHEMA_VERSION}: 64 bit ids and BSON dates.")
+
+
+def to_int64(value):
+
+    """An id as a 64 bit integer, or as it was if it isn't a number."""
+
+    if isinstance(value, Int64):
+        return value
+    try:
+        return Int64(int(value))
+    except (TypeError, ValueError):
+        return value
+
+
+def to_date(value):
+
+    """An ISO time string as a (utc) datetime, or as it was if it isn't one."""
+
+    if not isinstance(value, str):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+    except ValueError:
+        return value
+
+
+def to_v2(record, collection_name):
+
+    """
+    A record in schema 2.
+
+    ARGS:   the record as the API sent it (it isn't changed),
+            the collection it belongs in, a key of SCHEMA_FIELDS.
+
+    RETS:   a converted copy, or the record itself for other collections.
+    """
+
+    if collection_name not in SCHEMA_FIELDS:
+        return record
+    id_fields, time_fields = SCHEMA_FIELDS[collection_name]
+    converted = dict(record)
+    for field in id_fields:
+        if field in converted:
+            converted[field] = to_int64(converted[field])
+    for field in time_fields:
+        if field in converted:
+            converted[field] = to_date(converted[field])
+    converted["schema"] = SCHEMA_VERSION
+
+    return converted
+
+
+def convert_records(records, collection_name):
+
+    """The records as they should be stored this run: schema 2 if enabled, else as they are."""
+
+    if not enabled or collection_name not in SCHEMA_FIELDS:
+        return records
+
+    return [to_v2(record, collection_name) for record in records]
+
+
+def id_match(value):
+
+    """
+    A query value matching an id whichever schema it was stored in.
+
+    RETS:   {"$in": [the string, the Int64]}, or the value itself
+            if it isn't a number (eg a media_key).
+    """
+
+    as_int = to_int64(value)
+    if not isinstance(as_int, Int64):
+        return value
+
+    return {"$in": [str(int(as_int)), as_int]}
+
+
+def time_after(field, when):
+
+    """
+    A query matching documents whose time field is at or after a time,
+    whichever schema it was stored in (BSON compares strings only with
+    strings, and dates with dates).
+
+    ARGS:   the field name,
+            a utc datetime.
+    """
+
+    return {"$or": [{field: {"$gte": when.strftime("%Y-%m-%dT%H:%M:%S")}},
+                    {field: {"$gte": when}}]}
+
+
+def migrate_collection(working_collection, collection_name, batch_size=MIGRATION_BATCH,
+                       pause=MIGRATION_PAUSE, stop=None):
+
+    """
+    Convert a collection to schema 2 in batches, in _id order. Where it got
+    to is kept in the schema_migrations collection after every batch, so if
+    it is stopped it carries on from there next time. Documents already
+    in schema 2 are skipped.
+
+    CALLS:  to_v2()
+            collection.bulk_write()
+
+    ARGS:   the collection,
+            which SCHEMA_FIELDS entry it follows,
+            documents per batch, and seconds to pause between batches,
+            optionally, a threading.Event to stop at the next batch.
+
+    RETS:   how many documents were converted.
+    """
+
+    progress_collection = mongodb_config.schema_migrations_collection
+    progress = progress_collection.find_one({"_id": working_collection.name}) or {}
+    last_id = progress.get("last_id")
+    migrated = 0
+    id_fields, time_fields = SCHEMA_FIELDS[collection_name]
+    projection = {field: 1 for field in id_fields + time_fields + ("schema",)}
+    print(f"Migrating {working_collection.name} to schema {SCHEMA_VERSION}"
+          f"{', carrying on from where it stopped' if last_id is not None else ''}...")
+
+    while stop is None or not stop.is_set():
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        batch = list(working_collection.find(query, projection).sort("_id", 1).limit(batch_size))
+        if len(batch) == 0:
+            break
+        operations = []
+        for document in batch:
+            if document.get("schema") == SCHEMA_VERSION:
+                continue
+            converted = to_v2(document, collection_name)
+            operations.append(pymongo.UpdateOne(
+                {"_id": document["_id"]},
+                {"$set": {field: value for field, value in converted.items() if field != "_id"}}))
+        if len(operations) > 0:
+            working_collection.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+        last_id = batch[-1]["_id"]
+        progress_collection.update_one(
+            {"_id": working_collection.name},
+            {"$set": {"last_id": last_id, "updated": datetime.datetime.utcnow()},
+             "$inc": {"migrated": len(operations)}},
+            upsert=True)
+        if pause:
+            time.sleep(pause)
+
+    finished = stop is None or not stop.is_set()
+    if finished:
+        progress_collection.update_one({"_id": working_collection.name},
+                                       {"$set": {"finished": datetime.datetime.utcnow()}}, upsert=True)
+    print(f"Migrated {migrated} {working_collection.name} documents to schema {SCHEMA_VERSION}"
+          f"{'' if finished else ', stopped part way'}.")
+
+    return migrated
+
+
+def migrate(collection_names=("tweets", "follows", "pseudofeed"), batch_size=MIGRATION_BATCH,
+            pause=MIGRATION_PAUSE, stop=None):
+
+    """
+    Migrate the tweets, follows and pseudofeed collections in turn.
+
+    CALLS:  migrate_collection()
+
+    RETS:   dict of how many documents were converted in each.
+    """
+
+    migrated = {}
+    for collection_name in collection_names:
+        if stop is not None and stop.is_set():
+            break
+        working_collection = getattr(mongodb_config, f"{collection_name}_collection")
+        migrated[collection_name] = migrate_collection(working_collection, collection_name,
+                                                       batch_size, pause, stop)
+
+    return migrated
+
+
+def start_migration(batch_size=MIGRATION_BATCH, pause=MIGRATION_PAUSE):
+
+    """
+    Run the migration in a background thread, so a harvest can go on
+    at the same time. join() the thread to wait for it to finish, or
+    set() its stop event to have it stop after its current batch.
+    The thread doesn't hold up exiting (ctrl-c, --stop): a batch cut
+    short is simply done again next time.
+
+    RETS:   the thread, with its stop event as thread.stop.
+    """
+
+    stop = threading.Event()
+    thread = threading.Thread(target=migrate, name="schema-migration", daemon=True,
+                              kwargs={"batch_size": batch_size, "pause": pause, "stop": stop})
+    thread.stop = stop
+    thread.start()
+
+    return thread
@@ -0,0 +1,280 @@
+#~ Standard library imports
+import os
+import sys
+import threading
+
+#~ 3rd party imports
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, ConnectionError, Timeout
+from retry import retry
+
+#~ Local application imports
+from modules import rate_limit, json_ops, api_cassette
+try:
+    import bearer_token
+except ModuleNotFoundError as e:
+    print("Your bearer_token.py doesn't seem to be here.")
+    sys.exit(1)
+
+#~ one token, or a list of them if the study has several approved projects
+bearer_tokens = [token for token in getattr(bearer_token, "tokens", []) if token] or [bearer_token.token]
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Credential
+#~ TokenPool
+#~ endpoint_url
+#~ session
+#~ check_response
+#~ connect_to_endpoint
+#~ stats
+
+
+#~ can be pointed elsewhere, eg at harvest_benchmarker/mock_twitter.py
+API_ROOT = os.environ.get("EPICOSM_API_ROOT", "https://api.twitter.com/2")
+
+#~ seconds to wait for the TCP/TLS connection, and then for each read of the response
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 90
+
+#~ keep-alive connections held open per session (one session per thread)
+POOL_SIZE = 10
+
+
+#~ ERROR TAXONOMY ~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Everything is a RequestException, so older "except RequestException"
+#~ code still catches it.
+
+class TwitterAPIError(RequestException):
+
+    """Twitter answered, but not with a 200."""
+
+    def __init__(self, message, status_code=None, response=None):
+        super().__init__(message, response=response)
+        self.status_code = status_code
+
+
+class AuthenticationError(TwitterAPIError):
+
+    """401: the bearer token wasn't accepted."""
+
+
+class ServiceUnavailableError(TwitterAPIError):
+
+    """5xx: Twitter's servers are struggling, worth retrying."""
+
+
+class ClientError(TwitterAPIError):
+
+    """Any other 4xx: the request itself was wrong, retrying won't help."""
+
+
+class Credential:
+
+    """
+    One bearer token, with its own rate limit governor (each token has its
+    own budget). Used as the requests auth, so it signs the requests it is
+    chosen for.
+    """
+
+    def __init__(self, token, name, families=None):
+        self.token = token
+        self.name = name #~ what we call it in messages, never the token itself
+        self.governor = rate_limit.RateLimitGovernor(families)
+        self.revoked = False
+
+    def __call__(self, r):
+        r.headers["Authorization"] = f"Bearer {self.token}"
+        r.headers["User-Agent"] = "v2FullArchiveSearchPython"
+        return r
+
+
+class TokenPool:
+
+    """
+    All the bearer tokens we can use. Each request goes to the token that
+    can send it soonest, taking turns when several are free, so requests
+    spread across tokens. A token that is refused (401) is taken out of
+    rotation for the rest of the run; one that is rate limited just isn't
+    chosen until its limit resets, unless every token is waiting.
+    """
+
+    def __init__(self, tokens, families=None):
+        self.credentials = [Credential(token, f"token {number}", families)
+                            for number, token in enumerate(tokens, start=1)]
+        self._turn = 0
+        self._lock = threading.Lock()
+
+    def active(self):
+        return [credential for credential in self.credentials if not credential.revoked]
+
+    def choose(self, url):
+
+        """
+        Pick the token for a request to this url.
+
+        RETS:   a Credential, or raises AuthenticationError if none are left.
+        """
+
+        with self._lock:
+            active = self.active()
+            if len(active) == 0:
+                raise AuthenticationError("None of the bearer tokens were verified. Please check and retry.")
+            self._turn = (self._turn + 1) % len(active)
+            rotation = active[self._turn:] + active[:self._turn]
+
+        waits = [(credential.governor.available_in(url), position, credential)
+                 for position, credential in enumerate(rotation)]
+
+        return min(waits, key=lambda wait: wait[:2])[2]
+
+    def revoke(self, credential):
+        with self._lock:
+            credential.revoked = True
+        print(f"Bearer {credential.name} was not verified, taking it out of rotation "
+              f"({len(self.active())} left).")
+
+    def state(self):
+
+        """Each token's standing and rate limit state, as a dict."""
+
+        return {credential.name: {"active": not credential.revoked,
+                                  "limits": credential.governor.state()}
+                for credential in self.credentials}
+
+
+token_pool = TokenPool(bearer_tokens)
+
+
+def endpoint_url(path):
+
+    """
+    Build the full url for an API path, e.g. "tweets/search/all".
+    """
+
+    return f"{API_ROOT}/{path}"
+
+
+#~ each thread keeps its own session, and each session its own keep-alive pool,
+#~ so concurrent harvests don't fight over one connection pool
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "status_codes": {}}
+
+
+def session():
+
+    """
+    Get this thread's persistent requests session, making it on first use.
+    Connections are kept alive between requests, so a run of pages
+    only pays for one TLS handshake. With --record or --replay, the
+    session's transport records to, or answers from, a cassette
+    (see api_cassette).
+
+    RETS:   a requests.Session
+    """
+
+    if getattr(_local, "session", None) is None:
+        new_session = requests.Session()
+        adapter = (api_cassette.adapter(POOL_SIZE)
+                   or HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+        new_session.mount("https://", adapter)
+        new_session.mount("http://", adapter)
+        new_session.headers.update({
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive"})
+        _local.session = new_session
+
+    return _local.session
+
+
+def check_response(response):
+
+    """
+    Sort a response into the error taxonomy.
+
+    ARGS:   a requests response (not a 429, which the governors deal with)
+
+    RETS:   nothing if it was a 200, otherwise raises a TwitterAPIError subclass.
+    """
+
+    status_code = response.status_code
+    if status_code == 200:
+        return
+    if status_code == 401:
+        raise AuthenticationError("Bearer token was not verified. Please check and retry.",
+                                  status_code, response)
+    if status_code >= 500:
+        raise ServiceUnavailableError(f"Twitter's servers seem unavailable ({status_code}).",
+                                      status_code, response)
+    raise ClientError(f"Didn't get a 200 response: {status_code}", status_code, response)
+
+
+@retry((ServiceUnavailableError, ConnectionError, Timeout), delay=1, backoff=5, max_delay=900)
+def connect_to_endpoint(url, params=None):
+
+    """
+    Make connection to twitter endpoint
+
+    Each request goes out on whichever bearer token can send it soonest,
+    paced by that token's rate limit governor, which sleeps until the
+    endpoint's budget allows it. A 429 blocks that endpoint on that token
+    until the x-rate-limit-reset time the API gives, then tries again (on
+    another token if there is one). A token that gets a 401 is dropped, as
+    long as others are left. Server errors, dropped connections and
+    timeouts are retried with backoff.
+
+    CALLS:  token_pool.choose()
+            session()
+            Credential.governor
+            check_response()
+
+    ARGS:   url: the full URL built by endpoint_url, completed with
+            params (usually the fields you want). If you are doing
+            a user lookup, params aren't needed and can be left empty.
+
+    RETS:   response from the endpoint, decoded from json
+    """
+
+    while True:
+        credential = token_pool.choose(url)
+        credential.governor.acquire(url)
+        try:
+            response = session().get(url, params=params, auth=credential,
+                                     timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except (ConnectionError, Timeout):
+            print(f"Connection to Twitter dropped, trying again...")
+            raise
+        credential.governor.update(url, response.headers)
+        with _stats_lock:
+            _stats["requests"] += 1
+            _stats["status_codes"][response.status_code] = _stats["status_codes"].get(response.status_code, 0) + 1
+        if response.status_code == 401 and len(token_pool.credentials) > 1:
+            token_pool.revoke(credential)
+            continue
+        if response.status_code != 429:
+            break
+        cooldown = credential.governor.rate_limited(url, response.headers)
+        if len(token_pool.active()) > 1:
+            print(f"Rate limited on {credential.name} for {cooldown:.0f} seconds, trying another token...")
+        else:
+            print(f"Rate limited, waiting {cooldown:.0f} seconds for the limit to reset...")
+
+    try:
+        check_response(response)
+    except ServiceUnavailableError:
+        print("Twitter's servers seem unavailable, giving them a moment...")
+        raise
+
+    #~ decoded from the raw bytes, with orjson if it's installed (see json_ops)
+    return json_ops.loads(response.content)
+
+
+def stats():
+
+    """How many requests have been made, and what came back."""
+
+    with _stats_lock:
+        return {"requests": _stats["requests"],
+                "status_codes": dict(_stats["status_codes"])}
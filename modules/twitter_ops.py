@@ -3,76 +3,66 @@
 import os
 import sys
 import time
+import asyncio
+import datetime
 import re
 import json
 import subprocess
 
 #~ 3rd party imports
 import pymongo
-import requests
-from requests.exceptions import *
-from retry import retry
 from alive_progress import alive_bar
 
 #~ Local application imports
-try:
-    import bearer_token
-except ModuleNotFoundError as e:
-    print("Your bearer_token.py doesn't seem to be here.")
-    sys.exit(1)
-
-bearer_token = bearer_token.token
+from modules import twitter_api, mongo_ops, harvest_state, json_ops, user_failures
 
 #~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~
-#~ bearer_oauth
-#~ connect_to_endpoint
 #~ create_url
+#~ set_field_profile
+#~ timeline_fields
 #~ chunks
+#~ load_user_details
+#~ read_user_list
+#~ lookup_chunk
+#~ lookup_chunks
 #~ user_lookup
 #~ request_timeline_response
+#~ timeline_chain
+#~ walk_chain
+#~ timeline_pages
+#~ commit_timeline_page
+#~ finish_user_timeline
+#~ harvest_user_timeline
 #~ timeline_harvest
-#~ insert_to_mongodb
-
-def bearer_oauth(r):
-
-    """
-    Set up Oauth object.
-    """
-
-    r.headers["Authorization"] = f"Bearer {bearer_token}"
-    r.headers["User-Agent"] = "v2FullArchiveSearchPython"
-
-    return r
-
-
-@retry(RequestException, delay=1, backoff=5, max_delay=900)
-def connect_to_endpoint(url, params):
-
-    """
-    Make connection to twitter endpoint
-
-    CALLS:  requests.request()
-
-    ARGS:   url: the full URL built by create_url, completed with
-            params (usually the fields you want). If you are doing
-            a user lookup, params aren't needed and can be left empty.
-
-    RETS:   response from the endpoint as json
-    """
-
-    response = requests.request("GET", url, auth=bearer_oauth, params=params)
-    if response.status_code == 429:
-        print(f"Rate limited, waiting for cooldown...")
-        raise RequestException
-    if response.status_code == 401:
-        print("Bearer token was not verified. Please check and retry.")
-        sys.exit(129)
-    if response.status_code == 503:
-        print("Twitter's servers seem unavailable, giving them a moment...")
-        raise RequestException
-    elif response.status_code != 200:
-        print("Didn't get a 200 response:", response.status_code)
-    return response.json()
+#~ async_timeline_harvest
+
+#~ the endpoint family timeline checkpoints are kept under
+TIMELINE_ENDPOINT = "search/all"
+#~ what we ask for about each tweet (the "standard" profile)
+TIMELINE_FIELDS = "id,author_id,created_at,text,public_metrics,attachments,geo"
+
+#~ FIELD PROFILES ~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ How much to ask for about each tweet, chosen with --fields. Every profile
+#~ needs id and author_id (batches are sorted out by author). Expanded
+#~ objects come back once per page under "includes", and are kept in their
+#~ own collections (users, media; see mongo_ops.insert_includes) rather than
+#~ copied into every tweet that mentions them.
+USER_FIELDS = "id,username,name,created_at,description,location,public_metrics,protected,verified"
+MEDIA_FIELDS = "media_key,type,url,preview_image_url,duration_ms,height,width,public_metrics,alt_text"
+FIELD_PROFILES = {
+    "minimal": {
+        "tweet.fields": "id,author_id,created_at,text"},
+    "standard": {
+        "tweet.fields": TIMELINE_FIELDS},
+    "full": {
+        "tweet.fields": TIMELINE_FIELDS + ",conversation_id,in_reply_to_user_id,referenced_tweets,"
+                        "entities,lang,possibly_sensitive,reply_settings,source,context_annotations",
+        "expansions": "author_id,attachments.media_keys,in_reply_to_user_id,entities.mentions.username",
+        "user.fields": USER_FIELDS,
+        "media.fields": MEDIA_FIELDS}}
+
+#~ the profile this run asks for
+field_params = dict(FIELD_PROFILES["standard"])
 
 
 def create_url(screen_names):
@@ -89,11 +79,42 @@ def create_url(screen_names):
     #~ specify the fields we would like returned
     user_fields = "user.fields=id,username,name,created_at,description,location,pinned_tweet_id,public_metrics"
     #~ stick it all together
-    url = f"https://api.twitter.com/2/users/by?{usernames}&{user_fields}"
+    url = twitter_api.endpoint_url(f"users/by?{usernames}&{user_fields}")
 
     return url
 
 
+def set_field_profile(profile="standard", expansions=None):
+
+    """
+    Choose what timeline requests ask for.
+
+    ARGS:   the profile name, a key of FIELD_PROFILES,
+            optionally, expansions to add to it (comma separated),
+            e.g. "attachments.media_keys".
+    """
+
+    global field_params
+    params = dict(FIELD_PROFILES[profile])
+    if expansions:
+        wanted = [expansion for expansion in params.get("expansions", "").split(",") if expansion]
+        wanted += [expansion.strip() for expansion in expansions.split(",")
+                   if expansion.strip() and expansion.strip() not in wanted]
+        params["expansions"] = ",".join(wanted)
+        params.setdefault("user.fields", USER_FIELDS)
+        params.setdefault("media.fields", MEDIA_FIELDS)
+    field_params = params
+    print(f"Asking for the {profile} tweet fields"
+          f"{', expanding ' + params['expansions'] if params.get('expansions') else ''}.")
+
+
+def timeline_fields():
+
+    """The field and expansion params for a timeline request, to add to its own."""
+
+    return dict(field_params)
+
+
 def chunks(l, n):
 
     """split things into manageable blocks"""
@@ -102,15 +123,33 @@ def chunks(l, n):
         yield l[i:i+n]
 
 
-def user_lookup():
+def load_user_details(user_ids=None):
 
     """
-    Takes a text file with one twitter username per line,
-    queries twitter with these as blocks of 100 (the maximum),
-    and write out a file of the user details as json.
+    Load the user registry written by user_lookup.
 
-    CALLS:  create_url()
-            connect_to_endpoint()
+    ARGS:   optionally, the ids of the users wanted (default: everyone).
+
+    RETS:   the list of user details, in user_list order, or in the
+            order of user_ids if given (e.g. a harvest plan's).
+    """
+
+    #~ load in the json of users
+    user_details = json_ops.load_file("user_details.json")
+
+    if user_ids is not None:
+        by_id = {user["id"]: user for user in user_details}
+        user_details = [by_id[twitter_id] for twitter_id in user_ids if twitter_id in by_id]
+
+    return user_details
+
+
+def read_user_list():
+
+    """
+    Read and clean up user_list.
+
+    RETS:   the list of valid usernames, in the order given.
     """
 
     with open("user_list", "r") as infile: #~ clean up user_list
@@ -129,55 +168,177 @@ def user_lookup():
         if len(user_errors) > 0:
             print(f"Some usernames in user_list were invalid: {user_errors}.")
 
-    with open("user_details.json", "w") as outfile, open("user_errors.json", "w") as errorfile:
-        print(f"Looking up {len(users)} user details.")
-        json_array = []
-        json_errors = []
-        for chunk in list(chunks(users, 100)): #~ split list into manageable chunks of 100
-            comma_separated_string = ",".join(chunk) #~ lookup takes a comma-separated list
-            url = create_url(comma_separated_string)
-            json_response = connect_to_endpoint(url, params="")
-            for result in json_response["data"]: #~ I know this looks a little crazy
-                json_array.append(result)  #~ but I couldn't find another way to preserve
-            if "errors" in json_response:
-                for no_result in json_response["errors"]: #~ sane json nesting :/
-                    json_errors.append(no_result)
-        outfile.write(json.dumps(json_array, indent=4, sort_keys=True))
-        errorfile.write(json.dumps(json_errors, indent=4, sort_keys=True))
+    return users
+
+
+def lookup_chunk(chunk):
+
+    """
+    Look up one block of up to 100 usernames.
+
+    CALLS:  create_url()
+            twitter_api.connect_to_endpoint()
+
+    RETS:   the users found, and the errors for those that weren't.
+    """
+
+    comma_separated_string = ",".join(chunk) #~ lookup takes a comma-separated list
+    url = create_url(comma_separated_string)
+    try:
+        json_response = twitter_api.connect_to_endpoint(url, params="")
+    except twitter_api.AuthenticationError as e:
+        print(e)
+        sys.exit(129)
+
+    return json_response.get("data", []), json_response.get("errors", [])
 
 
-def request_timeline_response(twitter_id, timeline_params):
+async def lookup_chunks(name_chunks, concurrency):
+
+    """
+    Look up several blocks of usernames at once.
+
+    CALLS:  lookup_chunk()
+
+    RETS:   all the users found, and all the errors.
+    """
+
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def lookup_one(chunk):
+        async with semaphore:
+            return await asyncio.to_thread(lookup_chunk, chunk)
+
+    results = await asyncio.gather(*(lookup_one(chunk) for chunk in name_chunks))
+    found = [user for data, errors in results for user in data]
+    not_found = [error for data, errors in results for error in errors]
+
+    return found, not_found
+
+
+def user_lookup(max_age_days=None, concurrency=1):
+
+    """
+    Takes a text file with one twitter username per line,
+    queries twitter with these as blocks of 100 (the maximum),
+    and write out a file of the user details as json.
+
+    This is incremental: names already in user_details.json are kept as
+    they are, names no longer in user_list are dropped, and only new names
+    are looked up. If max_age_days is given, names which were last looked
+    up longer ago than that are checked again too.
+
+    CALLS:  read_user_list()
+            lookup_chunks()
+
+    ARGS:   how many days a looked up name stays good for (default: forever)
+            how many blocks of 100 to look up at once.
+    """
+
+    users = read_user_list()
+
+    #~ what we already know, matched on lower case (twitter names aren't case sensitive)
+    registry = {}
+    if os.path.exists("user_details.json"):
+        for user in json_ops.load_file("user_details.json"):
+            registry[user["username"].lower()] = user
+
+    wanted = {name.lower() for name in users}
+    dropped = [name for name in registry if name not in wanted]
+    for name in dropped:
+        del registry[name]
+
+    to_look_up = [name for name in users if name.lower() not in registry]
+    if max_age_days is not None:
+        cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=max_age_days)).isoformat(timespec="seconds")
+        stale = [name for name in users if name.lower() in registry
+                 and registry[name.lower()].get("epicosm_looked_up", "") < cutoff]
+        to_look_up = to_look_up + stale
+
+    #~ names that were gone or suspended last time are left until they are due a re-check
+    failing = user_failures.failing_keys(user_failures.name_key(name) for name in to_look_up)
+    to_look_up = [name for name in to_look_up if user_failures.name_key(name) not in failing]
+
+    print(f"{len(registry)} users already looked up, {len(dropped)} dropped from user_list, "
+          f"looking up {len(to_look_up)} user details"
+          f"{f' ({len(failing)} failed before and are not due a re-check)' if failing else ''}.")
+
+    #~ split list into manageable chunks of 100
+    found, json_errors = asyncio.run(lookup_chunks(list(chunks(to_look_up, 100)), concurrency))
+
+    #~ anyone we were re-checking who has now gone is no longer in the registry
+    previous_ids = {}
+    for name in to_look_up:
+        previous = registry.pop(name.lower(), None)
+        if previous is not None:
+            previous_ids[name.lower()] = previous["id"]
+    looked_up = datetime.datetime.utcnow().isoformat(timespec="seconds")
+    for user in found:
+        user["epicosm_looked_up"] = looked_up
+        registry[user["username"].lower()] = user
+        user_failures.clear_failure(user_failures.name_key(user["username"]))
+
+    #~ note why the rest failed, and under their old id too if we had one,
+    #~ so their timelines aren't asked for either
+    for error in json_errors:
+        name = str(error.get("value", ""))
+        if name == "":
+            continue
+        reason = user_failures.classify_error(error)
+        user_failures.record_failure(user_failures.name_key(name), reason, error.get("detail", ""))
+        if name.lower() in previous_ids:
+            user_failures.record_failure(previous_ids[name.lower()], reason, error.get("detail", ""))
+
+    #~ keep the order of user_list
+    json_array = [registry[name.lower()] for name in users if name.lower() in registry]
+
+    #~ the registry is read by every harvest, so it's kept compact; the errors are for people
+    json_ops.dump_file(json_array, "user_details.json")
+    json_ops.dump_file(json_errors, "user_errors.json", pretty=True)
+
+
+def request_timeline_response(twitter_id, timeline_params, label=None):
 
     """
     OK so this function tries to catch lots of things so looks a bit crazy.
     Using the timeline parameters built by the loop, gets the timeline of
     a twitter id.
 
-    CALLS:  connect_to_endpoint()
+    Problems down to the user (rather than the API) are noted in their
+    failure record, so they are left alone for a while if they keep failing.
+
+    CALLS:  twitter_api.connect_to_endpoint()
+            user_failures.record_failure()
 
-    ARGS:   the built timeline_url for API endpoint,
+    ARGS:   the ID number for the user (None for several users at once),
             timeline_parameters (what fields, how many, most recent),
-            the ID number for the user.
+            optionally, how to call them in messages.
 
     RETS:   hopefully, the timeline response as a JSON,
-            OR 1 if there was an issue. Return value 1 is
-            used as a trigger for the continue in the loop.
+            OR 0 if there was nothing (more) to get,
+            OR 1 if there was an issue. Return values 0 and 1 are
+            used as triggers for the continue in the loop.
     """
 
-    timeline_url = "https://api.twitter.com/2/tweets/search/all"
+    timeline_url = twitter_api.endpoint_url("tweets/search/all")
+    label = label or twitter_id
 
     try:
 
-        timeline_response = connect_to_endpoint(timeline_url, timeline_params)
+        timeline_response = twitter_api.connect_to_endpoint(timeline_url, timeline_params)
 
-        if timeline_response["meta"]["result_count"] == 0:
-            print(f"No new tweets for {twitter_id}.")
-            return 1 #~ all "return 1"s are triggers to continue the harvest loop
-
-        if "errors" in timeline_response:
-            print(f"Problem on {twitter_id} :", timeline_response["title"])
+        if "errors" in timeline_response and "data" not in timeline_response:
+            error = timeline_response["errors"][0]
+            print(f"Problem on {label} :", error.get("detail", error.get("title")))
+            if twitter_id is not None:
+                user_failures.record_failure(twitter_id, user_failures.classify_error(error),
+                                             error.get("detail", ""))
             return 1
 
+        if timeline_response["meta"]["result_count"] == 0:
+            print(f"No new tweets for {label}.")
+            return 0 #~ nothing more to get, the harvest of this user is complete
+
         #~ each subfield in "data" is a tweet / following.
         if "data" not in timeline_response:
             print(f"No data in response: {timeline_response}")
@@ -185,16 +346,199 @@ def request_timeline_response(twitter_id, timeline_params):
 
         return timeline_response
 
-    except RequestException:
-        print(f"Rate limited even after cooldown on {twitter_id}. Moving on...")
+    except twitter_api.AuthenticationError as e:
+        print(e)
+        sys.exit(129)
+
+    except twitter_api.ClientError as e:
+        print(f"Problem on {label}: {e}. Moving on...")
+        if twitter_id is not None:
+            user_failures.record_failure(twitter_id, *user_failures.classify_exception(e))
+        return 1
+
+    except twitter_api.TwitterAPIError as e:
+        print(f"Problem on {label}: {e}. Moving on...")
         return 1
 
     except Exception as e:
-        print(f"Something went wrong on {twitter_id}: {e}")
+        print(f"Something went wrong on {label}: {e}")
         return 1
 
 
-def timeline_harvest(db, working_collection):
+def timeline_chain(twitter_id, timeline_params, label=None):
+
+    """
+    Walk one search/all pagination chain, newest first. Each page is only
+    requested after the previous one has been handed back to the caller,
+    so since_id and next_token order is kept.
+
+    CALLS:  request_timeline_response()
+
+    ARGS:   the ID number for the user (None for several users at once),
+            the params for the first page of the chain,
+            optionally, how to call them in messages.
+
+    RETS:   yields (page, cursor) pairs, where cursor is the params for
+            the page after (None at the end of the chain). Stops early
+            if a request fails. Returns True if the chain was walked to
+            its end, False if it stopped early (see walk_chain).
+    """
+
+    while True:
+        api_response = request_timeline_response(twitter_id, timeline_params, label)
+        if api_response == 0: #~ the API has nothing more for this chain
+            return True
+        if api_response == 1: #~ this "1" is an end-trigger from request_timeline_response
+            return False
+        #~ we get a "next_token" if there are > 500 tweets.
+        if "next_token" not in api_response["meta"]:
+            yield api_response, None
+            return True
+        timeline_params = dict(timeline_params, next_token=api_response["meta"]["next_token"])
+        yield api_response, timeline_params
+
+
+def walk_chain(chain, outcome):
+
+    """
+    Pass the pages of a chain through, noting how it went in outcome:
+    "pages", how many it gave, and "complete", whether it got to its end.
+    The outcome is only final once the last page has been taken.
+
+    ARGS:   a generator of pages, such as timeline_chain or timeline_pages,
+            a dict to fill in.
+
+    RETS:   yields the chain's pages, and returns "complete".
+    """
+
+    outcome["pages"] = 0
+    outcome["complete"] = False
+    while True:
+        try:
+            page = next(chain)
+        except StopIteration as end:
+            outcome["complete"] = bool(end.value)
+            return outcome["complete"]
+        outcome["pages"] += 1
+        yield page
+
+
+def timeline_pages(twitter_id, working_collection):
+
+    """
+    Walk a user's timeline pages. If a previous harvest of this user was
+    interrupted part way along its chain, that chain is finished first from
+    its checkpoint, and then a fresh chain picks up anything newer.
+
+    CALLS:  harvest_state.load_cursor()
+            harvest_state.since_id()
+            timeline_chain()
+            walk_chain()
+
+    ARGS:   the ID number for the user,
+            the collection of tweets.
+
+    RETS:   yields (page, cursor) pairs, as timeline_chain, and returns
+            True if everything new was walked to the end.
+    """
+
+    resume_params = harvest_state.load_cursor(twitter_id, TIMELINE_ENDPOINT)
+    if resume_params is not None:
+        print(f"Resuming interrupted timeline harvest for user {twitter_id}...")
+        resumed = {}
+        yield from walk_chain(timeline_chain(twitter_id, resume_params), resumed)
+        if resumed["pages"] == 0: #~ the checkpoint is no use any more
+            harvest_state.clear_cursor(twitter_id, TIMELINE_ENDPOINT)
+        elif not resumed["complete"]: #~ stopped part way again, keep the checkpoint for next time
+            return False
+
+    timeline_params = {
+        "query": f"(from:{twitter_id})",
+        **timeline_fields(),
+        "max_results": 500,
+        "since_id": harvest_state.since_id(twitter_id, working_collection)}
+
+    #~ send the request for the first 500 tweets
+    print(f"Requesting timeline for user {twitter_id}...")
+    return (yield from timeline_chain(twitter_id, timeline_params))
+
+
+def commit_timeline_page(twitter_id, api_response, cursor, inserted):
+
+    """
+    Once a page of a user's tweets is in the DB, move their harvest state on
+    and checkpoint the pagination cursor, so if the harvest is stopped it
+    can carry on where it left off.
+
+    CALLS:  harvest_state.record_page()
+            harvest_state.save_cursor()
+            harvest_state.clear_cursor()
+
+    ARGS:   the ID number for the user,
+            the page the API sent back,
+            the params for the page after (None at the end of the chain),
+            how many of the page's tweets were new to the DB.
+    """
+
+    harvest_state.record_page(twitter_id, api_response["data"], inserted)
+    if cursor is None:
+        harvest_state.clear_cursor(twitter_id, TIMELINE_ENDPOINT)
+    else:
+        harvest_state.save_cursor(twitter_id, TIMELINE_ENDPOINT, cursor)
+
+
+def finish_user_timeline(twitter_id, complete=True):
+
+    """
+    Note the user as harvested (and whether we got everything new),
+    and say how many tweets we hold for them. A complete harvest
+    clears any failures they had before.
+    """
+
+    harvest_state.mark_run(twitter_id, complete)
+    if complete:
+        user_failures.clear_failure(twitter_id)
+    user_tweet_count = harvest_state.get_state(twitter_id)["count"]
+    print(f"Tweet count for user {twitter_id} in DB: {user_tweet_count}")
+
+
+def harvest_user_timeline(twitter_id, working_collection, stop=None):
+
+    """
+    Harvest everything new for one user and put it into MongoDB.
+    This is shared by the sequential and the concurrent harvests,
+    so both store exactly the same documents. If stopped, it leaves
+    off after the page in hand, with its checkpoint saved, and the user
+    isn't marked as run.
+
+    CALLS:  timeline_pages()
+            walk_chain()
+            mongo_ops.insert_pages()
+            commit_timeline_page()
+            finish_user_timeline()
+
+    ARGS:   the ID number for the user,
+            the collection of tweets,
+            optionally, a threading.Event to stop at the next page.
+
+    RETS:   "done" if the chain was walked to its end, "incomplete" if
+            a request failed part way (the user is still marked as run),
+            or "stopped".
+    """
+
+    outcome = {}
+    for api_response, cursor in walk_chain(timeline_pages(twitter_id, working_collection), outcome):
+        counts = mongo_ops.insert_pages([api_response], working_collection)
+        commit_timeline_page(twitter_id, api_response, cursor, counts["inserted"])
+        if stop is not None and stop.is_set():
+            print(f"Stopping the timeline harvest of {twitter_id} part way.")
+            return "stopped"
+    finish_user_timeline(twitter_id, outcome["complete"])
+
+    return "done" if outcome["complete"] else "incomplete"
+
+
+def timeline_harvest(db, working_collection, concurrency=1, user_ids=None):
 
     """
     This is the main running function for the harvester,
@@ -204,98 +548,63 @@ def timeline_harvest(db, working_collection):
     api.twitter.com/2/tweets/search/recent)
 
     1.  Takes the user_details as a list of ids to loop through
-    2.  Checks if the DB has this user, or what the newest harvested
-        tweet ID is.
+    2.  Checks the user's harvest state for the newest harvested
+        tweet ID, if we have one.
     3.  Harvests from the newest tweet, or as old as possible if new.
     4.  Inserts the response from the API to the DB, in batches of 500.
 
-    CALLS:  request_timeline_response()
-            insert_to_mongodb()
-            json.load()
-            collection.count_documents()
-            collection.find_one()
+    If concurrency is more than 1, several users are harvested at once
+    (see async_timeline_harvest).
+
+    CALLS:  load_user_details()
+            harvest_user_timeline()
+            async_timeline_harvest()
 
     ARGS:   db name (set in epicosm.py, just as local defaults)
             collection name (set in epicosm.py)
+            how many users to harvest at once (default 1)
+            optionally, which user ids to harvest (default: everyone)
     """
 
-    with open("user_details.json", "r") as infile:
-        #~ load in the json of users
-        user_details = json.load(infile)
+    user_details = load_user_details(user_ids)
 
-        total_users = (len(user_details))
-        print(f"\nHarvesting timelines from {total_users} users...")
+    total_users = (len(user_details))
+    print(f"\nHarvesting timelines from {total_users} users...")
 
+    if concurrency and concurrency > 1:
+        asyncio.run(async_timeline_harvest(user_details, working_collection, concurrency))
+    else:
         #~ loop over each user ID
         for user in user_details:
-
-            twitter_id = user["id"]
-
-            #~ check if we have this user in DB
-            if working_collection.count_documents({"author_id": twitter_id}) == 0:
-                latest_tweet = 1 #~ go as far back in time as possible.
-            else: #~ find latest tweet existing in working_collection
-                #~ I know this looks bonkers, but pymongo cannot alphanumeric sort (afaik)
-                tweet_ids = list(working_collection.find({"author_id": twitter_id}, {"id": 1}))
-                tweet_id_extract = []
-                for i in tweet_ids:
-                    tweet_id_extract.append(int(i["id"]))
-                latest_tweet = max(tweet_id_extract)
-
-            timeline_params = {
-                "query": f"(from:{twitter_id})",
-                "tweet.fields": "id,author_id,created_at,text,public_metrics,attachments,geo",
-                "max_results": 500,
-                "since_id": latest_tweet}
-
-            #~ send the request for the first 500 tweets and insert to mongodb
-            print(f"Requesting timeline for user {twitter_id}...")
-            api_response = request_timeline_response(twitter_id, timeline_params)
-            if api_response == 1: #~ this "1" is an end-trigger from request_timeline_response
-                user_tweet_count = working_collection.count_documents({"author_id": twitter_id})
-                print(f"Tweet count for user {twitter_id} in DB: {user_tweet_count}")
-                continue
-            else:
-                insert_to_mongodb(api_response, working_collection)
-
-            #~ we get a "next_token" if there are > 500 tweets.
-            try:
-                while "next_token" in api_response["meta"]:
-                    timeline_params["next_token"] = api_response["meta"]["next_token"]
-                    api_response = request_timeline_response(twitter_id, timeline_params)
-                    if api_response == 1: #~ "1" means "next"
-                        continue
-                    else:
-                        insert_to_mongodb(api_response, working_collection)
-            except TypeError as e:
-                print(e)
-                pass #~ move on for this harvest iteration.
-
-            user_tweet_count = working_collection.count_documents({"author_id": twitter_id})
-            print(f"Tweet count for user {twitter_id} in DB: {user_tweet_count}")
+            harvest_user_timeline(user["id"], working_collection)
 
     users_in_collection = len(working_collection.distinct("author_id"))
     print(f"\nThe DB contains a total of {working_collection.count()} tweets from {users_in_collection} users.")
 
 
-def insert_to_mongodb(api_response, working_collection):
+async def async_timeline_harvest(user_details, working_collection, concurrency):
 
     """
-    Puts tweets into the MongoDB database collection. I'm not sure if I am doing
-    this right, as "insert_one" loop seems silly? But I can't get "insert many"
-    to work.
+    Keep several users' pagination chains in flight at once.
+    Each user's chain still runs page after page (in a worker thread,
+    since requests and pymongo both block), and at most "concurrency"
+    users are being harvested at any time.
 
-    CALLS:  collection.insert_one()
+    CALLS:  harvest_user_timeline()
 
-    ARGS:   Stuff that the API sent back after query,
-            the name of the collection.
-
-    RETS:   Nothing, puts things into DB.
+    ARGS:   the loaded user_details list,
+            the collection of tweets,
+            how many users to harvest at once.
     """
 
-    for record in api_response["data"]:
+    print(f"Harvesting up to {concurrency} users at once.")
+    semaphore = asyncio.Semaphore(concurrency)
 
-        try:
-            working_collection.insert_one(record)
-        except pymongo.errors.DuplicateKeyError:
-            pass #~ denies duplicates being added
\ No newline at end of file
+    async def harvest_one(twitter_id):
+        async with semaphore:
+            try:
+                await asyncio.to_thread(harvest_user_timeline, twitter_id, working_collection)
+            except Exception as e:
+                print(f"Something went wrong on {twitter_id}: {e}")
+
+    await asyncio.gather(*(harvest_one(user["id"]) for user in user_details))
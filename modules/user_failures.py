@@ -0,0 +1,211 @@
+#~ Standard library imports
+import datetime
+
+#~ 3rd party imports
+from pymongo import ReturnDocument
+
+#~ Local application imports
+from modules import mongodb_config, json_ops
+
+
+#~ FUNCTION LIST ~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ name_key
+#~ classify_error
+#~ classify_exception
+#~ recheck_interval
+#~ record_failure
+#~ clear_failure
+#~ recorded_keys
+#~ failing_keys
+#~ due_keys
+#~ due_users
+
+
+#~ Accounts that can't be harvested (gone, suspended, protected, or just
+#~ failing every time) are kept in their own collection, so that rather
+#~ than being asked for on every run and every page, they are left alone
+#~ until they are due a re-check. Each failure in a row doubles the wait.
+#~ One document per account:
+#~   {"_id": "<twitter id>" or "@<lower case username>" (lookups, before we have an id),
+#~    "reason": "not_found" | "suspended" | "protected" | "errors",
+#~    "detail": <the API's message>,
+#~    "failures": <int>,        failures in a row
+#~    "first_failed": <date>, "last_failed": <date>,
+#~    "recheck_at": <date>}     left alone until then
+#~ A success clears the record.
+
+#~ how long to leave an account after its first failure, by reason
+RECHECK_AFTER = {
+    "not_found": datetime.timedelta(days=7),
+    "suspended": datetime.timedelta(days=7),
+    "protected": datetime.timedelta(days=3),
+    "errors": datetime.timedelta(hours=6)}
+#~ the longest an account is left before it's tried again
+MAX_RECHECK = datetime.timedelta(days=90)
+#~ an account with plain errors is only skipped once it has failed this many times in a row
+REPEATED_ERRORS = 3
+
+
+def name_key(username):
+
+    """The key a username is kept under, before we know its id."""
+
+    return "@" + username.lower()
+
+
+def classify_error(error):
+
+    """
+    Work out why an account failed, from an API error object (one of
+    the "errors" the API sends back alongside, or instead of, the data).
+
+    RETS:   the reason: "not_found", "suspended", "protected" or "errors".
+    """
+
+    title = str(error.get("title", "")).lower()
+    detail = str(error.get("detail", "")).lower()
+    error_type = str(error.get("type", "")).lower()
+    if "suspended" in detail:
+        return "suspended"
+    if "not-authorized" in error_type or "not authorized" in detail or "protected" in detail:
+        return "protected"
+    if "not found" in title or "resource-not-found" in error_type or "could not find" in detail:
+        return "not_found"
+
+    return "errors"
+
+
+def classify_exception(e):
+
+    """
+    Work out why an account failed, from a TwitterAPIError.
+
+    RETS:   the reason, and the API's message.
+    """
+
+    detail = str(e)
+    error = {}
+    response = getattr(e, "response", None)
+    if response is not None:
+        try:
+            body = json_ops.loads(response.content)
+            error = (body.get("errors") or [body])[0]
+            detail = error.get("detail", detail)
+        except Exception:
+            pass
+    reason = classify_error(error)
+    if reason == "errors" and getattr(e, "status_code", None) == 404:
+        reason = "not_found"
+
+    return reason, detail
+
+
+def recheck_interval(reason, failures):
+
+    """How long to leave an account after this many failures in a row."""
+
+    return min(RECHECK_AFTER.get(reason, RECHECK_AFTER["errors"]) * 2 ** max(failures - 1, 0), MAX_RECHECK)
+
+
+def record_failure(key, reason, detail="", failures_collection=None, now=None):
+
+    """
+    Note that an account failed, and when to try it again.
+
+    ARGS:   the twitter id (or name_key() of the username),
+            the reason (see classify_error),
+            the API's message.
+
+    RETS:   the updated failure record.
+    """
+
+    if failures_collection is None:
+        failures_collection = mongodb_config.user_failures_collection
+    now = now or datetime.datetime.utcnow()
+
+    failure = failures_collection.find_one_and_update(
+        {"_id": key},
+        {"$set": {"reason": reason, "detail": detail, "last_failed": now},
+         "$setOnInsert": {"first_failed": now},
+         "$inc": {"failures": 1}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+
+    if reason == "errors" and failure["failures"] < REPEATED_ERRORS:
+        recheck_at = now #~ not yet, it may just be a bad moment
+    else:
+        recheck_at = now + recheck_interval(reason, failure["failures"])
+    failures_collection.update_one({"_id": key}, {"$set": {"recheck_at": recheck_at}})
+    failure["recheck_at"] = recheck_at
+    if recheck_at > now:
+        print(f"{key} is {reason.replace('_', ' ')} ({failure['failures']} failures in a row), "
+              f"leaving it until {recheck_at.isoformat(timespec='minutes')}.")
+
+    return failure
+
+
+def clear_failure(key, failures_collection=None):
+
+    """Forget an account's failures, once it has worked again."""
+
+    if failures_collection is None:
+        failures_collection = mongodb_config.user_failures_collection
+
+    failures_collection.delete_one({"_id": key})
+
+
+def recorded_keys(keys, failures_collection=None):
+
+    """
+    Which of these accounts have a failure record at all, due or not,
+    so a success only has to clear the ones that do.
+
+    RETS:   set of the keys.
+    """
+
+    if failures_collection is None:
+        failures_collection = mongodb_config.user_failures_collection
+
+    return {failure["_id"] for failure in failures_collection.find(
+        {"_id": {"$in": list(keys)}}, {"_id": 1})}
+
+
+def failing_keys(keys, failures_collection=None, now=None):
+
+    """
+    Which of these accounts are being left alone for now.
+
+    RETS:   set of the keys not yet due a re-check.
+    """
+
+    if failures_collection is None:
+        failures_collection = mongodb_config.user_failures_collection
+    now = now or datetime.datetime.utcnow()
+
+    return {failure["_id"] for failure in failures_collection.find(
+        {"_id": {"$in": list(keys)}, "recheck_at": {"$gt": now}}, {"_id": 1})}
+
+
+def due_keys(keys, label="accounts", failures_collection=None, now=None):
+
+    """
+    Drop the accounts that are being left alone for now.
+
+    ARGS:   the twitter ids (or name keys),
+            what they are, for the message.
+
+    RETS:   list of the keys that are fine to ask for, in the order given.
+    """
+
+    keys = list(keys)
+    failing = failing_keys(keys, failures_collection, now)
+    if len(failing) > 0:
+        print(f"Skipping {len(failing)} {label} that failed before and aren't due a re-check yet.")
+
+    return [key for key in keys if key not in failing]
+
+
+def due_users(user_ids, now=None):
+
+    """The harvest users that are fine to ask for (see due_keys)."""
+
+    return due_keys(user_ids, "users", now=now)